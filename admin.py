@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import queue
+import socket
+import stat
+import threading
+import time
+
+REPLY_TIMEOUT = 5 # SECONDS to wait for the updater to carry out a queued command
+ADMIN_KEY = "admin" # the admin channel's sub-queue in the server's FairQueue
+CLIENT_ACTIONS = ("snapshot", "resync", "disconnect")
+
+# a control socket for operators, on a local unix socket so only users who can reach the
+# path get in. One command per line, one JSON reply per line:
+#   sessions                         every session with its cursor, bytes sent and lag in versions
+#   stats                            version, queue depth, op rate, connections and standbys
+#   snapshot|resync|disconnect ID    resend the doc, have the client resync by hashes, or drop it
+#   save [FILE]                      save now, to the autosave file if FILE is left out
+# `python admin.py PATH COMMAND...` sends one command and prints the reply
+
+
+class AdminChannel(object):
+    # reads go through a copy taken under data_lock, which only costs as long as copying a
+    # few dicts; anything that writes to a client is queued for the updater instead
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+        self.started = time.monotonic()
+        self.sample = (self.started, 0) # (when, ops processed) at the last stats command
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(f"{path} exists and isn't a socket, not replacing it")
+            # left over from a server that didn't shut down cleanly
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, daemon=True, name="admin_thread")
+        self.thread.start()
+
+    def stop(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                # stopped
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with conn, conn.makefile("rw", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                f.write(json.dumps(self.command(line)) + "\n")
+                f.flush()
+
+    def command(self, line):
+        name, *args = line.split()
+        try:
+            if name == "sessions" and not args:
+                return self.sessions()
+            if name == "stats" and not args:
+                return self.stats()
+            if name in CLIENT_ACTIONS and len(args) == 1:
+                return self.client_action(name, int(args[0]))
+            if name == "save" and len(args) <= 1:
+                return self.save(*args)
+        except (ValueError, OSError) as e:
+            return {"error": str(e)}
+        return {"error": f"unknown command {line.strip()!r}"}
+
+    def sessions(self):
+        server = self.server
+        with server.data_lock:
+            ver = server.doc_ver
+            connected = list(server.clients)
+            departed = list(server.departed)
+            cursors = dict(server.client_cursors)
+            viewports = dict(server.viewports)
+            traffic = {client_id: list(counts) for client_id, counts in server.traffic.items()}
+            crdt_peers = set(server.crdt_peers)
+            highlighters = set(server.highlighters)
+        sessions = []
+        for client_id in connected + departed:
+            sent, last = traffic.get(client_id, (0, None))
+            sessions.append({"id": client_id, "connected": client_id not in departed, "cursor": cursors.get(client_id),
+                             "viewport": viewports.get(client_id), "crdt": client_id in crdt_peers,
+                             "highlight": client_id in highlighters, "bytes": sent,
+                             "lag": None if last is None else ver - last})
+        return {"ver": ver, "sessions": sessions}
+
+    def stats(self):
+        server = self.server
+        with server.data_lock:
+            ver, lines, ops = server.doc_ver, len(server.doc), server.ops_processed
+            clients, departed = len(server.clients), len(server.departed)
+            replicas = server.replication_status()
+        now = time.monotonic()
+        # the rate since the previous stats command, so polling it gives a current figure
+        since, before = self.sample
+        self.sample = (now, ops)
+        return {"ver": ver, "lines": lines, "queue": server.op_queue.qsize(), "ops": ops,
+                "op_rate": round((ops - before) / max(now - since, 1e-9), 1), "clients": clients,
+                "departed": departed, "viewers": len(server.viewer_hub), "replicas": replicas,
+                "uptime": round(now - self.started, 1)}
+
+    def client_action(self, action, client_id):
+        reply = queue.Queue()
+        self.server.op_queue.put({"opcode": "ADMIN", "id": client_id, "action": action, "reply": reply}, ADMIN_KEY)
+        try:
+            return reply.get(timeout=REPLY_TIMEOUT)
+        except queue.Empty:
+            return {"error": "the updater didn't get to it in time"}
+
+    def save(self, path=None):
+        autosaver = self.server.autosaver
+        if path is None:
+            if autosaver is None:
+                return {"error": "no autosave file, give one to save to"}
+            written = autosaver.save()
+            return {"saved": autosaver.path, "ver": autosaver.saved_ver, "written": written}
+        self.server.write_file(path)
+        return {"saved": path, "written": True}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="The server's admin socket, as given to its --admin")
+    parser.add_argument("command", nargs="+", help="sessions, stats, snapshot ID, resync ID, disconnect ID or save [FILE]")
+    args = parser.parse_args()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(args.path)
+        with sock.makefile("rw", encoding="utf-8") as f:
+            f.write(" ".join(args.command) + "\n")
+            f.flush()
+            print(json.dumps(json.loads(f.readline()), indent=2))
+
+if __name__ == "__main__":
+    main()
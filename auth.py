@@ -0,0 +1,30 @@
+import secrets
+
+# what each role may send, worked out once so checking an op is a single set lookup.
+# DISCONNECT and SESSION are only ever queued by the server itself, so no role includes them
+READ_OPCODES = frozenset({"AUTH", "SUBSCRIBE", "RESUME", "RESYNC", "HISTORY", "EXPORT", "CURSOR", "FIND", "VIEWPORT", "HIGHLIGHT"})
+WRITE_OPCODES = READ_OPCODES | {"MODIFY", "UNDO", "REDO", "REPLACE_ALL", "MULTI", "CRDT", "CRDT_SYNC", "IMPORT"}
+ADMIN_OPCODES = WRITE_OPCODES | {"REPLICATE", "ACK"}
+ROLE_OPCODES = {"read": READ_OPCODES, "write": WRITE_OPCODES, "admin": ADMIN_OPCODES}
+# what a connection may do before it has authenticated against a server that wants keys
+UNAUTHENTICATED_OPCODES = frozenset({"AUTH"})
+OPEN_ROLE = "admin" # without a key file everyone is trusted, as before there were roles
+
+
+def load_keys(path):
+    # one "<key> <role>" per line, blank lines and # comments ignored
+    keys = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) != 2 or parts[1] not in ROLE_OPCODES:
+                raise ValueError(f"{path}:{number}: expected '<key> <read|write|admin>'")
+            keys[parts[0]] = parts[1]
+    return keys
+
+
+def new_token():
+    return secrets.token_hex(16)
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import threading
+import time
+
+AUTOSAVE_DELAY = 1.0       # SECONDS without edits before the doc is saved
+AUTOSAVE_MAX_DELAY = 10.0  # SECONDS an edit may stay unsaved while typing never pauses
+
+
+def write_atomic(path, lines):
+    # write next to the target and rename over it, so a crash mid-write leaves the old file intact
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Autosaver(object):
+    # saves the server's doc from its own thread. The updater only calls notify(), which is O(1);
+    # the worker waits for a quiet moment, copies the line list under the server's data_lock
+    # (lines are immutable strings, so the copy is a consistent version) and writes outside it
+    def __init__(self, server, path, delay=AUTOSAVE_DELAY, max_delay=AUTOSAVE_MAX_DELAY):
+        self.server = server
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.saved_ver = server.doc_ver
+        self.first_change = None # when the oldest unsaved edit came in
+        self.last_change = None
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True, name="autosave_thread")
+        self.thread.start()
+
+    def stop(self):
+        # flush whatever is still unsaved
+        self.running = False
+        self.changed.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.save()
+
+    def notify(self):
+        # called from the updater thread after every new version
+        now = time.monotonic()
+        with self.lock:
+            if self.first_change is None:
+                self.first_change = now
+            self.last_change = now
+        self.changed.set()
+
+    def run(self):
+        while self.running:
+            self.changed.wait()
+            # debounce: wait until edits pause, but not forever
+            while self.running:
+                with self.lock:
+                    due = min(self.last_change + self.delay, self.first_change + self.max_delay)
+                now = time.monotonic()
+                if now >= due:
+                    break
+                time.sleep(due - now)
+            with self.lock:
+                self.changed.clear()
+                self.first_change = None
+            if self.running:
+                self.save()
+
+    def save(self):
+        # returns whether anything was written; an unchanged doc_ver means nothing to do
+        with self.server.data_lock:
+            ver, lines = self.server.doc_ver, list(self.server.doc)
+        if ver == self.saved_ver:
+            return False
+        write_atomic(self.path, lines)
+        self.saved_ver = ver
+        print(f"Saved version {ver} to {self.path}")
+        return True
@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+import ctypes
+import math
+import os
+import statistics
+import sys
+import time
+from server import Server
+
+# micro-benchmarks for the edit hot path. Each case is timed across one axis (doc lines, line
+# length or connected clients) and the log-log slope of median time against that axis is checked
+# against a complexity budget: ~0 is constant, ~1 linear, anything near 2 is the O(n^2) we want to
+# catch. Run `python bench.py` (or --quick), the report also goes to bench_output.txt.
+
+LINES = [10, 100, 1000, 10000, 100000, 1000000]
+LINE_LENGTHS = [10, 100, 1000, 10000]
+CLIENTS = [1, 10, 100, 1000]
+QUICK_LINES = [10, 100, 1000, 10000, 100000, 300000]
+TARGET_SECONDS = 0.5 # per measurement; slow cases run fewer rounds instead of longer
+MIN_ROUNDS = 5
+REPEATS = 3          # fresh setups per size, so one unlucky run can't move the median much
+SLOPE_SIZES = 3      # fit the slope over the largest sizes, small ones are all call overhead
+M_MMAP_THRESHOLD = -3        # glibc mallopt() parameter
+MMAP_THRESHOLD = 128 * 1024  # its default starting value, kept from then on
+
+# (case, axis) -> highest slope allowed
+BUDGETS = {
+    ("insert_char", "lines"): 0.5,
+    ("insert_char", "line_length"): 1.5,
+    ("insert_char", "clients"): 1.5,
+    ("remove_char", "lines"): 0.5,
+    ("remove_char", "clients"): 1.5,
+    ("do_enter", "lines"): 1.5,
+    ("do_enter", "clients"): 1.5,
+    ("process_op", "lines"): 1.5,
+    ("process_op", "clients"): 1.5,
+    ("send_file", "lines"): 1.5,
+}
+
+
+class NullSocket(object):
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_server(lines=100, line_length=40, clients=1):
+    # a fully set up server on a throwaway port, with clients that swallow whatever is sent
+    server = Server("127.0.0.1", 0)
+    server.server_socket.close()
+    server.doc = ["x" * line_length + "\n"] * (lines - 1) + ["x" * line_length]
+    for i in range(clients):
+        server.clients[i + 1] = NullSocket()
+        server.client_cursors[i + 1] = f"{i % lines + 1}.0"
+    return server
+
+
+def measure(func, rounds, restore=None):
+    # per-call seconds; restore() runs untimed after each call to put the doc back
+    func()
+    if restore:
+        restore()
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    if restore:
+        restore()
+    rounds = max(MIN_ROUNDS, min(rounds, int(TARGET_SECONDS / max(first, 1e-9))))
+    times = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+        if restore:
+            restore()
+    return times
+
+
+def case_insert_char(lines=1000, line_length=40, clients=1):
+    server = make_server(lines, line_length, clients)
+    line, idx = lines // 2 + 1, line_length // 2
+    return (lambda: server.insert_char(line, idx, "a", 1),
+            lambda: server.remove_char(line, idx, 1))
+
+
+def case_remove_char(lines=1000, line_length=40, clients=1):
+    server = make_server(lines, line_length, clients)
+    line, idx = lines // 2 + 1, line_length // 2
+    return (lambda: server.remove_char(line, idx, 1),
+            lambda: server.insert_char(line, idx, "x", 1))
+
+
+def case_do_enter(lines=1000, line_length=40, clients=1):
+    server = make_server(lines, line_length, clients)
+    line, idx = lines // 2 + 1, line_length // 2
+    return (lambda: server.do_enter(line, idx, 1),
+            lambda: server.remove_char(line + 1, -1, 1))
+
+
+def case_process_op(lines=1000, line_length=40, clients=1):
+    # a whole keystroke: apply, record for undo, and broadcast to every client
+    server = make_server(lines, line_length, clients)
+    op = {"opcode": "MODIFY", "line": str(lines // 2 + 1), "idx": str(line_length // 2), "char": "a", "ver": 0, "id": 1}
+    return (lambda: server.process_op(dict(op)), None)
+
+
+def case_send_file(lines=1000, line_length=40, clients=1):
+    server = make_server(lines, line_length, clients)
+    return (lambda: server.send_file(1), None)
+
+
+CASES = {
+    "insert_char": case_insert_char,
+    "remove_char": case_remove_char,
+    "do_enter": case_do_enter,
+    "process_op": case_process_op,
+    "send_file": case_send_file,
+}
+
+
+def fit_slope(sizes, medians):
+    # least squares slope of log(time) over log(size)
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(median, 1e-12)) for median in medians]
+    mean_x, mean_y = statistics.fmean(xs), statistics.fmean(ys)
+    var = sum((x - mean_x) ** 2 for x in xs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var if var else 0.0
+
+
+def pin_allocator():
+    # glibc raises its mmap threshold each time a big block is freed, so whether a whole-doc
+    # frame comes from fresh pages (a page fault every 4k) or from reused heap depends on which
+    # cases ran before. That made send_file, linear by construction, fit as O(n^1.5) after
+    # process_op had run. Fixing the threshold keeps every large size in the same regime
+    try:
+        ctypes.CDLL("libc.so.6").mallopt(M_MMAP_THRESHOLD, MMAP_THRESHOLD)
+    except (OSError, AttributeError):
+        # not glibc, its allocator doesn't play this trick
+        pass
+
+
+def run(axes, rounds, cases=None):
+    # returns {(case, axis): [(size, times), ...]}
+    results = {}
+    for (case, axis) in BUDGETS:
+        if axis not in axes or (cases and case not in cases):
+            continue
+        results[(case, axis)] = []
+        for size in axes[axis]:
+            if axis == "clients" and case in ("process_op",) and size > 100:
+                # every client gets a frame, past 100 this only measures send_file again
+                continue
+            times = []
+            for repeat in range(REPEATS):
+                func, restore = CASES[case](**{axis: size, **({"lines": 1000} if axis != "lines" else {})})
+                times += measure(func, rounds, restore)
+            results[(case, axis)].append((size, times))
+    return results
+
+
+def report(results):
+    # pytest-benchmark style table per axis, then the scaling check; returns (lines, failures)
+    out = []
+    failures = []
+    for axis in ("lines", "line_length", "clients"):
+        rows = [(case, size, times) for (case, a), runs in results.items() if a == axis for size, times in runs]
+        if not rows:
+            continue
+        out.append(f"{'-' * 30} benchmark: {axis} {'-' * 30}")
+        out.append(f"{'Name (time in us)':<32}{'Min':>12}{'Max':>12}{'Mean':>12}{'StdDev':>12}{'Median':>12}{'OPS':>14}{'Rounds':>8}")
+        for case, size, times in rows:
+            us = [t * 1e6 for t in times]
+            median = statistics.median(us)
+            out.append(f"{case + '[' + axis + '=' + str(size) + ']':<32}{min(us):>12.2f}{max(us):>12.2f}{statistics.fmean(us):>12.2f}"
+                       f"{statistics.pstdev(us):>12.2f}{median:>12.2f}{1e6 / median:>14.1f}{len(us):>8}")
+        out.append("")
+    out.append(f"{'-' * 30} scaling {'-' * 30}")
+    for (case, axis), runs in results.items():
+        runs = runs[-SLOPE_SIZES:]
+        if len(runs) < 2:
+            continue
+        slope = fit_slope([size for size, times in runs], [statistics.median(times) for size, times in runs])
+        budget = BUDGETS[(case, axis)]
+        status = "ok" if slope <= budget else "REGRESSION"
+        if slope > budget:
+            failures.append((case, axis, slope, budget))
+        out.append(f"{case:<14} vs {axis:<12} slope {slope:5.2f}  (budget {budget:.2f}, ~O(n^{slope:.1f}))  {status}")
+    return out, failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes and fewer rounds, for a fast check")
+    parser.add_argument("--rounds", type=int, default=200, help="Most timed calls per measurement")
+    parser.add_argument("--case", action="append", choices=sorted(CASES), help="Only run this case (repeatable)")
+    parser.add_argument("--output", default="bench_output.txt", help="Also write the report here")
+    args = parser.parse_args()
+
+    axes = {"lines": QUICK_LINES if args.quick else LINES, "line_length": LINE_LENGTHS, "clients": CLIENTS}
+    rounds = min(args.rounds, 50) if args.quick else args.rounds
+    pin_allocator()
+    # the server narrates every op on stdout, which would drown the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = run(axes, rounds, args.case)
+    lines, failures = report(results)
+    text = "\n".join(lines) + "\n"
+    print(text, end="")
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if failures:
+        for case, axis, slope, budget in failures:
+            print(f"{case} scales as ~O(n^{slope:.1f}) in {axis}, over its budget of {budget}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
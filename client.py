@@ -1,55 +1,425 @@
 import argparse
 import socket
 import tkinter as tk
+from tkinter import simpledialog
 import json
 import threading 
+import time
+import queue
+from crdt import CRDTDocument, text_to_lines, line_offset
+from history import apply_to_lines, SPLIT
+from linehash import block_hashes, root_hash, rebuild, BLOCK_LINES
+from columns import ColumnMap, cluster_start
+from protocol import read_greeting
 
 DELIMITER = "\u001D"
+FRAME_END = "\u001E"
+TK_ASTRAL_WIDTH = 2 if tk.TkVersion < 9 else 1 # tk columns a character outside the BMP takes
+SEND_COALESCE = 0.004 # SECONDS the sender waits for more ops to go out in the same write
+RECONNECT_ATTEMPTS = 10
+RECONNECT_DELAY = 0.5 # SECONDS before the first retry, doubled after every failed one
+RECONNECT_MAX_DELAY = 8
 
 class Client(object):
 
-    def __init__(self, host, port):
-        # Create a TCP socket
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((host, port))
-        
-        for i in range(10):
-            data = self.client_socket.recv(4096)
-            if data:
-                data = data.decode("utf-8", errors="ignore").split(DELIMITER)
-                self.id = int(data[0].strip("ID: "))
-                break
+    def __init__(self, host, port, read_only=False, viewport=0, crdt=False, fallbacks=(), highlight=False, key=None):
+        # reconnecting walks these in turn, so a hot standby can take over from the server
+        self.addresses = [(host, port)] + list(fallbacks)
+        self.closed = False # set by close(), so a dropped connection can be told from our own shutdown
+        # servers started with --auth want a key first; they answer with a token for resuming the session
+        self.key = key
+        self.token = None
+        self.role = None
+        # ops from the GUI queue here and a sender thread writes them, so a slow socket never
+        # stalls tk; send_lock keeps it off the socket while a reconnect handshakes
+        self.outgoing = queue.Queue()
+        self.send_lock = threading.Lock()
+        self.connect(self.addresses[0])
+        self.sender_thread = threading.Thread(target=self.sender, daemon=True, name="sender thread")
+        self.sender_thread.start()
+
+        # viewers only receive the document and never send edits
+        self.read_only = read_only
+        if read_only:
+            self.subscribe()
 
         self.doc = []
         self.doc_version = 0
+        self.resync_base = None # the doc as it was when we hashed it for a resync
+        # the doc and the server count code points, tk counts emoji as two columns
+        self.columns = ColumnMap(TK_ASTRAL_WIDTH)
 
         self.cursor_pos = "1.0"
+        self.find_results = {}
+        self.history_result = {} # the last HISTORY reply: a past doc, a diff or an error
+        # extra carets as [doc line, idx], next to the insert cursor the server tracks for us
+        self.carets = []
+        # [[start, end, kind], ...] for every doc line, kept up to date by the server's tokenizer
+        self.highlight = highlight
+        self.tokens = []
+
+        # with a viewport only lines first_line .. first_line+len(doc)-1 are held locally
+        self.viewport = None
+        self.first_line = 1
+        self.line_count = 0
 
         self.lock = threading.Lock()
 
+        if viewport:
+            self.set_viewport(1, viewport)
+
+        # with a CRDT replica edits apply locally first and reach the server as ops,
+        # which wait in crdt_outbox whenever the connection is down
+        self.crdt = None
+        self.crdt_outbox = []
+        self.crdt_epoch = 0 # the server's delete epoch as of the last CRDT frame we applied
+        if crdt:
+            self.crdt = CRDTDocument(site=self.id)
+            self.crdt_sync()
+
+        if highlight:
+            self.request_tokens()
+
+    def request_tokens(self):
+        self.send({"opcode": "HIGHLIGHT", "on": True, "id": self.id})
+
+    def send(self, op):
+        # never blocks, the sender thread writes it out
+        self.outgoing.put(op)
+
+    def write(self, *ops):
+        # straight to the socket, for the handshake and the sender thread
+        self.client_socket.sendall("".join(json.dumps(op) + DELIMITER for op in ops).encode())
+
+    def sender(self):
+        # everything queued within SEND_COALESCE of the first op goes out as one write; Nagle is
+        # off on the socket, so coalescing happens here where we know an op is complete
+        stopping = False
+        while not stopping:
+            batch = [self.outgoing.get()]
+            deadline = time.monotonic() + SEND_COALESCE
+            while True:
+                try:
+                    batch.append(self.outgoing.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if None in batch:
+                # close() was called, flush what came before it
+                stopping = True
+                batch = batch[:batch.index(None)]
+            if not batch:
+                continue
+            try:
+                with self.send_lock:
+                    self.write(*batch)
+            except OSError:
+                self.send_failed(batch)
+
+    def send_failed(self, batch):
+        # edits to the old connection are lost except CRDT ops, crdt_sync() resends those
+        with self.lock:
+            for op in batch:
+                if op["opcode"] in ("CRDT", "CRDT_SYNC"):
+                    self.crdt_outbox = op["ops"] + self.crdt_outbox
+
+    def connect(self, address):
+        # Create a TCP socket
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # keystrokes are tiny and latency bound, don't let the kernel hold them back
+        self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.client_socket.connect(address)
+        self.address = address
+        # the greeting may share the read with the start of a frame, receive_file picks that up
+        self.id, self.unread = read_greeting(self.client_socket)
+        if self.key is not None:
+            self.write({"opcode": "AUTH", "key": self.key, "id": self.id})
+
+    def subscribe(self):
+        self.send({"opcode": "SUBSCRIBE", "role": "viewer", "id": self.id})
+
+    def reconnect(self):
+        # the sender waits until the new connection has been handshaked
+        with self.send_lock:
+            return self.handshake()
+
+    def handshake(self):
+        # retry with capped exponential backoff, then pick the session back up where we left it
+        prev_id = self.id
+        delay = RECONNECT_DELAY
+        start = self.addresses.index(self.address)
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if self.closed:
+                return False
+            try:
+                self.connect(self.addresses[(start + attempt) % len(self.addresses)])
+                break
+            except OSError:
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        else:
+            return False
+        if self.read_only:
+            # viewers have no session, the next frame they get is the whole doc anyway
+            self.write({"opcode": "SUBSCRIBE", "role": "viewer", "id": self.id})
+        else:
+            # the server answers with the edits we missed, or a full frame if we're too far behind
+            # (-1 if no frame ever arrived, our empty doc isn't version 0 of anything)
+            ver = self.doc_version if self.doc else -1
+            # with a whole block or more of doc, ask to resync by hashes rather than get a snapshot
+            resync = self.crdt is None and self.viewport is None and len(self.doc) >= BLOCK_LINES
+            self.write({"opcode": "RESUME", "prev_id": prev_id, "token": self.token, "ver": ver, "resync": resync, "id": self.id})
+        return True
+
+    def resumed(self, payload):
+        with self.lock:
+            self.id = payload["id"]
+            # replay what happened while we were gone, a snapshot frame follows otherwise. A full
+            # frame can beat the reply to the new connection, then there's nothing left to replay
+            if payload["mode"] == "delta" and self.crdt is None and self.doc_version == payload["from"]:
+                for ver, edits in payload["edits"]:
+                    for edit in edits:
+                        apply_to_lines(self.doc, edit)
+                self.doc_version = payload["to"]
+                self.cursor_pos = payload["cursor"]
+                self.first_line, self.line_count = 1, len(self.doc)
+        if payload["mode"] == "resync":
+            self.resync()
+        if self.viewport is not None:
+            self.set_viewport(*self.viewport)
+        if self.crdt is not None:
+            self.crdt_sync()
+        if self.highlight:
+            self.request_tokens()
+
+    def resync(self):
+        # send hashes of our doc, the server answers with the lines that differ
+        with self.lock:
+            self.resync_base = list(self.doc)
+        blocks = block_hashes(self.resync_base)
+        self.send({"opcode": "RESYNC", "blocks": blocks, "root": root_hash(blocks, self.resync_base), "id": self.id})
+
+    def resynced(self, payload):
+        with self.lock:
+            if "ops" in payload:
+                self.doc = rebuild(self.resync_base, payload["ops"])
+            elif self.resync_base is not None:
+                self.doc = self.resync_base
+            self.resync_base = None
+            self.doc_version = payload["ver"]
+            self.cursor_pos = payload["cursor"]
+            self.first_line, self.line_count = 1, len(self.doc)
+
+    def query_history(self, **query):
+        # ver=V for the doc at version V, or start=V1, end=V2 for a diff between them
+        op = {"opcode": "HISTORY", "id": self.id}
+        if "ver" in query:
+            op["ver"] = query["ver"]
+        else:
+            op["from"], op["to"] = query["start"], query["end"]
+        self.send(op)
+
+    def close(self):
+        self.closed = True
+        # let the sender flush what's queued before the socket goes
+        self.outgoing.put(None)
+        self.sender_thread.join(timeout=1)
+        self.client_socket.close()
+
+    def crdt_sync(self):
+        # send our version vector plus anything made offline, the server answers with what we lack.
+        # The epoch starts over, this may be a different server than the one that counted it
+        with self.lock:
+            self.crdt_epoch = 0
+            self.send({"opcode": "CRDT_SYNC", "vector": self.crdt.version(), "epoch": 0, "ops": self.crdt_outbox, "id": self.id})
+            self.crdt_outbox = []
+
+    def crdt_edit(self, line, idx, keysym):
+        # apply a keystroke to the local replica and ship the resulting ops
+        with self.lock:
+            pos = line_offset(self.doc, line, idx)
+            if keysym.lower() == "backspace":
+                width = idx - cluster_start(self.doc[line - 1], idx) if idx > 0 else 1
+                ops = self.crdt.delete(pos - width, width) if pos > 0 else []
+            elif keysym.lower() == "return":
+                ops = self.crdt.insert(pos, "\n")
+            elif keysym.lower() == "space":
+                ops = self.crdt.insert(pos, " ")
+            else:
+                ops = self.crdt.insert(pos, keysym)
+            self.doc = text_to_lines(self.crdt.text())
+            self.crdt_outbox += ops
+            if ops:
+                # offline the sender puts them back in the outbox for crdt_sync() to send once we're back
+                self.send({"opcode": "CRDT", "ops": self.crdt_outbox, "vector": self.crdt.version(),
+                           "epoch": self.crdt_epoch, "id": self.id})
+                self.crdt_outbox = []
+
+    def set_viewport(self, first, count):
+        # ask the server for a different slice of the doc, e.g. while scrolling
+        first = max(1, first)
+        self.viewport = (first, count)
+        self.send({"opcode": "VIEWPORT", "first": first, "count": count, "id": self.id})
+
+    def scroll(self, lines):
+        if self.viewport is not None:
+            first, count = self.viewport
+            last_first = max(1, self.line_count - count + 1)
+            self.set_viewport(min(first + lines, last_first), count)
+
+    def to_doc_line(self, line):
+        # tk line numbers count from the top of the viewport
+        return line + self.first_line - 1
+
+    def tk_index(self, line, idx):
+        # "line.column" in tk's terms for a code point offset into one of our lines
+        text = self.doc[line - 1] if 1 <= line <= len(self.doc) else ""
+        return f"{line}.{self.columns.to_column(text, idx)}"
+
+    def doc_index(self, line, column):
+        # the code point offset a tk column on one of our lines stands for
+        text = self.doc[line - 1] if 1 <= line <= len(self.doc) else ""
+        return self.columns.to_index(text, column)
+
     def receive_file(self):
-        # Receive response in chunks and concatenate
+        # Receive response in chunks and concatenate until a whole frame is in
+        buffer = b""
         while True:
-            chunk = self.client_socket.recv(4096)
-            if  chunk:
+            if self.unread is not None:
+                # a new connection, starting with whatever came in behind its greeting. A half
+                # received frame died with the old one
+                buffer, self.unread = self.unread, None
+                chunk = b""
+            else:
+                try:
+                    chunk = self.client_socket.recv(4096)
+                except OSError:
+                    chunk = b""
+                if not chunk:
+                    if self.closed or not self.reconnect():
+                        break
+                    continue
+            buffer += chunk
+            *frames, buffer = buffer.split(FRAME_END.encode())
+            for frame in frames:
+                frame = frame.decode("utf-8")
+                if frame.startswith("SESSION: "):
+                    payload = json.loads(frame[len("SESSION: "):])
+                    self.token, self.role = payload["token"], payload["role"]
+                    continue
+                if frame.startswith("AUTH: "):
+                    # the server turned our key down and hung up, retrying won't help
+                    print(f"Server refused the connection: {json.loads(frame[len('AUTH: '):])['error']}")
+                    self.closed = True
+                    continue
+                if frame.startswith("RESUME: "):
+                    self.resumed(json.loads(frame[len("RESUME: "):]))
+                    continue
+                if frame.startswith("RESYNC: "):
+                    self.resynced(json.loads(frame[len("RESYNC: "):]))
+                    continue
+                if frame.startswith("HISTORY: "):
+                    with self.lock:
+                        self.history_result = json.loads(frame[len("HISTORY: "):])
+                    continue
+                if frame.startswith("FIND: "):
+                    # search results come back as their own frame
+                    with self.lock:
+                        self.find_results = json.loads(frame[len("FIND: "):])
+                    continue
+                if frame.startswith("CARETS: "):
+                    # where a multi-caret edit left our carets, the first one is our cursor
+                    with self.lock:
+                        self.carets = json.loads(frame[len("CARETS: "):])["carets"][1:]
+                    continue
+                if frame.startswith("TOKENS: "):
+                    self.update_tokens(json.loads(frame[len("TOKENS: "):]))
+                    continue
+                if frame.startswith("ERROR: "):
+                    # the server couldn't make sense of an op we sent and dropped it
+                    print(f"Server rejected an op: {json.loads(frame[len('ERROR: '):])['error']}")
+                    continue
+                if frame.startswith("CRDT: "):
+                    payload = json.loads(frame[len("CRDT: "):])
+                    if self.crdt is not None and "ops" in payload:
+                        with self.lock:
+                            self.crdt.apply(payload["ops"])
+                            self.crdt_epoch = payload.get("epoch", self.crdt_epoch)
+                            self.doc = text_to_lines(self.crdt.text())
+                    continue
                 # Decode and update current document version
-                data = chunk.decode("utf-8", errors="ignore").split(DELIMITER)
+                data = frame.split(DELIMITER)
                 with self.lock:
                     self.doc_version = int(data[0].strip("VERSION: "))
+                    if self.crdt is not None:
+                        # the replica is the source of truth, the cursor is ours too
+                        continue
                     self.cursor_pos = data[1].strip("CURSOR: ")
-                    self.doc = data[2:]
-                chunk = None
+                    if self.viewport is not None and data[2].startswith("LINES: "):
+                        # the edit happened outside our viewport, only the length changed
+                        self.line_count = int(data[2][len("LINES: "):])
+                    elif self.viewport is not None and data[2].startswith("RANGE: "):
+                        first, total = data[2][len("RANGE: "):].split()
+                        self.first_line, self.line_count = int(first), int(total)
+                        self.doc = data[3:]
+                    else:
+                        self.doc = data[2:]
+                        self.first_line, self.line_count = 1, len(self.doc)
+
+    def update_tokens(self, payload):
+        with self.lock:
+            if payload["full"]:
+                self.tokens = payload["lines"]
+                return
+            # shift lines the way the doc did, then take the re-lexed ones
+            for kind, line in payload["structure"]:
+                if kind == SPLIT:
+                    self.tokens.insert(line, [])
+                elif line - 1 < len(self.tokens):
+                    self.tokens.pop(line - 1)
+            for line, spans in payload["lines"]:
+                if line - 1 < len(self.tokens):
+                    self.tokens[line - 1] = spans
+
+    def highlight_visible(self):
+        # tag only the lines on screen, so redraws cost the window and not the doc
+        top = int(self.text_widget.index("@0,0").split(".")[0])
+        bottom = int(self.text_widget.index(f"@0,{self.text_widget.winfo_height()}").split(".")[0])
+        for line in range(top, bottom + 1):
+            doc_line = line + self.first_line - 1
+            if 1 <= doc_line <= len(self.tokens):
+                for start, end, kind in self.tokens[doc_line - 1]:
+                    self.text_widget.tag_add(kind, self.tk_index(line, start), self.tk_index(line, end))
 
     def display_file(self):
         # clear the tkinter window, show contents of the doc
         with self.lock:
+            if self.crdt is not None:
+                # local edits move tk's own cursor, keep it across the redraw
+                line, column = self.text_widget.index(tk.INSERT).split(".")
+                self.cursor_pos = f"{self.to_doc_line(int(line))}.{self.doc_index(int(line), int(column))}"
             self.text_widget.delete("1.0", tk.END)
             self.text_widget.insert("1.0", "".join(self.doc))
+            for line, start, end in self.find_results.get("matches", []):
+                line -= self.first_line - 1
+                if 1 <= line <= len(self.doc):
+                    self.text_widget.tag_add("match", self.tk_index(line, start), self.tk_index(line, end))
+            if self.tokens:
+                self.highlight_visible()
+            for line, idx in self.carets:
+                line -= self.first_line - 1
+                if 1 <= line <= len(self.doc):
+                    self.text_widget.tag_add("caret", self.tk_index(line, idx))
             self.set_cursor()
         self.text_widget.after(100, self.display_file)
 
     def set_cursor(self):
-        self.text_widget.mark_set(tk.INSERT, self.cursor_pos)
+        line, idx = self.cursor_pos.split(".")
+        if self.viewport is not None:
+            first, count = self.viewport
+            if not first <= int(line) < first + count:
+                # the cursor moved out of view, fetch the lines around it
+                self.set_viewport(int(line) - count // 2, count)
+        self.text_widget.mark_set(tk.INSERT, self.tk_index(int(line) - self.first_line + 1, int(idx)))
 
     def write_file(self, filename="client_file.txt"):
         with open(filename, 'w') as f:
@@ -79,11 +449,32 @@ class GUI(object):
         # adding text editing space
         self.text_widget = tk.Text(self.window)
         self.text_widget.pack(expand=True, fill="both")
+        self.text_widget.tag_configure("match", background="yellow")
+        self.text_widget.tag_configure("caret", background="gray")
+        for kind, color in (("keyword", "blue"), ("string", "dark green"), ("comment", "gray50"), ("number", "purple")):
+            self.text_widget.tag_configure(kind, foreground=color)
 
         self.client.text_widget = self.text_widget
 
         # bind key press to event handler
         self.text_widget.bind("<Key>", self.key_handler)
+        # undo/redo are resolved on the server so they account for everyone's edits
+        self.text_widget.bind("<Control-z>", lambda event: self.history_handler("UNDO"))
+        self.text_widget.bind("<Control-y>", lambda event: self.history_handler("REDO"))
+        self.text_widget.bind("<Control-Z>", lambda event: self.history_handler("REDO"))
+        # ctrl+click adds a caret, escape drops them; tab indents a selection
+        self.text_widget.bind("<Control-Button-1>", self.add_caret)
+        self.text_widget.bind("<Escape>", self.clear_carets)
+        self.text_widget.bind("<Tab>", lambda event: self.indent_handler(event, "Indent"))
+        self.text_widget.bind("<ISO_Left_Tab>", lambda event: self.indent_handler(event, "Dedent"))
+        self.text_widget.bind("<Control-f>", self.find_handler)
+        self.text_widget.bind("<Control-h>", self.replace_handler)
+        # in viewport mode scrolling fetches new lines instead of moving over local text
+        self.text_widget.bind("<MouseWheel>", lambda event: self.scroll_handler(-3 if event.delta > 0 else 3))
+        self.text_widget.bind("<Button-4>", lambda event: self.scroll_handler(-3))
+        self.text_widget.bind("<Button-5>", lambda event: self.scroll_handler(3))
+        self.text_widget.bind("<Prior>", lambda event: self.scroll_handler(-self.page_size()))
+        self.text_widget.bind("<Next>", lambda event: self.scroll_handler(self.page_size()))
 
         self.client.display_file()
 
@@ -92,23 +483,97 @@ class GUI(object):
 
     def get_text_widget(self):
         return self.text_widget
+
+    def page_size(self):
+        return self.client.viewport[1] // 2 if self.client.viewport else 0
+
+    def scroll_handler(self, lines):
+        if self.client.viewport is None:
+            return
+        self.client.scroll(lines)
+        return "break"
+
+    def cursor_index(self):
+        # current insert cursor as (doc line, idx) strings
+        line, idx = self.doc_position(tk.INSERT)
+        return str(line), str(idx)
     
+    def doc_position(self, index):
+        # a tk index as (doc line, code point offset), the units the server works in
+        line, column = self.text_widget.index(index).split('.')
+        return self.client.to_doc_line(int(line)), self.client.doc_index(int(line), int(column))
+
+    def add_caret(self, event):
+        if self.client.read_only or self.client.crdt is not None:
+            return "break"
+        with self.client.lock:
+            self.client.carets.append(list(self.doc_position(f"@{event.x},{event.y}")))
+        return "break"
+
+    def clear_carets(self, event):
+        with self.client.lock:
+            self.client.carets = []
+
+    def edit_ranges(self):
+        # the selection or the insert cursor, plus any extra carets; None for a plain single caret
+        selection = self.text_widget.tag_ranges(tk.SEL)
+        if not selection and not self.client.carets:
+            return None
+        if selection:
+            ranges = [[*self.doc_position(tk.SEL_FIRST), *self.doc_position(tk.SEL_LAST)]]
+        else:
+            ranges = [[*self.doc_position(tk.INSERT)] * 2]
+        with self.client.lock:
+            return ranges + [[line, idx, line, idx] for line, idx in self.client.carets]
+
+    def send_multi(self, ranges, key):
+        op = {"opcode": "MULTI", "ranges": ranges, "char": key, "ver": self.client.doc_version, "id": self.client.id}
+        self.client.send(op)
+
+    def indent_handler(self, event, key):
+        if self.client.read_only or self.client.crdt is not None:
+            return self.key_handler(event)
+        ranges = self.edit_ranges()
+        if ranges is None:
+            # no selection: a tab is just a key
+            return self.key_handler(event) if key == "Indent" else "break"
+        self.send_multi(ranges, key)
+        return "break"
+
     def key_handler(self, event):
+        if self.client.read_only:
+            # viewers can move around but never change the text
+            if event.keysym.lower() in ['left', 'right', 'up', 'down', 'prior', 'next', 'home', 'end']:
+                return
+            return "break"
         # get current index of the insert cursor in the window
-        line, idx = self.text_widget.index(tk.INSERT).split('.')
+        line, idx = self.cursor_index()
+        if self.client.crdt is not None:
+            # edits apply to the local replica right away, arrows just move tk's cursor
+            if event.char and len(event.char) == 1 or event.keysym.lower() in ["backspace", "space", "return"]:
+                printable = event.char and len(event.char) == 1 and event.char.isprintable()
+                self.client.crdt_edit(int(line), int(idx), event.char if printable else event.keysym)
+            return
         if event.char and len(event.char) == 1 or event.keysym.lower() in ["backspace", "space", "delete", "return"]:
+            # the typed character itself, keysyms like "eacute" or "exclam" are only names for it
+            printable = event.char and len(event.char) == 1 and event.char.isprintable()
+            key = event.char if printable else event.keysym
+            ranges = self.edit_ranges()
+            if ranges is not None:
+                # one op for every caret and the selection, the server answers with one version
+                self.send_multi(ranges, key)
+                return "break"
             # construct operation packet
             op = {
                 "opcode": "MODIFY",
                 "line": line,
                 "idx": idx,
-                "char": event.keysym,
+                "char": key,
                 "ver": self.client.doc_version,
                 "id": self.client.id
             }
-            # send operation through the socket
-            json_str = json.dumps(op) + DELIMITER # adding terminating character
-            self.client.client_socket.sendall(json_str.encode())
+            # queue the operation, the sender thread batches it onto the socket
+            self.client.send(op)
         elif event.keysym.lower() in ['left', 'right', 'up', 'down']: 
             # handle cursor movement on server
             op = {
@@ -119,15 +584,58 @@ class GUI(object):
                 "ver": self.client.doc_version,
                 "id": self.client.id
             }
-            # send operation through the socket
-            json_str = json.dumps(op) + DELIMITER # adding terminating character
-            self.client.client_socket.sendall(json_str.encode())
+            # queue the operation, the sender thread batches it onto the socket
+            self.client.send(op)
+
+    def history_handler(self, opcode):
+        if self.client.read_only:
+            return "break"
+        line, idx = self.cursor_index()
+        op = {
+            "opcode": opcode,
+            "line": line,
+            "idx": idx,
+            "char": "",
+            "ver": self.client.doc_version,
+            "id": self.client.id
+        }
+        self.client.send(op)
+        # stop tk from applying its own local undo
+        return "break"
+
+    def find_handler(self, event):
+        pattern = simpledialog.askstring("Find", "Find:", parent=self.window)
+        if pattern:
+            self.send_search({"opcode": "FIND", "pattern": pattern})
+        return "break"
+
+    def replace_handler(self, event):
+        if self.client.read_only:
+            return "break"
+        pattern = simpledialog.askstring("Replace", "Find:", parent=self.window)
+        if not pattern:
+            return "break"
+        replacement = simpledialog.askstring("Replace", f"Replace '{pattern}' with:", parent=self.window)
+        if replacement is not None:
+            self.send_search({"opcode": "REPLACE_ALL", "pattern": pattern, "replacement": replacement})
+        return "break"
+
+    def send_search(self, op):
+        # searches run on the server against the whole document
+        op.update({"regex": False, "case": True, "ver": self.client.doc_version, "id": self.client.id})
+        self.client.send(op)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("host", help="Server IP address")
     parser.add_argument("port", help="Server listener port")
+    parser.add_argument("--view", action="store_true", help="Join as a read-only viewer (works against a relay too)")
+    parser.add_argument("--crdt", action="store_true", help="Keep a local CRDT replica (needs a server started with --engine crdt)")
+    parser.add_argument("--viewport", type=int, default=0, help="Only keep this many lines around the cursor (0 syncs the whole doc)")
+    parser.add_argument("--highlight", action="store_true", help="Syntax highlight with tokens kept up to date by the server")
+    parser.add_argument("--fallback", metavar="HOST:PORT", action="append", default=[], help="Standby server to reconnect to if the server goes away (repeatable)")
+    parser.add_argument("--key", help="Key to authenticate with, for servers started with --auth")
 
     args = parser.parse_args()
 
@@ -135,7 +643,9 @@ def main():
     HOST = args.host
     PORT = int(args.port)
 
-    client = Client(HOST, PORT)
+    fallbacks = [(host, int(port)) for host, port in (address.rsplit(":", 1) for address in args.fallback)]
+    client = Client(HOST, PORT, read_only=args.view, viewport=args.viewport, crdt=args.crdt, fallbacks=fallbacks, highlight=args.highlight,
+                    key=args.key)
     screen = GUI(client)
 
     # start listener thread for server responses and gui thread
@@ -146,7 +656,7 @@ def main():
     except KeyboardInterrupt:
         print("\nShutting down client...")
     finally:
-        client.client_socket.close()
+        client.close()
         print("Done.")
 
     
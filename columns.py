@@ -0,0 +1,105 @@
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+ASTRAL = "\U00010000" # characters from here on are outside the BMP, tk before 9 counts them twice
+ZWJ = "\u200d"
+MAX_CACHED_LINES = 4096
+
+
+def extends(char):
+    # joins the grapheme cluster before it: combining marks, ZWJ, variation selectors,
+    # emoji skin tone modifiers and tag characters
+    if char == ZWJ or "\ufe00" <= char <= "\ufe0f" or "\U0001f3fb" <= char <= "\U0001f3ff" or "\U000e0020" <= char <= "\U000e01ef":
+        return True
+    return unicodedata.category(char) in ("Mn", "Me", "Mc")
+
+
+def regional(char):
+    return "\U0001f1e6" <= char <= "\U0001f1ff"
+
+
+def is_boundary(text, i):
+    # whether a grapheme cluster can end between text[i - 1] and text[i] (a simplified UAX #29)
+    if i <= 0 or i >= len(text):
+        return True
+    char, prev = text[i], text[i - 1]
+    if extends(char) or prev == ZWJ:
+        return False
+    if regional(char) and regional(prev):
+        # flags are pairs of regional indicators, a boundary falls after every second one
+        run = 0
+        while i - run > 0 and regional(text[i - run - 1]):
+            run += 1
+        return run % 2 == 0
+    return True
+
+
+def cluster_start(text, idx):
+    # where the cluster ending at idx starts, i.e. what one backspace takes back to
+    idx = min(idx, len(text))
+    if idx <= 0:
+        return 0
+    if text.isascii():
+        return idx - 1
+    i = idx - 1
+    while not is_boundary(text, i):
+        i -= 1
+    return i
+
+
+def cluster_end(text, idx):
+    # where the cluster starting at idx ends, i.e. what one right arrow skips to
+    if idx >= len(text):
+        return len(text)
+    if text.isascii():
+        return idx + 1
+    i = idx + 1
+    while not is_boundary(text, i):
+        i += 1
+    return i
+
+
+class ColumnMap(object):
+    # converts between code point offsets in a line (what the server and the doc use) and tk
+    # text columns. Only lines with characters outside the BMP differ; ASCII lines are spotted
+    # in O(1) by str.isascii, the rest get their tables built once per distinct line and looked
+    # up by content, so a line isn't scanned again until it changes
+    def __init__(self, astral_width=2, max_lines=MAX_CACHED_LINES):
+        self.astral_width = astral_width
+        self.max_lines = max_lines
+        self.tables = OrderedDict() # line text -> (columns by code point, code points by column), None if identical
+
+    def table(self, text):
+        if self.astral_width == 1 or text.isascii():
+            return None
+        if text in self.tables:
+            self.tables.move_to_end(text)
+            return self.tables[text]
+        table = None
+        if max(text) >= ASTRAL:
+            columns, indexes = array("l", [0]), array("l", [0])
+            for i, char in enumerate(text):
+                width = self.astral_width if char >= ASTRAL else 1
+                columns.append(columns[-1] + width)
+                # a column inside a surrogate pair means the character it's part of
+                indexes.extend([i] * (width - 1) + [i + 1])
+            table = (columns, indexes)
+        self.tables[text] = table
+        if len(self.tables) > self.max_lines:
+            self.tables.popitem(last=False)
+        return table
+
+    def to_column(self, text, idx):
+        table = self.table(text)
+        if table is None:
+            return idx
+        columns = table[0]
+        return columns[min(idx, len(columns) - 1)] + max(0, idx - len(columns) + 1)
+
+    def to_index(self, text, column):
+        table = self.table(text)
+        if table is None:
+            return column
+        indexes = table[1]
+        return indexes[min(column, len(indexes) - 1)] + max(0, column - len(indexes) + 1)
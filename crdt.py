@@ -0,0 +1,387 @@
+from bisect import bisect_right
+from history import INSERT, DELETE, SPLIT, JOIN
+
+# RGA-style sequence CRDT. Characters are identified by (site, seq); consecutive characters typed
+# by one site live in a single Item run, so a paragraph of typing costs one Item instead of one per
+# character. Deleted runs drop their text and keep only ids and length (tombstones). gc() drops the
+# tombstones every known peer has seen deleted and that nothing is inserted after, and merges
+# neighbouring runs back together.
+#
+# Version vectors only count inserts, so deletes are counted by an epoch: every replica numbers
+# the deletes it integrates, and a peer acknowledges (vector, epoch) once it has applied what this
+# replica sent up to then (see acknowledge()).
+#
+# ops are plain JSON-able dicts:
+#   {"t": "i", "id": [site, seq], "ts": lamport, "o": [site, seq] or None, "s": text}
+#       insert a run after origin "o"; "s" is None and "n" the length for an already deleted run
+#   {"t": "d", "id": [site, seq, length]}
+#       delete a run of ids (idempotent)
+#   {"t": "g", "id": [site, seq, length]}
+#       a run of ids gc() has dropped, sent to a peer catching up so its vector moves past them
+
+ITEM_BYTES = 120 # rough size of one Item with its slots, used by stats()
+
+
+class Item(object):
+    __slots__ = ("site", "seq", "ts", "origin", "text", "length", "deleted")
+
+    def __init__(self, site, seq, ts, origin, text, length, deleted=None):
+        self.site = site
+        self.seq = seq       # seq of the first character; the rest follow contiguously
+        self.ts = ts         # lamport timestamp of the first character, same contiguity
+        self.origin = origin # id of the character this run was inserted after, None for the start
+        self.text = text     # None once the run is deleted
+        self.length = length
+        self.deleted = deleted # the epoch this replica deleted it in
+
+    def last_id(self):
+        return (self.site, self.seq + self.length - 1)
+
+
+class CRDTDocument(object):
+    def __init__(self, site):
+        self.site = site
+        self.items = []       # document order, tombstones included
+        self.site_seqs = {}   # site -> sorted first seqs of that site's items
+        self.site_items = {}  # site -> items in the same order as site_seqs
+        self.vector = {}      # site -> highest seq integrated (always contiguous from 1)
+        self.lamport = 0
+        self.epoch = 0        # deletes integrated so far
+        self.peers = {}       # site -> (vector, epoch) that peer has acknowledged
+        self.pending = []     # remote ops waiting for something they depend on
+
+    def text(self):
+        return "".join(item.text for item in self.items if item.text is not None)
+
+    def version(self):
+        return dict(self.vector)
+
+    def acknowledge(self, site, vector, epoch):
+        # peer `site` has every insert in `vector` and every delete this replica had integrated
+        # by `epoch`. Peers are kept once known, an offline one holds back gc() until it's back
+        self.peers[site] = (dict(vector), epoch)
+
+    def stats(self):
+        chars = sum(item.length for item in self.items if item.text is not None)
+        tombstones = sum(1 for item in self.items if item.text is None)
+        return {"items": len(self.items), "tombstones": tombstones, "chars": chars,
+                "bytes_per_char": round(len(self.items) * ITEM_BYTES / max(chars, 1), 2)}
+
+    # local edits, returning the ops to send to other peers
+
+    def insert(self, pos, text):
+        if not text:
+            return []
+        origin = None
+        if pos > 0:
+            item, offset = self.visible_char(pos - 1)
+            origin = (item.site, item.seq + offset)
+        op = {"t": "i", "id": [self.site, self.vector.get(self.site, 0) + 1], "ts": self.lamport + 1,
+              "o": list(origin) if origin else None, "s": text}
+        self.apply_insert(op)
+        return [op]
+
+    def delete(self, pos, length):
+        # collect the id runs first, the splits done while deleting would shift positions
+        runs = []
+        for item, start, end in self.visible_range(pos, length):
+            runs.append([item.site, item.seq + start, end - start])
+        ops = [{"t": "d", "id": run} for run in runs]
+        for op in ops:
+            self.apply_delete(op)
+        return ops
+
+    # remote ops
+
+    def apply(self, ops):
+        # integrate ops in any order; returns the visible changes as ("i", pos, text) / ("d", pos, length)
+        changes = []
+        queue = list(ops) + self.pending
+        self.pending = []
+        progress = True
+        while queue and progress:
+            progress = False
+            waiting = []
+            for op in queue:
+                if op["t"] == "i":
+                    result = self.apply_insert(op)
+                elif op["t"] == "d":
+                    result = self.apply_delete(op)
+                else:
+                    result = self.apply_collected(op)
+                if result is None:
+                    waiting.append(op)
+                else:
+                    changes.extend(result)
+                    progress = True
+            queue = waiting
+        self.pending = queue
+        return changes
+
+    def apply_insert(self, op):
+        site, seq = op["id"]
+        ts = op["ts"]
+        origin = tuple(op["o"]) if op["o"] else None
+        text = op["s"]
+        length = len(text) if text is not None else op["n"]
+        known = self.vector.get(site, 0)
+        if seq + length - 1 <= known:
+            return [] # duplicate
+        if seq <= known:
+            # part of this run is already here (runs can be cut differently by different peers)
+            skip = known - seq + 1
+            origin = (site, known)
+            seq, ts, length = seq + skip, ts + skip, length - skip
+            text = text[skip:] if text is not None else None
+        elif seq != known + 1:
+            return None # an earlier run from this site hasn't arrived yet
+        if origin is not None and self.find(*origin) is None:
+            return None
+
+        item = Item(site, seq, ts, origin, text, length)
+        if text is None:
+            self.epoch += 1
+            item.deleted = self.epoch
+        idx = 0
+        if origin is not None:
+            o_item, offset = self.find(*origin)
+            if offset < o_item.length - 1:
+                self.split(o_item, offset + 1)
+            idx = self.items.index(o_item) + 1
+        # concurrent inserts at the same origin: higher timestamps stay closer to it, and so
+        # does everything inserted after them, which always has an even higher timestamp
+        while idx < len(self.items) and (self.items[idx].ts, self.items[idx].site) > (ts, site):
+            idx += 1
+        self.items.insert(idx, item)
+        self.site_seqs.setdefault(site, []).append(seq)
+        self.site_items.setdefault(site, []).append(item)
+        self.vector[site] = seq + length - 1
+        self.lamport = max(self.lamport, ts + length - 1)
+
+        changes = []
+        if text is not None:
+            changes.append(("i", self.position(idx), text))
+        self.merge_left(idx)
+        return changes
+
+    def apply_delete(self, op):
+        site, seq, length = op["id"]
+        if seq + length - 1 > self.vector.get(site, 0):
+            return None
+        changes = []
+        end = seq + length
+        while seq < end:
+            found = self.find(site, seq)
+            if found is None:
+                # collected by gc(), so already deleted; go on from the next run still here
+                seqs = self.site_seqs.get(site, [])
+                i = bisect_right(seqs, seq)
+                seq = seqs[i] if i < len(seqs) else end
+                continue
+            item, offset = found
+            if offset > 0:
+                item = self.split(item, offset)
+            if item.length > end - seq:
+                self.split(item, end - seq)
+            if item.text is not None:
+                changes.append(("d", self.position(self.items.index(item)), item.length))
+                item.text = None
+                item.deleted = self.epoch + 1
+            seq += item.length
+        if changes:
+            self.epoch += 1
+        return changes
+
+    def apply_collected(self, op):
+        site, seq, length = op["id"]
+        known = self.vector.get(site, 0)
+        if seq > known + 1:
+            return None
+        self.vector[site] = max(known, seq + length - 1)
+        return []
+
+    def ops_since(self, vector):
+        # everything a peer at `vector` is missing, in timestamp order so origins come first
+        ops = []
+        for item in sorted(self.items, key=lambda item: item.ts):
+            known = vector.get(item.site, 0) - item.seq + 1
+            if known < item.length:
+                # the peer lacks (part of) this run
+                skip = max(known, 0)
+                origin = (item.site, item.seq + skip - 1) if skip else item.origin
+                op = {"t": "i", "id": [item.site, item.seq + skip], "ts": item.ts + skip,
+                      "o": list(origin) if origin else None, "s": None}
+                if item.text is not None:
+                    op["s"] = item.text[skip:]
+                else:
+                    op["n"] = item.length - skip
+                ops.append(op)
+            if item.text is None and known > 0:
+                # it has the run but may not know it was deleted; deletes are idempotent
+                ops.append({"t": "d", "id": [item.site, item.seq, min(known, item.length)]})
+        for site, last in self.vector.items():
+            # the ids gc() dropped that the peer hasn't got past yet
+            seq = vector.get(site, 0) + 1
+            for item in self.site_items.get(site, []):
+                if item.seq + item.length <= seq:
+                    continue
+                if item.seq > seq:
+                    ops.append({"t": "g", "id": [site, seq, item.seq - seq]})
+                seq = item.seq + item.length
+            if seq <= last:
+                ops.append({"t": "g", "id": [site, seq, last - seq + 1]})
+        return ops
+
+    def gc(self):
+        # drop the tombstones that are safe to forget, then merge neighbouring runs that continue
+        # each other, which mostly folds the remaining tombstones together
+        stable, epoch = self.stable()
+        origins = {}
+        for origin in [item.origin for item in self.items] + [op["o"] for op in self.pending if op["t"] == "i"]:
+            if origin is not None:
+                origins.setdefault(origin[0], []).append(origin[1])
+        for seqs in origins.values():
+            seqs.sort()
+        kept = []
+        for item in self.items:
+            if (item.text is None and item.deleted <= epoch and item.seq + item.length - 1 <= stable.get(item.site, 0)
+                    and not self.referenced(item, origins.get(item.site, []))):
+                self.drop(item)
+            else:
+                kept.append(item)
+        self.items = kept
+        idx = len(self.items) - 1
+        while idx > 0:
+            self.merge_left(idx)
+            idx -= 1
+
+    def stable(self):
+        # the version vector and epoch every known peer has acknowledged; with no peers that is
+        # all of this replica, a peer joining later gets the doc without the dropped runs
+        vector, epoch = dict(self.vector), self.epoch
+        for peer_vector, peer_epoch in self.peers.values():
+            vector = {site: min(seq, peer_vector.get(site, 0)) for site, seq in vector.items()}
+            epoch = min(epoch, peer_epoch)
+        return vector, epoch
+
+    # internals
+
+    def find(self, site, seq):
+        seqs = self.site_seqs.get(site)
+        if not seqs:
+            return None
+        i = bisect_right(seqs, seq) - 1
+        if i < 0:
+            return None
+        item = self.site_items[site][i]
+        if seq >= item.seq + item.length:
+            return None
+        return item, seq - item.seq
+
+    def referenced(self, item, origins):
+        # whether a run is inserted after one of item's characters; origins is sorted
+        i = bisect_right(origins, item.seq - 1)
+        return i < len(origins) and origins[i] < item.seq + item.length
+
+    def drop(self, item):
+        # forget a tombstone run, gc() takes it out of items; its ids stay counted in the vector
+        i = bisect_right(self.site_seqs[item.site], item.seq) - 1
+        del self.site_seqs[item.site][i]
+        del self.site_items[item.site][i]
+
+    def split(self, item, offset):
+        right = Item(item.site, item.seq + offset, item.ts + offset, (item.site, item.seq + offset - 1),
+                     item.text[offset:] if item.text is not None else None, item.length - offset, item.deleted)
+        if item.text is not None:
+            item.text = item.text[:offset]
+        item.length = offset
+        self.items.insert(self.items.index(item) + 1, right)
+        i = bisect_right(self.site_seqs[item.site], item.seq)
+        self.site_seqs[item.site].insert(i, right.seq)
+        self.site_items[item.site].insert(i, right)
+        return right
+
+    def merge_left(self, idx):
+        # fold items[idx] into its left neighbour when it simply continues that run
+        if idx <= 0 or idx >= len(self.items):
+            return
+        left, item = self.items[idx - 1], self.items[idx]
+        if (left.site != item.site or left.seq + left.length != item.seq or left.ts + left.length != item.ts
+                or item.origin != left.last_id() or (left.text is None) != (item.text is None)):
+            return
+        if left.text is not None:
+            left.text += item.text
+        else:
+            left.deleted = max(left.deleted, item.deleted)
+        left.length += item.length
+        del self.items[idx]
+        i = bisect_right(self.site_seqs[item.site], item.seq) - 1
+        del self.site_seqs[item.site][i]
+        del self.site_items[item.site][i]
+
+    def position(self, idx):
+        return sum(item.length for item in self.items[:idx] if item.text is not None)
+
+    def visible_char(self, pos):
+        for item in self.items:
+            if item.text is not None:
+                if pos < item.length:
+                    return item, pos
+                pos -= item.length
+        raise IndexError("position past the end of the document")
+
+    def visible_range(self, pos, length):
+        # (item, start, end) slices of the visible characters pos .. pos+length
+        slices = []
+        for item in self.items:
+            if length <= 0:
+                break
+            if item.text is None:
+                continue
+            if pos >= item.length:
+                pos -= item.length
+                continue
+            end = min(item.length, pos + length)
+            slices.append((item, pos, end))
+            length -= end - pos
+            pos = 0
+        return slices
+
+
+def text_to_lines(text):
+    # the server's line model: every line but the last ends in "\n"
+    lines = text.split("\n")
+    return [line + "\n" for line in lines[:-1]] + [lines[-1]]
+
+
+def line_offset(doc, line, idx):
+    return sum(len(l) for l in doc[:line - 1]) + idx
+
+
+def offset_to_line(doc, pos):
+    for i, text in enumerate(doc):
+        if pos < len(text) or i == len(doc) - 1:
+            return i + 1, pos
+        pos -= len(text)
+
+
+class CRDTBridge(object):
+    # edit listener mirroring the server's line edits into its CRDT replica, so peers running
+    # their own replica see keystrokes from plain clients as ops
+    def __init__(self, server):
+        self.server = server
+        self.outbox = []
+        self.muted = False # set while the server applies ops that came from the CRDT itself
+
+    def on_edit(self, kind, line, idx, n):
+        if self.muted:
+            return
+        doc, crdt = self.server.doc, self.server.crdt
+        if kind == INSERT:
+            self.outbox += crdt.insert(line_offset(doc, line, idx), doc[line - 1][idx:idx + n])
+        elif kind == DELETE:
+            self.outbox += crdt.delete(line_offset(doc, line, idx), n)
+        elif kind == SPLIT:
+            self.outbox += crdt.insert(line_offset(doc, line, idx), "\n")
+        elif kind == JOIN:
+            self.outbox += crdt.delete(line_offset(doc, line - 1, idx), 1)
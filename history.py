@@ -0,0 +1,326 @@
+from array import array
+from collections import deque
+import sys
+
+# primitive edit kinds shared by the server, the undo stacks and the edit log
+INSERT = 0  # insert text at (line, idx)
+DELETE = 1  # delete n chars at (line, idx)
+SPLIT = 2   # break line at (line, idx)
+JOIN = 3    # merge line into the previous one; idx is the previous line's length without "\n"
+
+# rough per-record cost of the array slots, the list pointer and the str header
+RECORD_OVERHEAD = 64
+
+DEFAULT_UNDO_BUDGET = 256 * 1024  # bytes per client
+DEFAULT_LOG_LIMIT = 20000         # edits kept for transforming old undo records
+DEFAULT_REPLAY_VERSIONS = 5000    # versions a reconnecting client can be caught up across
+
+
+def transform_point(line, idx, kind, oline, oidx, n, stick_left=False):
+    # move a (line, idx) position across an edit applied after it was recorded
+    if kind == INSERT:
+        if line == oline and (idx > oidx or (idx == oidx and not stick_left)):
+            idx += n
+    elif kind == DELETE:
+        if line == oline and idx > oidx:
+            idx = max(oidx, idx - n)
+    elif kind == SPLIT:
+        if line > oline:
+            line += 1
+        elif line == oline and (idx > oidx or (idx == oidx and not stick_left)):
+            line, idx = line + 1, idx - oidx
+    elif kind == JOIN:
+        if line == oline:
+            line, idx = oline - 1, oidx + idx
+        elif line > oline:
+            line -= 1
+    return line, idx
+
+
+def forward_edit(inverse):
+    # the (kind, line, idx, n) edit that an inverse record undoes
+    kind, line, idx, text = inverse
+    if kind == DELETE:
+        return INSERT, line, idx, len(text)
+    if kind == INSERT:
+        return DELETE, line, idx, len(text)
+    if kind == JOIN:
+        return SPLIT, line - 1, idx, 0
+    return JOIN, line + 1, idx, 0
+
+
+def replay_edit(inverse):
+    # like forward_edit, but keeping the inserted text so a client can replay it
+    kind, line, idx, text = inverse
+    if kind == DELETE:
+        return [INSERT, line, idx, text]
+    if kind == INSERT:
+        return [DELETE, line, idx, len(text)]
+    if kind == JOIN:
+        return [SPLIT, line - 1, idx, ""]
+    return [JOIN, line + 1, idx, 0]
+
+
+def apply_to_lines(doc, edit):
+    # apply a replayed edit to a plain list of lines, the same way the server's edit methods do
+    kind, line, idx, payload = edit
+    if kind == INSERT:
+        doc[line - 1] = doc[line - 1][:idx] + payload + doc[line - 1][idx:]
+    elif kind == DELETE:
+        doc[line - 1] = doc[line - 1][:idx] + doc[line - 1][idx + payload:]
+    elif kind == SPLIT:
+        doc.insert(line, doc[line - 1][idx:])
+        doc[line - 1] = doc[line - 1][:idx] + "\n"
+    elif kind == JOIN:
+        doc[line - 2] = doc[line - 2][:-1] + doc[line - 1]
+        doc.pop(line - 1)
+
+
+class EditStack(object):
+    # stack of edit records kept in parallel arrays; oldest entries are dropped by moving head
+    def __init__(self):
+        self.kinds = array("b")
+        self.lines = array("l")
+        self.idxs = array("l")
+        self.seqs = array("q")  # edit log position of the forward edit
+        self.firsts = array("q")  # log position of its first edit, earlier than seq once chars merge in
+        self.vers = array("q")  # doc version the edit belongs to, records sharing one undo together
+        self.texts = []
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return len(self.kinds) - self.head
+
+    def push(self, seq, ver, kind, line, idx, text):
+        self.kinds.append(kind)
+        self.lines.append(line)
+        self.idxs.append(idx)
+        self.seqs.append(seq)
+        self.firsts.append(seq)
+        self.vers.append(ver)
+        self.texts.append(text)
+        self.size += RECORD_OVERHEAD + len(text)
+
+    def pop(self):
+        kind, line, idx = self.kinds.pop(), self.lines.pop(), self.idxs.pop()
+        seq, first, ver, text = self.seqs.pop(), self.firsts.pop(), self.vers.pop(), self.texts.pop()
+        self.size -= RECORD_OVERHEAD + len(text)
+        return seq, ver, kind, line, idx, text, first
+
+    def evict(self):
+        self.size -= RECORD_OVERHEAD + len(self.texts[self.head])
+        self.texts[self.head] = ""
+        self.head += 1
+        # compact once the dead prefix dominates, keeping eviction amortised O(1)
+        if self.head > 64 and self.head * 2 > len(self.kinds):
+            for arr in (self.kinds, self.lines, self.idxs, self.seqs, self.firsts, self.vers, self.texts):
+                del arr[:self.head]
+            self.head = 0
+
+    def clear(self):
+        self.__init__()
+
+    def merge(self, seq, ver, kind, line, idx, text):
+        # fold a single char edit into the top record when it directly continues it
+        top = len(self.kinds) - 1
+        if top < self.head or self.seqs[top] != seq - 1 or self.kinds[top] != kind:
+            return False
+        if self.lines[top] != line or text == "\n" or self.texts[top].endswith("\n"):
+            return False
+        # the top record must be a single edit, not part of a grouped version
+        if top > self.head and self.vers[top - 1] == self.vers[top]:
+            return False
+        if kind == DELETE and self.idxs[top] + len(self.texts[top]) == idx:
+            # typing forward: undo deletes a longer run starting at the same place
+            self.texts[top] += text
+        elif kind == INSERT and idx + len(text) == self.idxs[top]:
+            # backspacing: undo reinserts a longer run starting further left
+            self.texts[top] = text + self.texts[top]
+            self.idxs[top] = idx
+        else:
+            return False
+        self.seqs[top] = seq
+        self.vers[top] = ver
+        self.size += len(text)
+        return True
+
+
+class EditLog(object):
+    # bounded log of applied edits used to transform undo records made before them
+    def __init__(self, limit=DEFAULT_LOG_LIMIT):
+        self.limit = limit
+        self.kinds = array("b")
+        self.lines = array("l")
+        self.idxs = array("l")
+        self.ns = array("l")
+        self.base = 0  # seq of the first retained entry
+        # entries that cancel out and are left out of transforms: an undone edit together with
+        # the edit that undid it. Rebasing over such a pair can't bring a point back where it
+        # was (a SPLIT and its JOIN push a caret at the split onto the next line). A redo is a
+        # fresh edit as far as the log goes, undoing it again makes another pair
+        self.skipped = set()
+
+    def next_seq(self):
+        return self.base + len(self.kinds)
+
+    def append(self, kind, line, idx, n):
+        self.kinds.append(kind)
+        self.lines.append(line)
+        self.idxs.append(idx)
+        self.ns.append(n)
+        if len(self.kinds) > self.limit * 2:
+            drop = len(self.kinds) - self.limit
+            for arr in (self.kinds, self.lines, self.idxs, self.ns):
+                del arr[:drop]
+            self.base += drop
+            self.skipped = {seq for seq in self.skipped if seq >= self.base}
+        return self.base + len(self.kinds) - 1
+
+    def cancel(self, first, last, by):
+        # entry `by` undid entries first..last
+        self.skipped.update(range(max(first, self.base), last + 1))
+        self.skipped.add(by)
+
+    def covers(self, seq):
+        # true if every edit after seq is still in the log
+        return seq + 1 >= self.base
+
+    def transform(self, seq, line, idx, stick_left=False):
+        skipped = self.skipped
+        for i in range(seq + 1 - self.base, len(self.kinds)):
+            if self.base + i in skipped:
+                continue
+            line, idx = transform_point(line, idx, self.kinds[i], self.lines[i], self.idxs[i], self.ns[i], stick_left)
+        return line, idx
+
+
+class UndoHistory(object):
+    def __init__(self, budget=DEFAULT_UNDO_BUDGET, log_limit=DEFAULT_LOG_LIMIT):
+        self.budget = budget
+        self.log = EditLog(log_limit)
+        self.undo_stacks = {}
+        self.redo_stacks = {}
+
+    def reset(self):
+        # the doc was replaced wholesale, no record refers to anything in the new one
+        self.log = EditLog(self.log.limit)
+        self.undo_stacks.clear()
+        self.redo_stacks.clear()
+
+    def forget(self, client_id):
+        self.undo_stacks.pop(client_id, None)
+        self.redo_stacks.pop(client_id, None)
+
+    def record(self, client_id, ver, inverse, source="edit"):
+        # log the forward edit and file its inverse on the right stack
+        kind, line, idx, text = inverse
+        seq = self.log.append(*forward_edit(inverse))
+
+        if client_id is None:
+            return
+        # source is "edit" for keystrokes, "batch" for multi-edit ops, or "undo"/"redo"
+        if source == "undo":
+            stack = self.redo_stacks.setdefault(client_id, EditStack())
+        else:
+            stack = self.undo_stacks.setdefault(client_id, EditStack())
+            if source in ("edit", "batch"):
+                # a fresh edit invalidates whatever could have been redone
+                redo = self.redo_stacks.get(client_id)
+                if redo:
+                    redo.clear()
+
+        if source != "edit" or len(text) != 1 or not stack.merge(seq, ver, kind, line, idx, text):
+            stack.push(seq, ver, kind, line, idx, text)
+        while stack.size > self.budget and len(stack) > 1:
+            stack.evict()
+
+    def pop_undo(self, client_id):
+        return self._pop_group(self.undo_stacks.get(client_id))
+
+    def pop_redo(self, client_id):
+        return self._pop_group(self.redo_stacks.get(client_id))
+
+    def _pop_group(self, stack):
+        # pop every record of the newest version, newest first; callers apply them in that order
+        # via transform() and cancel()
+        group = []
+        if not stack:
+            return group
+        ver = stack.vers[-1]
+        while len(stack) and stack.vers[-1] == ver:
+            record = stack.pop()
+            if not self.log.covers(record[0]):
+                # edits it depends on have been evicted, so nothing older is usable either
+                stack.clear()
+                return []
+            group.append(record)
+        return group
+
+    def transform(self, record):
+        # rebase a popped record onto the current document; returns None if it no longer applies
+        seq, ver, kind, line, idx, text, first = record
+        if not self.log.covers(seq):
+            return None
+        if kind == DELETE:
+            start = self.log.transform(seq, line, idx)
+            end = self.log.transform(seq, line, idx + len(text), stick_left=True)
+            if end[0] != start[0]:
+                # someone broke the run across lines; undo what is left on the first line
+                return DELETE, start[0], start[1], sys.maxsize
+            if end[1] <= start[1]:
+                return None
+            return DELETE, start[0], start[1], end[1] - start[1]
+        if kind == JOIN:
+            # the line break we would remove must still sit right before column 0 of the line
+            line, idx = self.log.transform(seq, line, 0, stick_left=True)
+            if idx != 0:
+                return None
+            return JOIN, line, 0, 0
+        line, idx = self.log.transform(seq, line, idx)
+        return kind, line, idx, text
+
+
+    def cancel(self, record):
+        # the edit logged last undid (or redid) record, later transforms leave the pair out
+        self.log.cancel(record[6], record[0], self.log.next_seq() - 1)
+
+
+class ReplayBuffer(object):
+    # the edits of the last max_versions versions, so a client coming back from a dropped
+    # connection can be sent what it missed instead of the whole doc
+    def __init__(self, max_versions=DEFAULT_REPLAY_VERSIONS):
+        self.max_versions = max_versions
+        self.versions = deque()
+        self.base = 0 # oldest version a client can still be caught up from
+
+    def reset(self, ver):
+        # the doc was replaced wholesale, nobody can catch up across that
+        self.versions.clear()
+        self.base = ver
+
+    def record(self, ver, inverse):
+        self.extend(ver, [replay_edit(inverse)])
+
+    def extend(self, ver, edits):
+        # add already replayable edits, e.g. ones a standby received from its primary
+        if self.versions and self.versions[-1][0] == ver:
+            self.versions[-1][1].extend(edits)
+            return
+        self.versions.append((ver, list(edits)))
+        while len(self.versions) > self.max_versions:
+            self.versions.popleft()
+            self.base = self.versions[0][0] - 1
+
+    def since(self, ver):
+        # [[ver, [edit, ...]], ...] after ver, or None if part of that range is gone.
+        # Walks back from the newest version, the common case only wants the last few
+        if ver < self.base:
+            return None
+        missed = []
+        for v, edits in reversed(self.versions):
+            if v <= ver:
+                break
+            missed.append([v, edits])
+        missed.reverse()
+        return missed
@@ -0,0 +1,146 @@
+import hashlib
+from history import INSERT, DELETE, SPLIT, JOIN
+
+BLOCK_LINES = 128 # lines per resync block, ~800 hashes for a 100k line doc
+MODULUS = (1 << 61) - 1
+BASE = 1000003
+TOP_POWER = pow(BASE, BLOCK_LINES - 1, MODULUS) # weight of a window's first line, for rolling it out
+
+
+def line_digest(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big") % MODULUS
+
+
+def window_hash(digests, start):
+    # polynomial hash of BLOCK_LINES line digests, cheap to roll one line further
+    h = 0
+    for d in digests[start:start + BLOCK_LINES]:
+        h = (h * BASE + d) % MODULUS
+    return h
+
+
+def roll(h, out, into):
+    return ((h - out * TOP_POWER) * BASE + into) % MODULUS
+
+
+def block_hashes(lines):
+    # what a client sends to resync: the hash of each whole block of its doc
+    digests = [line_digest(text) for text in lines]
+    return [window_hash(digests, start) for start in range(0, len(lines) - BLOCK_LINES + 1, BLOCK_LINES)]
+
+
+def root_hash(blocks, lines):
+    # the Merkle root, with the tail lines that don't fill a block folded in
+    h = hashlib.blake2b(digest_size=8)
+    for block in blocks:
+        h.update(block.to_bytes(8, "big"))
+    for text in lines[len(blocks) * BLOCK_LINES:]:
+        h.update(line_digest(text).to_bytes(8, "big"))
+    return h.hexdigest()
+
+
+def rebuild(base, ops):
+    # the doc a resync reply describes, copying unchanged blocks out of the doc we hashed
+    doc = []
+    for op in ops:
+        if isinstance(op, str):
+            doc.append(op)
+        else:
+            first, count = op
+            doc.extend(base[first * BLOCK_LINES:(first + count) * BLOCK_LINES])
+    return doc
+
+
+class LineHashIndex(object):
+    # per-line digests of the doc plus a hash per block of BLOCK_LINES lines, kept up to date
+    # lazily: an edit only forgets the digests and block hashes it touched, they're recomputed
+    # when a client asks to resync. Line splits and joins shift every later block, so those
+    # just lower the mark above which all block hashes are stale
+    def __init__(self):
+        self.digests = []
+        self.blocks = []
+        self.dirty = set()          # blocks below stale_from whose hash needs recomputing
+        self.stale_from = 0         # first block that shifted since the last refresh
+
+    def reset(self):
+        self.digests = []
+        self.blocks = []
+        self.dirty.clear()
+        self.stale_from = 0
+
+    def on_edit(self, kind, line, idx, n):
+        if not self.digests:
+            return
+        if kind in (INSERT, DELETE):
+            self.digests[line - 1] = None
+            self.dirty.add((line - 1) // BLOCK_LINES)
+            return
+        if kind == SPLIT:
+            self.digests[line - 1] = None
+            self.digests.insert(line, None)
+            first = (line - 1) // BLOCK_LINES
+        elif kind == JOIN:
+            self.digests.pop(line - 1)
+            self.digests[line - 2] = None
+            first = (line - 2) // BLOCK_LINES
+        self.stale_from = min(self.stale_from, first)
+
+    def refresh(self, doc):
+        if len(self.digests) != len(doc):
+            # first use, or the doc was replaced without going through the edit listeners
+            self.digests = [line_digest(text) for text in doc]
+            self.blocks = []
+            self.dirty.clear()
+            self.stale_from = 0
+        count = len(doc) // BLOCK_LINES
+        del self.blocks[min(self.stale_from, count):]
+        for block in sorted(self.dirty):
+            if block < len(self.blocks):
+                self.fill(doc, block)
+                self.blocks[block] = window_hash(self.digests, block * BLOCK_LINES)
+        while len(self.blocks) < count:
+            self.fill(doc, len(self.blocks))
+            self.blocks.append(window_hash(self.digests, len(self.blocks) * BLOCK_LINES))
+        self.fill(doc, count)
+        self.dirty.clear()
+        self.stale_from = count
+
+    def fill(self, doc, block):
+        # digest the lines of one block that edits left blank
+        for i in range(block * BLOCK_LINES, min((block + 1) * BLOCK_LINES, len(doc))):
+            if self.digests[i] is None:
+                self.digests[i] = line_digest(doc[i])
+
+    def root(self, doc):
+        self.refresh(doc)
+        return root_hash(self.blocks, doc)
+
+    def diff(self, doc, theirs):
+        # rsync style: walk our doc and wherever the next BLOCK_LINES lines hash to one of the
+        # client's blocks send a reference to it, otherwise send the line itself. Runs of
+        # consecutive blocks collapse into one [first, count]
+        self.refresh(doc)
+        wanted = {}
+        for i, h in enumerate(theirs):
+            wanted.setdefault(h, i)
+        ops = []
+        i = 0
+        h = None
+        while i + BLOCK_LINES <= len(doc):
+            if h is None:
+                h = self.blocks[i // BLOCK_LINES] if i % BLOCK_LINES == 0 else window_hash(self.digests, i)
+            match = wanted.get(h)
+            if match is not None:
+                if ops and not isinstance(ops[-1], str) and ops[-1][0] + ops[-1][1] == match:
+                    ops[-1][1] += 1
+                else:
+                    ops.append([match, 1])
+                i += BLOCK_LINES
+                h = None
+                continue
+            ops.append(doc[i])
+            if i + BLOCK_LINES < len(doc):
+                h = roll(h, self.digests[i], self.digests[i + BLOCK_LINES])
+            i += 1
+        ops.extend(doc[i:])
+        return ops
@@ -0,0 +1,270 @@
+import bisect
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from itertools import accumulate, islice
+
+PAGE_LINES = 256          # lines per page, the unit that moves between memory and the scratch file
+LINE_OVERHEAD = 56        # bytes a line costs beyond its characters: the str header and its list slot
+COMPACT_MIN = 1024 * 1024 # bytes of dead records in the scratch file before it is worth rewriting
+
+
+class Page(object):
+    __slots__ = ("lines", "size", "offset", "length", "shared")
+
+    def __init__(self, lines):
+        self.lines = lines   # None while the page only lives in the scratch file
+        self.size = sum(len(line) for line in lines) + LINE_OVERHEAD * len(lines)
+        self.offset = None   # where its record starts in the scratch file, None if it has no current one
+        self.length = 0
+        self.shared = False  # a snapshot holds its lines list, copy it before changing it
+
+
+class Snapshot(object):
+    # the lines of a PagedDoc as they were when it was taken, for another thread to read. It
+    # holds the lists of the pages that were in memory and the scratch file records of the
+    # rest, never the whole doc; the doc copies a shared page before changing it
+    def __init__(self, scratch, parts, length):
+        self.scratch = scratch # keeps the file open even if the doc has compacted to a new one
+        self.parts = parts     # per page its lines, or (offset, length) of its record
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        fd = self.scratch.fileno()
+        for part in self.parts:
+            if isinstance(part, list):
+                yield from part
+            else:
+                # pread leaves the file position alone, the doc's own reads and writes go on meanwhile
+                offset, length = part
+                yield from json.loads(os.pread(fd, length, offset).decode("utf-8"))
+
+
+def snapshot(doc):
+    # a copy of the doc's lines that stays as it is while the doc is edited
+    if isinstance(doc, PagedDoc):
+        return doc.snapshot()
+    return list(doc)
+
+
+class PagedDoc(object):
+    # a stand-in for Server.doc's list of lines that holds roughly `budget` bytes of them in
+    # memory. Lines are kept in pages of about PAGE_LINES; touching a page makes it the most
+    # recently used, and when the resident pages go over budget the least recently used ones
+    # are written to an unnamed scratch file and dropped, to be read back the next time
+    # something indexes into them. Keystrokes land in pages that were just read, so editing
+    # stays in memory; only jumping to a cold region costs a read.
+    def __init__(self, lines=(), budget=64 * 1024 * 1024, directory=None, page_lines=PAGE_LINES):
+        self.budget = budget
+        self.page_lines = page_lines
+        self.directory = directory
+        self.scratch = tempfile.TemporaryFile(dir=directory)
+        self.end = 0           # scratch file length, records are only ever appended
+        self.garbage = 0       # bytes of records no page points at any more
+        self.pages = []
+        self.counts = []       # lines per page
+        self.starts = []       # first line of every page, the first `valid` of them up to date
+        self.valid = 0
+        self.length = 0
+        self.resident = OrderedDict() # resident pages, least recently used first
+        self.resident_bytes = 0
+        # an iterator (an open file) is paged in as it's read, it never has to fit in memory
+        lines = iter(lines)
+        while True:
+            chunk = list(islice(lines, page_lines))
+            if not chunk:
+                break
+            self.add_page(len(self.pages), Page(chunk))
+            self.length += len(chunk)
+            self.trim()
+        if not self.pages:
+            self.add_page(0, Page([]))
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        # the server prints its doc after every keystroke, which mustn't read every page back in
+        return f"<PagedDoc {self.length} lines, {len(self.resident)}/{len(self.pages)} pages in memory>"
+
+    def __iter__(self):
+        # a scan of the whole doc (a save, a checkpoint, a full frame) reads spilled pages
+        # straight from the scratch file and leaves what is resident alone, so it doesn't push
+        # out the pages being edited
+        for page in self.pages:
+            yield from page.lines if page.lines is not None else self.read(page)
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            lines = []
+            while start < stop:
+                k, offset = self.locate(start)
+                page = self.load(k).lines
+                lines += page[offset:offset + stop - start]
+                start += len(page) - offset
+            return lines
+        k, offset = self.locate(i)
+        return self.load(k).lines[offset]
+
+    def __setitem__(self, i, line):
+        k, offset = self.locate(i)
+        page = self.modify(k)
+        self.resize(page, len(line) - len(page.lines[offset]))
+        page.lines[offset] = line
+
+    def __delitem__(self, i):
+        self.pop(i)
+
+    def insert(self, i, line):
+        # like list.insert, i may be anywhere up to len(self)
+        i = max(0, min(i + self.length if i < 0 else i, self.length))
+        k, offset = self.locate(i) if i < self.length else (len(self.pages) - 1, self.counts[-1])
+        page = self.modify(k)
+        page.lines.insert(offset, line)
+        self.resize(page, len(line) + LINE_OVERHEAD)
+        self.moved(k, 1)
+        if len(page.lines) > 2 * self.page_lines:
+            # split a page that has grown too long, so a cold page is never expensive to read back
+            half = len(page.lines) // 2
+            rest = Page(page.lines[half:])
+            del page.lines[half:]
+            self.resize(page, -rest.size)
+            self.counts[k] = len(page.lines)
+            self.add_page(k + 1, rest)
+        self.trim()
+
+    def append(self, line):
+        self.insert(self.length, line)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def pop(self, i=-1):
+        k, offset = self.locate(i)
+        page = self.modify(k)
+        line = page.lines.pop(offset)
+        self.resize(page, -len(line) - LINE_OVERHEAD)
+        self.moved(k, -1)
+        if not page.lines and len(self.pages) > 1:
+            del self.pages[k], self.counts[k], self.starts[k]
+            del self.resident[page]
+            self.valid = min(self.valid, k)
+        return line
+
+    def snapshot(self):
+        # O(pages): resident pages are shared until either side would change them. Records still
+        # in the file's buffer are flushed, the snapshot reads them past it
+        self.scratch.flush()
+        parts = []
+        for page in self.pages:
+            if page.lines is not None:
+                page.shared = True
+                parts.append(page.lines)
+            else:
+                parts.append((page.offset, page.length))
+        return Snapshot(self.scratch, parts, self.length)
+
+    def locate(self, i):
+        # (page, offset in it) of line i
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError("doc index out of range")
+        valid = self.valid
+        if not valid or i >= self.starts[valid - 1] + self.counts[valid - 1]:
+            # past the pages whose starts are known, count on from the last of them. Edits only
+            # move the pages after their own, so lookups near the cursor rarely get here
+            base = self.starts[valid - 1] + self.counts[valid - 1] if valid else 0
+            self.starts[valid:] = accumulate(self.counts[valid:-1], initial=base)
+            valid = self.valid = len(self.pages)
+        k = bisect.bisect_right(self.starts, i, 0, valid) - 1
+        return k, i - self.starts[k]
+
+    def add_page(self, k, page):
+        self.pages.insert(k, page)
+        self.counts.insert(k, len(page.lines))
+        self.starts.insert(k, 0)
+        self.valid = min(self.valid, k)
+        self.resident[page] = None
+        self.resident_bytes += page.size
+
+    def moved(self, k, n):
+        self.counts[k] += n
+        self.length += n
+        self.valid = min(self.valid, k + 1)
+
+    def resize(self, page, n):
+        page.size += n
+        self.resident_bytes += n
+
+    def load(self, k):
+        # page k, read back in if it was spilled, as the most recently used
+        page = self.pages[k]
+        if page.lines is None:
+            page.lines = self.read(page)
+            self.resident[page] = None
+            self.resident_bytes += page.size
+            self.trim()
+        else:
+            self.resident.move_to_end(page)
+        return page
+
+    def read(self, page):
+        # the lines of a spilled page, from its record in the scratch file
+        self.scratch.seek(page.offset)
+        return json.loads(self.scratch.read(page.length).decode("utf-8"))
+
+    def modify(self, k):
+        # page k about to change, its record in the scratch file no longer matches it
+        page = self.load(k)
+        if page.offset is not None:
+            self.garbage += page.length
+            page.offset = None
+        if page.shared:
+            page.lines = list(page.lines)
+            page.shared = False
+        return page
+
+    def trim(self):
+        # spill the least recently used pages until the rest fit the budget; the page in use
+        # was just moved to the end, so it always stays
+        while self.resident_bytes > self.budget and len(self.resident) > 1:
+            page, _ = self.resident.popitem(last=False)
+            if page.offset is None:
+                # changed since it was last written, or never written at all
+                data = json.dumps(page.lines).encode("utf-8")
+                self.scratch.seek(self.end)
+                self.scratch.write(data)
+                page.offset, page.length = self.end, len(data)
+                self.end += len(data)
+            page.lines, page.shared = None, False
+            self.resident_bytes -= page.size
+        if self.garbage > max(COMPACT_MIN, self.end - self.garbage):
+            self.compact()
+
+    def compact(self):
+        # rewrite the scratch file with only the live records, once most of it is dead
+        old, self.scratch = self.scratch, tempfile.TemporaryFile(dir=self.directory)
+        end = 0
+        for page in self.pages:
+            if page.offset is not None:
+                old.seek(page.offset)
+                self.scratch.write(old.read(page.length))
+                page.offset = end
+                end += page.length
+        # not closed here, a snapshot may still be reading records from it; it goes with the last one
+        self.end, self.garbage = end, 0
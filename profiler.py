@@ -0,0 +1,132 @@
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# server methods on the keystroke path; connection_handler threads go through parse_ops
+HOT_PATHS = ("parse_ops", "process_op", "apply_edit", "insert_char", "do_enter", "remove_char",
+             "record_edit", "broadcast", "send_file", "send_line_count", "render_frame")
+SAMPLE_INTERVAL = 0.005 # SECONDS between stack samples
+
+
+class Profiler(object):
+    # records where the server's time goes, as collapsed stacks ("a;b;c <count>") for flame graphs.
+    # "timing" wraps the hot methods on the instance while running and counts microseconds,
+    # "sample" polls every thread's stack from a background thread. Stopped, nothing is wrapped
+    # or polled, so a server that never profiles pays nothing for it.
+    def __init__(self, target, mode="timing", hot_paths=HOT_PATHS, interval=SAMPLE_INTERVAL):
+        if mode not in ("timing", "sample"):
+            raise ValueError(f"unknown profiling mode {mode!r}")
+        self.target = target
+        self.mode = mode
+        self.hot_paths = hot_paths
+        self.interval = interval
+        self.running = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stacks = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.totals = defaultdict(float)
+        self.saved = {}
+        self.sampler = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if self.mode == "timing":
+            for name in self.hot_paths:
+                # remember instance overrides (tests swap send_file out) so stop() can put them back
+                self.saved[name] = self.target.__dict__.get(name)
+                setattr(self.target, name, self.wrap(name, getattr(self.target, name)))
+        else:
+            self.sampler = threading.Thread(target=self.sample, daemon=True, name="profiler_thread")
+            self.sampler.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.mode == "timing":
+            for name, original in self.saved.items():
+                if original is None:
+                    delattr(self.target, name)
+                else:
+                    setattr(self.target, name, original)
+            self.saved.clear()
+        elif self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def toggle(self, path):
+        # used by the runtime trigger: start, or stop and write what was collected
+        if self.running:
+            self.stop()
+            self.dump(path)
+        else:
+            self.start()
+
+    def wrap(self, name, func):
+        profiler = self
+
+        def timed(*args, **kwargs):
+            stack = getattr(profiler.local, "stack", None)
+            if stack is None:
+                stack = profiler.local.stack = [threading.current_thread().name]
+            stack.append(name)
+            child_time = getattr(profiler.local, "child_time", 0.0)
+            profiler.local.child_time = 0.0
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                # flame graphs want self time per stack, children report their own
+                own = elapsed - profiler.local.child_time
+                key = ";".join(stack)
+                with profiler.lock:
+                    profiler.stacks[key] += int(own * 1e6)
+                    profiler.calls[name] += 1
+                    profiler.totals[name] += elapsed
+                stack.pop()
+                profiler.local.child_time = child_time + elapsed
+        return timed
+
+    def sample(self):
+        me = threading.get_ident()
+        while self.running:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                with self.lock:
+                    self.stacks[";".join(reversed(frames))] += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        with self.lock:
+            return [f"{stack} {count}" for stack, count in sorted(self.stacks.items()) if count > 0]
+
+    def summary(self):
+        # per-function call counts and cumulative seconds (timing mode only)
+        with self.lock:
+            return {name: {"calls": self.calls[name], "seconds": round(self.totals[name], 6)} for name in self.calls}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+        print(f"Wrote profile to {path}")
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.calls.clear()
+            self.totals.clear()
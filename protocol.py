@@ -0,0 +1,15 @@
+DELIMITER = "\u001D"
+
+
+def read_greeting(sock, peer="Server"):
+    # the server greets every connection with "ID: n" before anything else. Returns the id and
+    # whatever came in behind the greeting in the same reads, the start of the first frame,
+    # which the caller's frame reader has to start from
+    data = b""
+    while DELIMITER.encode() not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError(f"{peer} closed the connection")
+        data += chunk
+    greeting, rest = data.split(DELIMITER.encode(), 1)
+    return int(greeting.decode().strip("ID: ")), rest
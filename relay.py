@@ -0,0 +1,169 @@
+import socket
+import threading
+import argparse
+import json
+from protocol import read_greeting
+
+DELIMITER = "\u001D"
+FRAME_END = "\u001E"
+SEND_TIMEOUT = 5 # SECONDS a slow viewer may block the fan-out before it is dropped
+
+
+class ViewerHub(object):
+    # fans the latest document frame out to read-only viewers from its own thread,
+    # so the publisher only pays for storing one frame no matter how many viewers there are
+    def __init__(self):
+        self.viewers = {}
+        self.latest = None
+        self.latest_ver = -1
+        self.sent_ver = -1
+        self.joining = {} # viewer_id -> the first frame for a viewer that hasn't had one yet
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.viewers)
+
+    def add(self, viewer_id, sock, frame=None):
+        # may be called from the updater thread, so the first frame is sent by the fan-out
+        # thread like every other one
+        sock.settimeout(SEND_TIMEOUT)
+        with self.lock:
+            # only spin up the fan-out thread once somebody is actually watching
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.fan_out, daemon=True, name="fanout_thread")
+                self.thread.start()
+            self.viewers[viewer_id] = sock
+            frame = frame or self.latest
+            # bring the new viewer up to date without waiting for the next edit
+            if frame is not None:
+                self.joining[viewer_id] = frame
+        self.pending.set()
+
+    def remove(self, viewer_id):
+        with self.lock:
+            self.joining.pop(viewer_id, None)
+            return self.viewers.pop(viewer_id, None)
+
+    def publish(self, ver, frame):
+        # called from the updater thread: O(1), older unsent frames are simply replaced
+        with self.lock:
+            if ver < self.latest_ver:
+                return
+            self.latest, self.latest_ver = frame, ver
+        self.pending.set()
+
+    def send(self, viewer_id, sock, frame):
+        try:
+            sock.sendall(frame)
+        except OSError:
+            # viewer is gone or too slow, stop serving it
+            self.remove(viewer_id)
+            sock.close()
+
+    def fan_out(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            with self.lock:
+                joining = [(viewer_id, self.viewers[viewer_id], frame) for viewer_id, frame in self.joining.items()]
+                self.joining.clear()
+                if self.latest_ver == self.sent_ver:
+                    frame, viewers = None, []
+                else:
+                    frame, self.sent_ver = self.latest, self.latest_ver
+                    viewers = list(self.viewers.items())
+            # first frames go out ahead of the next version, so a new viewer never gets them out of order
+            for viewer_id, sock, first in joining:
+                self.send(viewer_id, sock, first)
+            for viewer_id, sock in viewers:
+                self.send(viewer_id, sock, frame)
+
+
+class Relay(object):
+    # subscribes to a server once as a viewer and serves that stream to its own viewers
+    def __init__(self, upstream_host, upstream_port, host, port, key=None):
+        self.upstream = socket.create_connection((upstream_host, upstream_port))
+        # the id the server greets us with isn't needed, only what came in behind it
+        _, self.unread = read_greeting(self.upstream, "Upstream server")
+        if key is not None:
+            # a read key is enough to watch
+            self.upstream.sendall((json.dumps({"opcode": "AUTH", "key": key}) + DELIMITER).encode())
+        subscribe = {"opcode": "SUBSCRIBE", "role": "viewer"}
+        self.upstream.sendall((json.dumps(subscribe) + DELIMITER).encode())
+
+        self.hub = ViewerHub()
+        self.next_id = 0
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen()
+        print(f"Relay for {upstream_host}:{upstream_port} listening on {host}:{port}...")
+
+    def upstream_reader(self):
+        # split the upstream stream into whole frames and republish each one
+        buffer = self.unread
+        while True:
+            data = self.upstream.recv(65536)
+            if not data:
+                print("Upstream server closed the connection")
+                break
+            buffer += data
+            *frames, buffer = buffer.split(FRAME_END.encode())
+            # only doc frames are republished, not the session handshake
+            frames = [frame for frame in frames if frame.startswith(b"VERSION: ")]
+            if frames:
+                frame = frames[-1] + FRAME_END.encode()
+                header = frame[:frame.find(DELIMITER.encode())].decode()
+                self.hub.publish(int(header.strip("VERSION: ")), frame)
+
+    def connection_listener(self):
+        while True:
+            viewer_socket, addr = self.server_socket.accept()
+            self.next_id += 1
+            # viewers talk the server's protocol, they just never get to edit
+            viewer_socket.sendall((f"ID: {self.next_id}" + DELIMITER).encode())
+            threading.Thread(target=self.connection_handler, args=(viewer_socket, self.next_id), daemon=True).start()
+
+    def connection_handler(self, viewer_socket, viewer_id):
+        self.hub.add(viewer_id, viewer_socket)
+        # drain and ignore whatever the viewer sends until it hangs up
+        while True:
+            try:
+                if not viewer_socket.recv(4096):
+                    break
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+        self.hub.remove(viewer_id)
+        viewer_socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("upstream_host", help="Server's IP address")
+    parser.add_argument("upstream_port", help="Server's port number")
+    parser.add_argument("host", help="Relay's IP address")
+    parser.add_argument("port", help="Relay's port number for viewers")
+    parser.add_argument("--key", help="Key to authenticate to the server with, if it requires one")
+    args = parser.parse_args()
+
+    relay = Relay(args.upstream_host, int(args.upstream_port), args.host, int(args.port), key=args.key)
+
+    try:
+        reader_thread = threading.Thread(target=relay.upstream_reader, daemon=True, name="upstream_thread")
+        listener_thread = threading.Thread(target=relay.connection_listener, daemon=True, name="main_thread")
+        reader_thread.start()
+        listener_thread.start()
+        reader_thread.join()
+    except KeyboardInterrupt:
+        print("\nShutting down relay...")
+    finally:
+        relay.server_socket.close()
+        relay.upstream.close()
+        print("Done.")
+
+if __name__ == "__main__":
+    main()
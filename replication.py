@@ -0,0 +1,96 @@
+import json
+import socket
+import time
+from history import apply_to_lines
+from protocol import read_greeting
+
+DELIMITER = "\u001D"
+FRAME_END = "\u001E"
+REPORT_INTERVAL = 5 # SECONDS between replication status lines
+
+
+class Standby(object):
+    # keeps a Server that isn't serving yet in step with a primary's op stream, so it can take
+    # over with the same doc, doc_ver and replay buffer (resuming clients still get deltas).
+    #
+    # the primary sends "SNAPSHOT: {ver, doc, time}" when the standby is too far behind and
+    # "REPL: {ver, versions, time}" after every broadcast; the standby ACKs each frame
+    def __init__(self, server, primary_host, primary_port, key=None):
+        self.server = server
+        self.primary = (primary_host, primary_port)
+        self.key = key # needs an admin key when the primary requires authentication
+        self.upstream = None
+        self.id = None
+        self.unread = b"" # what came in behind the greeting, follow() starts from it
+        self.synced = False
+        self.following = False
+        self.lag = None # SECONDS between the primary sending the last frame and us applying it
+
+    def connect(self):
+        self.upstream = socket.create_connection(self.primary)
+        self.id, self.unread = read_greeting(self.upstream, "Primary server")
+        if self.key is not None:
+            self.send({"opcode": "AUTH", "key": self.key})
+        ver = self.server.doc_ver if self.synced else -1
+        self.send({"opcode": "REPLICATE", "ver": ver, "id": self.id})
+        self.following = True
+
+    def send(self, op):
+        self.upstream.sendall((json.dumps(op) + DELIMITER).encode())
+
+    def follow(self):
+        # apply frames until the primary goes away
+        buffer = self.unread
+        while True:
+            try:
+                data = self.upstream.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                print("Lost the primary")
+                self.following = False
+                break
+            buffer += data
+            *frames, buffer = buffer.split(FRAME_END.encode())
+            for frame in frames:
+                kind, payload = frame.decode("utf-8").split(": ", 1)
+                self.apply(kind, json.loads(payload))
+        self.upstream.close()
+
+    def apply(self, kind, payload):
+        if kind not in ("SNAPSHOT", "REPL"):
+            # the session handshake, nothing to replicate
+            return
+        server = self.server
+        with server.data_lock:
+            if kind == "SNAPSHOT":
+                server.doc = server.new_doc(payload["doc"])
+                server.replay.reset(payload["ver"])
+                server.versions.reset(payload["ver"], server.doc)
+            else:
+                for ver, edits in payload["versions"]:
+                    for edit in edits:
+                        apply_to_lines(server.doc, edit)
+                    server.replay.extend(ver, edits)
+                    server.versions.extend(ver, edits)
+                    server.versions.commit(ver, server.doc)
+            server.doc_ver = payload["ver"]
+        if server.autosaver is not None:
+            # a standby keeps its own copy on disk too
+            server.autosaver.notify()
+        self.synced = True
+        self.lag = max(0.0, time.time() - payload["time"])
+        try:
+            self.send({"opcode": "ACK", "ver": server.doc_ver, "time": payload["time"], "id": self.id})
+        except OSError:
+            # follow() notices on its next recv
+            pass
+
+    def status(self):
+        return {"primary": "%s:%d" % self.primary, "ver": self.server.doc_ver, "synced": self.synced, "lag": self.lag}
+
+    def report(self, interval=REPORT_INTERVAL):
+        while self.following:
+            time.sleep(interval)
+            if self.following and self.lag is not None:
+                print(f"Replicated version {self.server.doc_ver} from {self.primary[0]}:{self.primary[1]}, lag {self.lag * 1000:.1f} ms")
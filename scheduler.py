@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import deque
+
+DEFAULT_RATE = 100.0 # ops per SECOND a client can keep up
+DEFAULT_BURST = 200  # ops a client can send at once after going quiet, a short paste or an undo run
+MAX_PENDING = 1000   # ops queued per client before its connection handler stops reading
+FREE_OPCODES = ("ACK", "DISCONNECT", "SESSION", "ADMIN") # bookkeeping that never waits for tokens
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        # SECONDS until the next token, valid right after a failed take()
+        return (1 - self.tokens) / self.rate
+
+
+class FairQueue(object):
+    # stands in for the updater's op Queue. Every connection gets its own sub-queue and the
+    # updater takes one op from each in turn, so a client pasting thousands of ops only delays
+    # its own; the token buckets then cap how fast any one client is served at all. A flooding
+    # client's handler blocks once its sub-queue is full, which pushes back on it through TCP.
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_pending=MAX_PENDING):
+        self.rate = rate # 0 turns rate limiting off, the round-robin stays
+        self.burst = burst
+        self.max_pending = max_pending
+        self.queues = {}     # key -> deque of that client's ops, in arrival order
+        self.ready = deque() # keys with ops waiting, in round-robin order
+        self.buckets = {}
+        self.cond = threading.Condition()
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, op, key=None):
+        # key is the connection the op came in on, the op's own id is only a fallback
+        key = op.get("id") if key is None else key
+        with self.cond:
+            while True:
+                queue = self.queues.setdefault(key, deque())
+                if len(queue) < self.max_pending or op["opcode"] in FREE_OPCODES:
+                    break
+                self.cond.wait()
+            if not queue:
+                self.ready.append(key)
+            queue.append(op)
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while True:
+                op = self.next_op(time.monotonic())
+                if isinstance(op, dict):
+                    # a sub-queue has room again
+                    self.cond.notify_all()
+                    return op
+                self.cond.wait(op)
+
+    def next_op(self, now):
+        # the next op in round-robin order, or how long to wait for one (None: until a put)
+        delay = None
+        for i in range(len(self.ready)):
+            key = self.ready.popleft()
+            queue = self.queues[key]
+            if self.rate and queue[0]["opcode"] not in FREE_OPCODES:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+                if not bucket.take(now):
+                    self.ready.append(key)
+                    wait = bucket.wait_time()
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+            op = queue.popleft()
+            if queue:
+                self.ready.append(key)
+            else:
+                del self.queues[key]
+            if op["opcode"] == "DISCONNECT":
+                self.buckets.pop(key, None)
+            return op
+        return delay
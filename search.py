@@ -0,0 +1,73 @@
+import re
+from collections import OrderedDict
+from history import INSERT, DELETE, SPLIT, JOIN
+
+MAX_CACHED_PATTERNS = 8
+
+
+def compile_pattern(pattern, regex=False, case=True):
+    # raises re.error for bad user regexes, callers report it back to the client
+    flags = 0 if case else re.IGNORECASE
+    return re.compile(pattern if regex else re.escape(pattern), flags)
+
+
+class SearchIndex(object):
+    # per-pattern cache of match spans for every line; edits only drop the lines they touch,
+    # so searching again after a few keystrokes rescans a few lines instead of the whole doc
+    def __init__(self, max_patterns=MAX_CACHED_PATTERNS):
+        self.max_patterns = max_patterns
+        self.caches = OrderedDict()
+
+    def reset(self):
+        self.caches.clear()
+
+    def on_edit(self, kind, line, idx, n):
+        for spans in self.caches.values():
+            if kind in (INSERT, DELETE):
+                spans[line - 1] = None
+            elif kind == SPLIT:
+                spans[line - 1] = None
+                spans.insert(line, None)
+            elif kind == JOIN:
+                spans.pop(line - 1)
+                spans[line - 2] = None
+
+    def spans(self, doc, rx):
+        # returns the per-line span list for rx, filling in only lines that are stale
+        spans = self.caches.get(rx)
+        if spans is None or len(spans) != len(doc):
+            # first search for this pattern (or the doc was swapped out from under us)
+            spans = [None] * len(doc)
+            if len(self.caches) >= self.max_patterns:
+                self.caches.popitem(last=False)
+        self.caches[rx] = spans
+        self.caches.move_to_end(rx)
+
+        for i, cached in enumerate(spans):
+            if cached is None:
+                # matches never cross a line break
+                spans[i] = [m.span() for m in rx.finditer(doc[i].rstrip("\n"))]
+        return spans
+
+    def find(self, doc, rx):
+        return [[i + 1, start, end] for i, line_spans in enumerate(self.spans(doc, rx)) for start, end in line_spans]
+
+    def replace_edits(self, doc, rx, replacement, regex=False):
+        # primitive edits replacing every match; each line is edited right to left so earlier spans stay valid.
+        # Raises ValueError if a replacement comes out with a line break, e.g. a regex template with \n in it
+        edits = []
+        count = 0
+        for i, line_spans in enumerate(self.spans(doc, rx)):
+            if not line_spans:
+                continue
+            matches = list(rx.finditer(doc[i].rstrip("\n")))
+            for m in reversed(matches):
+                text = m.expand(replacement) if regex else replacement
+                if "\n" in text:
+                    raise ValueError("replacement can't contain line breaks")
+                if m.end() > m.start():
+                    edits.append((DELETE, i + 1, m.start(), m.end() - m.start()))
+                if text:
+                    edits.append((INSERT, i + 1, m.start(), text))
+            count += len(matches)
+        return edits, count
@@ -1,23 +1,80 @@
 import socket
 import threading
 import argparse
-from queue import Queue
 import time 
 import json
+import os
 import random
+import re
+import shutil
+import signal
+import tempfile
+import traceback
+from history import UndoHistory, ReplayBuffer, forward_edit, transform_point, INSERT, DELETE, SPLIT, JOIN, DEFAULT_UNDO_BUDGET, DEFAULT_REPLAY_VERSIONS
+from relay import ViewerHub
+from search import SearchIndex, compile_pattern
+from viewport import ChangeTracker, clamp_viewport
+from profiler import Profiler
+from replication import Standby
+from scheduler import FairQueue, DEFAULT_RATE, DEFAULT_BURST
+from autosave import Autosaver, write_atomic, AUTOSAVE_DELAY
+from tokenizer import SyntaxIndex
+from linehash import LineHashIndex
+from columns import cluster_start, cluster_end
+from paging import PagedDoc, snapshot
+from versions import VersionStore, DEFAULT_CHECKPOINT_EVERY, DEFAULT_MAX_CHECKPOINTS
+from admin import AdminChannel
+from auth import ROLE_OPCODES, UNAUTHENTICATED_OPCODES, OPEN_ROLE, load_keys, new_token
+from crdt import CRDTDocument, CRDTBridge, text_to_lines, offset_to_line
 
 DELIMITER = "\u001D"
+FRAME_END = "\u001E" # terminates every frame sent to clients
 TIMEOUT = 60 # SECONDS
+CRDT_GC_INTERVAL = 100 # versions between tombstone compactions
+MAX_DEPARTED = 256 # disconnected sessions kept around for their client to resume
+INDENT = "    " # what one indent step of a multi-line selection inserts
+IMPORT_BROADCAST_INTERVAL = 0.5 # SECONDS between broadcasts while a file is streamed in
+EXPORT_CHUNK = 64 * 1024 # characters of doc per EXPORT frame
 
 class Server(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, undo_budget=DEFAULT_UNDO_BUDGET, engine="server", replay_versions=DEFAULT_REPLAY_VERSIONS,
+                 rate_limit=DEFAULT_RATE, burst=DEFAULT_BURST, auth_keys=None, checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+                 max_checkpoints=DEFAULT_MAX_CHECKPOINTS, history_dir=None, memory_budget=None, scratch_dir=None):
         # define instance vars
-        self.doc = [""] * 10 # 200 empty lines to start
+        self.memory_budget = memory_budget # bytes of lines kept in memory, None keeps the doc a plain list
+        self.scratch_dir = scratch_dir
+        self.doc = self.new_doc([""] * 10) # 200 empty lines to start
         self.doc_ver = 0
         self.clients = {}
         self.client_cursors = {}
-        self.data_lock = threading.Lock()
-        self.op_queue = Queue()
+        self.data_lock = threading.Lock() # held while an op is processed, so snapshots see whole versions
+        # per-client sub-queues served round-robin, each client rate limited
+        self.op_queue = FairQueue(rate_limit, burst)
+        self.history = UndoHistory(undo_budget)
+        self.replay = ReplayBuffer(replay_versions)
+        self.versions = VersionStore(checkpoint_every, max_checkpoints, history_dir) # past versions for HISTORY queries
+        self.departed = {} # client_id -> None, sessions whose connection dropped, oldest first
+        self.replicas = {} # client_id -> {"socket", "sent", "acked", "lag"} of standby servers
+        self.autosaver = None
+        self.import_broadcast = 0.0 # when an import last broadcast, its chunks don't each need one
+        self.auth_keys = auth_keys # key -> role, None lets everyone in as admin
+        self.sessions = {} # token -> client_id, so a reconnecting client proves which session is its own
+        self.tokens = {} # client_id -> token
+        self.traffic = {} # client_id -> [bytes sent, last version sent], for the admin channel
+        self.ops_processed = 0 # by the updater, for the admin channel's op rate
+        self.viewer_hub = ViewerHub()
+        self.search_index = SearchIndex()
+        self.viewports = {} # client_id -> (first line, line count) for clients that only want part of the doc
+        self.change_tracker = ChangeTracker()
+        self.syntax = SyntaxIndex()
+        self.line_hashes = LineHashIndex() # block hashes of the doc, for resyncing clients that drifted
+        self.highlighters = set() # clients that get token spans along with the doc
+        # indexes kept in step with the doc, each gets on_edit(kind, line, idx, n) after every primitive edit
+        self.edit_listeners = [self.search_index, self.change_tracker, self.syntax, self.line_hashes]
+        self.crdt = None
+        self.crdt_peers = set() # clients running their own replica, they get ops instead of the doc
+        if engine == "crdt":
+            self.enable_crdt()
 
         # bind socket to ip with given port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -31,64 +88,277 @@ class Server(object):
         while True:
             # get ip and port
             client_socket, addr = self.server_socket.accept()
+            # every frame is a whole version, sending it right away beats waiting to fill a packet
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             # store client data in dictionary
             # generate and send client id to client on connection
             client_id = random.randint(1, 60000)
             data = f"ID: {client_id}" + DELIMITER
-            client_socket.sendall(data.encode())
-            self.clients[client_id] = client_socket
-            self.client_cursors[client_id] = "1.0"
+            # greet before registering, a broadcast must never reach the socket ahead of the id
+            try:
+                client_socket.sendall(data.encode())
+            except OSError:
+                # gone before it was greeted
+                client_socket.close()
+                continue
+            if self.auth_keys is None:
+                # between ops, and before the handler starts so its ops find the client known
+                with self.data_lock:
+                    self.clients[client_id] = client_socket
+                    self.client_cursors[client_id] = "1.0"
+            # with keys, the connection only joins once its AUTH goes through the updater
 
             # start new thread for newly connected client
-            thread = threading.Thread(target=self.connection_handler, args=(client_socket, addr))
+            thread = threading.Thread(target=self.connection_handler, args=(client_socket, addr, client_id))
             thread.start()
 
-    def connection_handler(self, client_socket, addr):
+    def connection_handler(self, client_socket, addr, client_id):
         print(f"(New Thread) Connected by {addr}")
         local_ip, local_port = client_socket.getsockname()
         print(f"Using IP {local_ip} and port {local_port} for this client")
 
+        viewer = False
+        conn_id = client_id # fair queue key, stays with the connection even if it resumes a session
+        # the op set this connection may send, checked per op with one set lookup
+        allowed = ROLE_OPCODES[OPEN_ROLE] if self.auth_keys is None else UNAUTHENTICATED_OPCODES
+        rejected = False
+        pending = b"" # the start of an op whose end hasn't arrived yet
         start = time.thread_time()
         # receive data and process into cmd code and url
-        while time.thread_time() - start < TIMEOUT:
-            data = client_socket.recv(4096)
-            if data:
-                print(f"Server received data: {data}")
-                arr = data.decode("utf-8", errors='ignore').split(DELIMITER)
-                for elem in arr:
-                    if elem: self.op_queue.put(json.loads(elem))
-                    start = time.thread_time() # restart timeout timer
+        while not rejected and time.thread_time() - start < TIMEOUT:
+            try:
+                data = client_socket.recv(65536)
+            except socket.timeout:
+                # viewer sockets carry a send timeout, which recv shares
+                continue
+            except OSError:
+                break
+            if not data:
+                # client hung up
+                break
+            print(f"Server received data: {data}")
+            ops, pending = self.parse_ops(pending + data)
+            for op in ops:
+                opcode = op["opcode"]
+                if opcode not in allowed:
+                    print(f"Dropping {opcode} from client {client_id}, not permitted")
+                    continue
+                # ops act on the session this connection holds, whatever id the payload claims
+                op["id"] = client_id
+                if opcode == "AUTH":
+                    role = self.auth_keys.get(op.get("key")) if self.auth_keys is not None else OPEN_ROLE
+                    if role is None:
+                        self.send_auth_error(client_socket, "unknown key")
+                        rejected = True
+                        break
+                    allowed = ROLE_OPCODES[role]
+                    self.op_queue.put({"opcode": "SESSION", "id": client_id, "token": new_token(), "role": role,
+                                       "socket": client_socket}, conn_id)
+                elif opcode == "SUBSCRIBE":
+                    # viewers leave the editor set and are served by the fan-out thread from now on
+                    viewer = True
+                    self.op_queue.put({"opcode": "SUBSCRIBE", "id": client_id}, conn_id)
+                elif not viewer:
+                    if opcode == "RESUME" and self.auth_keys is not None:
+                        # only the session's token can take it over
+                        client_id = self.sessions.get(op.get("token"), client_id)
+                        op["prev_id"] = client_id
+                    elif opcode == "RESUME":
+                        client_id = int(op["prev_id"])
+                    self.op_queue.put(op, conn_id)
+            start = time.thread_time() # restart timeout timer
 
+        # the socket tells the updater which connection went away, the session may have moved on
+        self.op_queue.put({"opcode": "DISCONNECT", "id": client_id, "socket": client_socket}, conn_id)
         client_socket.close()
 
+    def send_auth_error(self, client_socket, error):
+        # sent from the handler thread, the connection was never registered so nothing else writes to it
+        frame = "AUTH: " + json.dumps({"error": error}) + FRAME_END
+        try:
+            client_socket.sendall(frame.encode())
+        except OSError:
+            pass
+
+    def parse_ops(self, data):
+        # whole ops plus whatever trails the last delimiter; clients batch several ops into one
+        # write, so recv boundaries can fall anywhere, even inside a multi-byte character
+        *arr, rest = data.split(DELIMITER.encode())
+        return [json.loads(elem) for elem in arr if elem], rest
+
     def write_file(self, filename="server_file.txt"):
-        with open(filename, 'w') as f:
-            # writes the lines into a file on disk 
-            f.writelines(self.doc)
+        # writes the lines into a file on disk, all or nothing
+        with self.data_lock:
+            lines = list(self.doc)
+        write_atomic(filename, lines)
+
+    def enable_autosave(self, filename, delay=AUTOSAVE_DELAY):
+        self.autosaver = Autosaver(self, filename, delay)
+        self.autosaver.start()
 
     def open_file(self, filename="server_file.txt"):
         try:
             with open(filename, 'r') as f:
-                # obtains a list of lines as strings in a file (includes terminating \n)
-                self.doc = f.readlines()
+                # the file's lines as strings (includes terminating \n), read as they are paged in
+                self.load_lines(f)
         except FileNotFoundError:
             print("File not found...")
 
+    def new_doc(self, lines):
+        # with a memory budget the doc spills its least recently used pages to a scratch file
+        if self.memory_budget is None:
+            return list(lines)
+        return PagedDoc(lines, self.memory_budget, self.scratch_dir)
+
+    def load_lines(self, lines):
+        # replace the doc wholesale, outside the edit path
+        self.doc = self.new_doc(lines)
+        self.search_index.reset()
+        self.syntax.reset()
+        self.line_hashes.reset()
+        # neither do undo records
+        self.history.reset()
+        # cursors into the old text mean nothing in the new one
+        for client_id in self.client_cursors:
+            self.client_cursors[client_id] = "1.0"
+        # the version doesn't move, so even a client at doc_ver may hold the old text
+        self.replay.reset(self.doc_ver + 1)
+        self.versions.reset(self.doc_ver, self.doc)
+        if self.crdt is not None:
+            # swap the replica's content too so peers pick up the new file as ops
+            text = "".join(self.doc)
+            self.crdt_bridge.outbox += self.crdt.delete(0, len(self.crdt.text())) + self.crdt.insert(0, text)
+            self.doc = self.new_doc(text_to_lines(text))
+
+    def append_text(self, text, client_id):
+        # a chunk of an import onto the end of the doc, as line inserts and splits in one batch
+        line, idx = len(self.doc), len(self.doc[-1])
+        edits = []
+        parts = text.split("\n")
+        for i, part in enumerate(parts):
+            if part:
+                edits.append((INSERT, line, idx, part))
+                idx += len(part)
+            if i < len(parts) - 1:
+                edits.append((SPLIT, line, idx, ""))
+                line, idx = line + 1, 0
+        return self.apply_edits(edits, client_id, "batch")
+
+    def stream_export(self, client_socket, ver, lines):
+        # runs on its own thread over a snapshot of the doc, so a slow reader only holds up
+        # itself and a paged doc is read page by page; each frame carries about EXPORT_CHUNK characters
+        seq, chunk, size = 0, [], 0
+        try:
+            for i, line in enumerate(lines):
+                chunk.append(line)
+                size += len(line)
+                if size >= EXPORT_CHUNK or i == len(lines) - 1:
+                    payload = {"ver": ver, "seq": seq, "lines": chunk, "done": i == len(lines) - 1}
+                    client_socket.sendall((f"EXPORT: {json.dumps(payload)}" + FRAME_END).encode())
+                    seq, chunk, size = seq + 1, [], 0
+        except OSError:
+            pass
+
+    def enable_crdt(self):
+        # keep a CRDT replica next to the line doc; plain clients keep editing lines and the bridge
+        # turns their edits into ops, while CRDT peers merge ops without the server transforming them
+        text = "".join(self.doc)
+        self.doc = self.new_doc(text_to_lines(text))
+        self.crdt = CRDTDocument(site=0)
+        self.crdt.insert(0, text)
+        self.crdt_bridge = CRDTBridge(self)
+        self.edit_listeners.append(self.crdt_bridge)
+
+    def apply_crdt_ops(self, ops, client_id):
+        changes = self.crdt.apply(ops)
+        # replay the visible result on the line doc without echoing it back into the replica
+        self.crdt_bridge.muted = True
+        try:
+            for change in changes:
+                self.apply_text_change(change, client_id)
+        finally:
+            self.crdt_bridge.muted = False
+        # pass the ops on to the other peers as they were, they integrate them themselves
+        self.crdt_bridge.outbox += ops
+        return bool(changes)
+
+    def apply_text_change(self, change, client_id):
+        kind, pos, payload = change
+        line, idx = offset_to_line(self.doc, pos)
+        if kind == "i":
+            parts = payload.split("\n")
+            for i, part in enumerate(parts):
+                if part:
+                    self.apply_edits([(INSERT, line, idx, part)], client_id, "batch")
+                    idx += len(part)
+                if i < len(parts) - 1:
+                    self.apply_edits([(SPLIT, line, idx, "")], client_id, "batch")
+                    line, idx = line + 1, 0
+        else:
+            remaining = payload
+            while remaining > 0 and line <= len(self.doc):
+                take = min(remaining, len(self.doc[line - 1].rstrip("\n")) - idx)
+                if take > 0:
+                    self.apply_edits([(DELETE, line, idx, take)], client_id, "batch")
+                    remaining -= take
+                if remaining > 0:
+                    # the deleted range runs through the line break
+                    self.apply_edits([(JOIN, line + 1, 0, 0)], client_id, "batch")
+                    remaining -= 1
+
+    def render_frame(self, cursor, viewport=None):
+        header = f"VERSION: {self.doc_ver}" + DELIMITER + f"CURSOR: {cursor}"
+        if viewport is None:
+            content = DELIMITER.join(self.doc)
+        else:
+            # only the requested lines, plus where they start and how long the doc is
+            first, count = clamp_viewport(*viewport, len(self.doc))
+            header += DELIMITER + f"RANGE: {first} {len(self.doc)}"
+            content = DELIMITER.join(self.doc[first - 1:first - 1 + count])
+        data = header + DELIMITER + content + FRAME_END
+        return data.encode()
+
+    def send_to(self, client_id, data, ver=None):
+        # every frame for an editor goes out here, counted so the admin channel can show how much
+        # each session was sent and how many versions behind the last one it got is
+        client_socket = self.clients.get(client_id)
+        if client_socket is None:
+            # gone from the editors (exported, subscribed, disconnected) while its ops were queued
+            return
+        client_socket.sendall(data)
+        traffic = self.traffic.setdefault(client_id, [0, self.doc_ver])
+        traffic[0] += len(data)
+        if ver is not None:
+            traffic[1] = ver
+
     def send_file(self, client_id):
+        self.send_to(client_id, self.render_frame(self.client_cursors[client_id], self.viewports.get(client_id)), self.doc_ver)
+
+    def send_line_count(self, client_id):
+        # an edit outside a client's viewport only changes what it knows about the doc's length
         header = f"VERSION: {self.doc_ver}" + DELIMITER + f"CURSOR: {self.client_cursors[client_id]}"
-        content = DELIMITER.join(self.doc)
-        data = header + DELIMITER + content
-        self.clients[client_id].sendall(data.encode())
+        data = header + DELIMITER + f"LINES: {len(self.doc)}" + FRAME_END
+        self.send_to(client_id, data.encode(), self.doc_ver)
+
+    def send_result(self, client_id, kind, payload):
+        # replies to queries travel as their own frame: "<KIND>: <json>"
+        data = f"{kind}: {json.dumps(payload)}" + FRAME_END
+        self.send_to(client_id, data.encode())
+
+    def caught_up(self, client_id):
+        # a result frame that brought the client to the current version, not just a doc frame
+        self.traffic.setdefault(client_id, [0, self.doc_ver])[1] = self.doc_ver
 
     def insert_char(self, line, idx, char, client_id):
+        # char may be a whole run of characters (undo/redo reinserts runs in one go)
         self.doc[line - 1] = self.doc[line - 1][:idx] + char + self.doc[line - 1][idx:]
-        self.client_cursors[client_id] = str(line) + "." + str(idx+1)
+        self.client_cursors[client_id] = str(line) + "." + str(idx+len(char))
 
         # adjust other clients cursors if they're on the same line after the insertion index
         for key in self.client_cursors.keys():
             l, i = self.client_cursors[key].split(".")
             if int(i) >= idx and key != client_id and int(l) == line:
-                self.client_cursors[key] = str(int(l)) + "." + str(int(i)+1)
+                self.client_cursors[key] = str(int(l)) + "." + str(int(i)+len(char))
 
     def do_enter(self, line, idx, client_id):
         self.doc.insert(line, "") # insert new line
@@ -109,7 +379,7 @@ class Server(object):
                     elif int(l) == line and int(i) > idx:
                         self.client_cursors[key] = str(int(l)+1) + "." + str((int(i))-len(self.doc[line-1])+1)
 
-    def remove_char(self, line, idx, client_id):
+    def remove_char(self, line, idx, client_id, count=1):
 
         # check if we're deleting a line break
         if idx < 0:
@@ -140,52 +410,376 @@ class Server(object):
                         self.client_cursors[key] = str(int(l)-1) + "." + str(previous_line_length+(int(i))-1)
         
         else:
-            # delete character at given index
-            self.doc[line - 1] = self.doc[line - 1][:idx] + self.doc[line - 1][idx + 1:]
+            # delete count characters starting at given index
+            self.doc[line - 1] = self.doc[line - 1][:idx] + self.doc[line - 1][idx + count:]
             self.client_cursors[client_id] = str(line) + "." + str(idx)
 
-            # adjust other clients cursors if they're on the same line after the deletion in dex
+            # adjust other clients cursors if they're on the same line after the deletion index
             for key in self.client_cursors.keys():
                 l, i = self.client_cursors[key].split(".")
-                if int(i) >= idx and key != client_id and int(l) == line:
-                    self.client_cursors[key] = str(int(l)) + "." + str(int(i)-1)
+                if int(i) > idx and key != client_id and int(l) == line:
+                    self.client_cursors[key] = str(int(l)) + "." + str(max(idx, int(i)-count))
+
+    def apply_edit(self, kind, line, idx, payload, client_id):
+        # apply one primitive edit and return its inverse as (kind, line, idx, text), or None for a no-op
+        if line < 1 or line > len(self.doc):
+            return None
+        if kind == INSERT:
+            self.insert_char(line, idx, payload, client_id)
+            return DELETE, line, idx, payload
+        if kind == DELETE:
+            # never eat the line break, that's what JOIN is for
+            content = self.doc[line - 1].rstrip("\n")
+            count = min(payload, len(content) - idx)
+            if idx < 0 or count <= 0:
+                return None
+            removed = content[idx:idx + count]
+            self.remove_char(line, idx, client_id, count)
+            return INSERT, line, idx, removed
+        if kind == SPLIT:
+            self.do_enter(line, idx, client_id)
+            return JOIN, line + 1, idx, ""
+        if kind == JOIN:
+            if line <= 1 or line > len(self.doc):
+                return None
+            previous_length = len(self.doc[line - 2]) - 1
+            self.remove_char(line, -1, client_id)
+            return SPLIT, line - 1, previous_length, ""
+
+    def record_edit(self, client_id, ver, inverse, source):
+        self.history.record(client_id, ver, inverse, source)
+        self.replay.record(ver, inverse)
+        self.versions.record(ver, inverse)
+        edit = forward_edit(inverse)
+        for listener in self.edit_listeners:
+            listener.on_edit(*edit)
+
+    def apply_edits(self, edits, client_id, source="edit"):
+        # apply a batch of primitive edits as a single version and record them for undo;
+        # returns the (kind, line, idx, n) edits that took effect, empty if nothing changed
+        ver = self.doc_ver + 1
+        if len(edits) > 1:
+            source = "batch"
+        applied = []
+        for kind, line, idx, payload in edits:
+            inverse = self.apply_edit(kind, line, idx, payload, client_id)
+            if inverse is not None:
+                self.record_edit(client_id, ver, inverse, source)
+                applied.append(forward_edit(inverse))
+        return applied
+
+    def clamp_position(self, line, idx):
+        line = min(max(1, line), len(self.doc))
+        return line, min(max(0, idx), len(self.doc[line - 1].rstrip("\n")))
+
+    def merge_ranges(self, ranges):
+        # [line, idx, end_line, end_idx] selections (carets are empty ones) clamped to the doc,
+        # overlapping ones merged, last in the doc first
+        spans = []
+        for l1, i1, l2, i2 in ranges:
+            start, end = sorted([self.clamp_position(int(l1), int(i1)), self.clamp_position(int(l2), int(i2))])
+            spans.append((start, end))
+        merged = []
+        for start, end in sorted(spans):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        return merged[::-1]
+
+    def range_edits(self, start, end):
+        # primitive edits deleting the text between two positions, against the current doc
+        (l1, i1), (l2, i2) = start, end
+        if l1 == l2:
+            return [(DELETE, l1, i1, i2 - i1)] if i2 > i1 else []
+        edits = [(DELETE, l2, 0, i2)] if i2 > 0 else []
+        for line in range(l2 - 1, l1, -1):
+            content = self.doc[line - 1].rstrip("\n")
+            if content:
+                edits.append((DELETE, line, 0, len(content)))
+        tail = len(self.doc[l1 - 1].rstrip("\n")) - i1
+        if tail > 0:
+            edits.append((DELETE, l1, i1, tail))
+        return edits + [(JOIN, l1 + 1, 0, 0)] * (l2 - l1)
+
+    def key_edits(self, key, line, idx):
+        # edits for one key at an empty caret, plus where the caret ends up
+        if key.lower() == "return":
+            return [(SPLIT, line, idx, "")], (line + 1, 0)
+        if key.lower() == "backspace":
+            if idx > 0:
+                start = cluster_start(self.doc[line - 1], idx)
+                return [(DELETE, line, start, idx - start)], (line, start)
+            if line > 1:
+                return [(JOIN, line, 0, 0)], (line - 1, len(self.doc[line - 2]) - 1)
+            return [], (line, idx)
+        if key.lower() == "delete":
+            if idx < len(self.doc[line - 1].rstrip("\n")):
+                return [(DELETE, line, idx, cluster_end(self.doc[line - 1], idx) - idx)], (line, idx)
+            if line < len(self.doc):
+                return [(JOIN, line + 1, 0, 0)], (line, idx)
+            return [], (line, idx)
+        text = {"space": " ", "tab": "\t"}.get(key.lower(), key)
+        return [(INSERT, line, idx, text)], (line, idx + len(text))
+
+    def multi_edit(self, client_id, ranges, key):
+        # one key at several carets or selections as one version and one undo group. Ranges are
+        # applied from the bottom of the doc up, so each one's positions are still valid when its
+        # turn comes, and every other cursor is moved once over the whole batch at the end.
+        # Returns the applied edits and the resulting carets in document order
+        ranges = self.merge_ranges(ranges)
+        cursors = self.client_cursors
+        # park the other cursors so the primitives don't each walk them
+        self.client_cursors = {client_id: cursors.get(client_id, "1.0")}
+        applied, carets = [], []
+        try:
+            if key.lower() in ("indent", "dedent"):
+                lines = sorted({line for start, end in ranges for line in range(start[0], end[0] + 1)}, reverse=True)
+                for line in lines:
+                    if key.lower() == "indent":
+                        applied += self.apply_edits([(INSERT, line, 0, INDENT)], client_id, "batch")
+                    else:
+                        content = self.doc[line - 1]
+                        width = 1 if content.startswith("\t") else len(content[:len(INDENT)]) - len(content[:len(INDENT)].lstrip(" "))
+                        if width:
+                            applied += self.apply_edits([(DELETE, line, 0, width)], client_id, "batch")
+                carets = [(end, 0) for start, end in ranges]
+            else:
+                for start, end in ranges:
+                    selected = start != end
+                    applied += self.apply_edits(self.range_edits(start, end), client_id, "batch")
+                    if selected and key.lower() in ("backspace", "delete"):
+                        carets.append((start, len(applied)))
+                        continue
+                    edits, caret = self.key_edits(key, *start)
+                    applied += self.apply_edits(edits, client_id, "batch")
+                    carets.append((caret, len(applied)))
+        finally:
+            self.client_cursors = cursors
+        # carets move with the edits at carets above them, which were applied after them
+        positions = []
+        for (line, idx), mark in carets:
+            for edit in applied[mark:]:
+                line, idx = transform_point(line, idx, *edit)
+            positions.append((line, idx))
+        positions.reverse()
+        for key_id, cursor in cursors.items():
+            if key_id != client_id:
+                line, idx = (int(n) for n in cursor.split("."))
+                for edit in applied:
+                    line, idx = transform_point(line, idx, *edit)
+                cursors[key_id] = f"{line}.{idx}"
+        if positions:
+            cursors[client_id] = f"{positions[0][0]}.{positions[0][1]}"
+        return applied, positions
+
+    def undo(self, client_id, source="undo"):
+        # pop the newest group for this client and apply it, rebased over everyone's later edits
+        if source == "undo":
+            group = self.history.pop_undo(client_id)
+        else:
+            group = self.history.pop_redo(client_id)
+        ver = self.doc_ver + 1
+        changed = False
+        for record in group:
+            # the group comes newest first, so its later edits are already undone and cancelled in
+            # the log by the time an earlier one is rebased: only edits made after the group count
+            edit = self.history.transform(record)
+            if edit is None:
+                continue
+            inverse = self.apply_edit(*edit, client_id)
+            if inverse is not None:
+                self.record_edit(client_id, ver, inverse, source)
+                self.history.cancel(record)
+                changed = True
+        return changed
 
     def process_op(self, op):
         opcode = op["opcode"]
         client_id = op["id"]
-        line = int(op["line"])
-        idx = int(op["idx"])
+
+        # session changes are queued like edits so only this thread touches client state
+        if opcode == "SESSION":
+            # a connection that authenticated: join the editors and hand it the token to resume with
+            if self.clients.get(client_id) is not op["socket"]:
+                self.clients[client_id] = op["socket"]
+                self.client_cursors.setdefault(client_id, "1.0")
+            old = self.tokens.pop(client_id, None)
+            self.sessions.pop(old, None)
+            self.sessions[op["token"]] = client_id
+            self.tokens[client_id] = op["token"]
+            self.send_result(client_id, "SESSION", {"id": client_id, "token": op["token"], "role": op["role"]})
+            return
+        if opcode == "SUBSCRIBE":
+            client_socket = self.clients.pop(client_id, None)
+            self.client_cursors.pop(client_id, None)
+            self.traffic.pop(client_id, None)
+            if client_socket is not None:
+                self.viewer_hub.add(client_id, client_socket, self.render_frame("1.0"))
+            return
+        if opcode == "DISCONNECT":
+            if self.clients.get(client_id) is not op["socket"]:
+                # the session was resumed under another id, or this was a viewer
+                client_id = next((key for key, sock in self.clients.items() if sock is op["socket"]), None)
+                if client_id is None:
+                    self.viewer_hub.remove(op["id"])
+                    self.replicas.pop(op["id"], None)
+                    return
+            self.clients.pop(client_id, None)
+            self.viewports.pop(client_id, None)
+            self.crdt_peers.discard(client_id)
+            self.highlighters.discard(client_id)
+            # keep the cursor (still moved along by other edits) and undo history a while in case
+            # the client comes back
+            self.departed[client_id] = None
+            if len(self.departed) > MAX_DEPARTED:
+                oldest = next(iter(self.departed))
+                del self.departed[oldest]
+                self.client_cursors.pop(oldest, None)
+                self.sessions.pop(self.tokens.pop(oldest, None), None)
+                self.traffic.pop(oldest, None)
+                self.history.forget(oldest)
+            return
+        if opcode == "REPLICATE":
+            # a standby server: it leaves the editors and follows the op stream from here on
+            client_socket = self.clients.pop(client_id, None)
+            self.client_cursors.pop(client_id, None)
+            self.traffic.pop(client_id, None)
+            if client_socket is not None:
+                self.replicas[client_id] = {"socket": client_socket, "sent": int(op["ver"]), "acked": None, "lag": None}
+                self.send_replication(client_id)
+            return
+        if opcode == "ACK":
+            replica = self.replicas.get(client_id)
+            if replica is not None:
+                replica["acked"] = op["ver"]
+                # round trip from sending the frame to hearing back, so clocks don't have to agree
+                replica["lag"] = time.time() - op["time"]
+            return
+        if opcode == "ADMIN":
+            self.admin_action(client_id, op["action"], op["reply"])
+            return
+        if opcode == "RESUME":
+            self.resume(client_id, int(op["prev_id"]), int(op["ver"]), op.get("resync", False))
+            return
+        if opcode == "RESYNC":
+            self.resync(client_id, op)
+            return
+        if opcode == "IMPORT":
+            # a file streamed in by transfer.py, one chunk per version; the first one empties the doc
+            if op.get("start"):
+                self.load_lines([""])
+            self.append_text(op["text"], client_id)
+            self.doc_ver += 1
+            self.send_result(client_id, "IMPORT", {"seq": op["seq"], "ver": self.doc_ver})
+            # everyone else catches up every so often instead of on every chunk
+            if op.get("done") or time.monotonic() - self.import_broadcast >= IMPORT_BROADCAST_INTERVAL:
+                self.import_broadcast = time.monotonic()
+                self.broadcast()
+            return
+        if opcode == "EXPORT":
+            # the connection leaves the editors and gets the doc as of now, streamed off this thread
+            client_socket = self.clients.pop(client_id, None)
+            self.client_cursors.pop(client_id, None)
+            self.traffic.pop(client_id, None)
+            if client_socket is not None:
+                threading.Thread(target=self.stream_export, args=(client_socket, self.doc_ver, snapshot(self.doc)),
+                                 daemon=True, name="export_thread").start()
+            return
+        if opcode == "HISTORY":
+            self.send_result(client_id, "HISTORY", self.history_query(op))
+            return
+        if opcode in ("FIND", "REPLACE_ALL"):
+            self.search(op)
+            return
+        if opcode in ("CRDT", "CRDT_SYNC"):
+            if self.crdt is None:
+                self.send_result(client_id, "CRDT", {"error": "server is not running the crdt engine"})
+                return
+            if self.apply_crdt_ops(op.get("ops", []), client_id):
+                self.doc_ver += 1
+            vector = {int(site): seq for site, seq in op.get("vector", {}).items()}
+            if "vector" in op:
+                # what the peer has applied, which tells gc() which tombstones it can drop
+                self.crdt.acknowledge(client_id, vector, op.get("epoch", 0))
+            if opcode == "CRDT_SYNC":
+                # a new or returning peer: hand it whatever its version vector is missing
+                self.crdt_peers.add(client_id)
+                self.send_result(client_id, "CRDT", {"ops": self.crdt.ops_since(vector), "epoch": self.crdt.epoch})
+            self.broadcast()
+            return
+        if opcode == "MULTI":
+            # the same key at many carets/selections, one version and one broadcast for all of them
+            applied, carets = self.multi_edit(client_id, op["ranges"], op["char"])
+            self.doc_ver += 1
+            self.send_result(client_id, "CARETS", {"carets": carets})
+            self.broadcast()
+            return
+        if opcode == "HIGHLIGHT":
+            # tokens for the whole doc once, then only the lines each version re-lexed
+            if op.get("on", True):
+                self.highlighters.add(client_id)
+                self.syntax.refresh(self.doc)
+                self.send_result(client_id, "TOKENS", {"ver": self.doc_ver, "full": True, "lines": list(self.syntax.spans)})
+            else:
+                self.highlighters.discard(client_id)
+            return
+        if opcode == "VIEWPORT":
+            # count 0 switches the client back to receiving the whole doc
+            if int(op["count"]) > 0:
+                self.viewports[client_id] = (int(op["first"]), int(op["count"]))
+            else:
+                self.viewports.pop(client_id, None)
+            self.crdt_peers.discard(client_id)
+            self.send_file(client_id)
+            return
+
+        # a client that hasn't seen the latest edits yet can point past the end of a line or the doc
+        line, idx = self.clamp_position(int(op["line"]), int(op["idx"]))
 
         if opcode == "MODIFY":
             print("Inserting character into the doc...")
             if op["char"].lower() not in ["return", "backspace", "space"]:
                 # insert normal characters
-                self.insert_char(line, idx, op["char"], client_id)
+                edit = (INSERT, line, idx, op["char"])
             if op["char"].lower() == "return":
                 # insert newline character
-                self.do_enter(line, idx, client_id)
+                edit = (SPLIT, line, idx, "")
             if op["char"].lower() == "space":
                 # insert space
-                self.insert_char(line, idx, " ", client_id)
+                edit = (INSERT, line, idx, " ")
             if op["char"].lower() == "backspace":
-                self.remove_char(line, idx-1, client_id)
+                # backspace at the start of a line removes the line break; elsewhere the whole
+                # character before the cursor, which may be several code points (emoji, accents)
+                if idx > 0:
+                    start = cluster_start(self.doc[line-1], idx)
+                    edit = (DELETE, line, start, idx - start)
+                else:
+                    edit = (JOIN, line, 0, 0)
+            self.apply_edits([edit], client_id)
             # increment version
             self.doc_ver += 1
             # send updated file to every client
-            for client_id in self.clients.keys():
-                print("Sending file to clients...")
-                self.send_file(client_id)
+            self.broadcast()
             print(self.doc)
 
+        elif opcode in ("UNDO", "REDO"):
+            if self.undo(client_id, opcode.lower()):
+                self.doc_ver += 1
+                self.broadcast()
+            else:
+                # nothing to undo, just resend so the client's view stays in sync
+                self.send_file(client_id)
+
         elif opcode == "CURSOR":
             match op["char"].lower():
                 case "left":
                     if idx > 0:
-                        idx -= 1
+                        idx = cluster_start(self.doc[line-1], idx)
                     self.client_cursors[client_id] = str(line) + "." + str(idx)
                 case "right":
                     if idx < len(self.doc[line-1]):
-                        idx += 1
+                        idx = cluster_end(self.doc[line-1], idx)
                     self.client_cursors[client_id] = str(line) + "." + str(idx)
                 case "up":
                     if line > 1:
@@ -202,11 +796,221 @@ class Server(object):
             print("Sending cursor status to client...")
             self.send_file(client_id)
 
+    def resume(self, client_id, prev_id, ver, resync=False):
+        if client_id not in self.clients:
+            return
+        if prev_id != client_id:
+            # the new connection takes over the previous session, cursor and undo history included.
+            # the connection handler already checked the token (or, without keys, trusts the id)
+            stale = self.clients.get(prev_id)
+            self.clients[prev_id] = self.clients.pop(client_id)
+            self.departed.pop(prev_id, None)
+            self.client_cursors.pop(client_id, None)
+            self.client_cursors.setdefault(prev_id, "1.0")
+            # traffic counts what went down the current connection
+            self.traffic[prev_id] = self.traffic.pop(client_id, [0, ver])
+            self.viewports.pop(prev_id, None)
+            self.crdt_peers.discard(prev_id)
+            self.highlighters.discard(prev_id)
+            if stale is not None:
+                # the server hadn't noticed the old connection drop yet
+                stale.close()
+            token = self.tokens.pop(client_id, None)
+            if token is not None:
+                # the token this connection authenticated with now names the resumed session
+                self.sessions.pop(self.tokens.pop(prev_id, None), None)
+                self.sessions[token] = prev_id
+                self.tokens[prev_id] = token
+            client_id = prev_id
+
+        edits = self.replay.since(ver) if ver <= self.doc_ver else None
+        if edits is None and resync and ver >= 0 and client_id not in self.viewports:
+            # the client holds a big doc, hashing it beats sending ours whole
+            self.send_result(client_id, "RESUME", {"id": client_id, "mode": "resync"})
+        elif edits is None or client_id in self.viewports:
+            # too far behind for the replay buffer, start over from a full frame
+            self.send_result(client_id, "RESUME", {"id": client_id, "mode": "snapshot"})
+            self.send_file(client_id)
+        else:
+            self.send_result(client_id, "RESUME", {"id": client_id, "mode": "delta", "from": ver, "to": self.doc_ver,
+                                                   "edits": edits, "cursor": self.client_cursors[client_id]})
+            self.caught_up(client_id)
+
+    def admin_action(self, client_id, action, reply):
+        # operator commands from the admin channel that write to a client, so they run here like
+        # everything else that does. The outcome goes back on the channel's reply queue
+        if client_id not in self.clients:
+            reply.put({"error": f"no connected client {client_id}"})
+            return
+        try:
+            if action == "snapshot":
+                self.send_file(client_id)
+            elif action == "resync":
+                # the client answers with its line hashes, as after a reconnect
+                self.send_result(client_id, "RESUME", {"id": client_id, "mode": "resync"})
+            elif action == "disconnect":
+                # its handler sees the connection end and queues the DISCONNECT; the session is
+                # kept for resuming like any dropped one
+                self.clients[client_id].shutdown(socket.SHUT_RDWR)
+        except OSError as e:
+            reply.put({"error": str(e)})
+            return
+        reply.put({"id": client_id, "action": action, "ver": self.doc_ver})
+
+    def resync(self, client_id, op):
+        # the client sent hashes of its copy of the doc and gets back only the lines that differ
+        if client_id in self.viewports:
+            self.send_file(client_id)
+            return
+        payload = {"ver": self.doc_ver, "cursor": self.client_cursors.get(client_id, "1.0")}
+        if op.get("root") == self.line_hashes.root(self.doc):
+            payload["same"] = True
+        else:
+            payload["ops"] = self.line_hashes.diff(self.doc, op.get("blocks", []))
+        self.send_result(client_id, "RESYNC", payload)
+        self.caught_up(client_id)
+
+    def history_query(self, op):
+        # {"ver": V} asks for the doc at V, {"from": V1, "to": V2} for a diff between two versions
+        oldest = self.versions.oldest()
+        try:
+            vers = [int(op["ver"])] if "ver" in op else [int(op["from"]), int(op["to"])]
+        except (KeyError, TypeError, ValueError):
+            return {"error": "give a version as ver, or two as from and to"}
+        if len(vers) == 1:
+            doc = self.versions.doc_at(vers[0])
+            if doc is not None:
+                return {"ver": vers[0], "doc": doc}
+        else:
+            diff = self.versions.diff(*vers)
+            if diff is not None:
+                return {"from": vers[0], "to": vers[1], "diff": diff}
+        return {"error": f"only versions {oldest} to {self.doc_ver} are kept" if oldest is not None else "no versions kept yet"}
+
+    def send_replication(self, replica_id):
+        # everything the standby lacks since the last frame it got, or the whole doc if the
+        # replay buffer no longer reaches back that far
+        replica = self.replicas[replica_id]
+        versions = self.replay.since(replica["sent"]) if replica["sent"] <= self.doc_ver else None
+        if versions is None:
+            kind, payload = "SNAPSHOT", {"ver": self.doc_ver, "doc": list(self.doc), "time": time.time()}
+        else:
+            kind, payload = "REPL", {"ver": self.doc_ver, "versions": versions, "time": time.time()}
+        replica["socket"].sendall((f"{kind}: {json.dumps(payload)}" + FRAME_END).encode())
+        replica["sent"] = self.doc_ver
+
+    def replicate(self):
+        for replica_id in list(self.replicas):
+            try:
+                self.send_replication(replica_id)
+            except OSError:
+                # the standby is gone, its handler queues the disconnect
+                self.replicas.pop(replica_id, None)
+
+    def replication_status(self):
+        # how far each standby is behind, in versions and in seconds
+        return {replica_id: {"acked": replica["acked"], "behind": None if replica["acked"] is None else self.doc_ver - replica["acked"],
+                             "lag": replica["lag"]}
+                for replica_id, replica in self.replicas.items()}
+
+    def search(self, op):
+        client_id = op["id"]
+        try:
+            rx = compile_pattern(op["pattern"], op.get("regex", False), op.get("case", True))
+        except re.error as e:
+            self.send_result(client_id, "FIND", {"pattern": op["pattern"], "error": str(e)})
+            return
+
+        if op["opcode"] == "FIND":
+            matches = self.search_index.find(self.doc, rx)
+            self.send_result(client_id, "FIND", {"pattern": op["pattern"], "ver": self.doc_ver, "matches": matches})
+            return
+
+        replacement = op.get("replacement", "")
+        if "\n" in replacement:
+            self.send_result(client_id, "FIND", {"pattern": op["pattern"], "error": "replacement can't contain line breaks"})
+            return
+        try:
+            edits, count = self.search_index.replace_edits(self.doc, rx, replacement, op.get("regex", False))
+        except (re.error, IndexError, ValueError) as e:
+            # bad group reference in the replacement template, or one that expands to a line break
+            self.send_result(client_id, "FIND", {"pattern": op["pattern"], "error": str(e)})
+            return
+        # every replacement lands as one version, one undo step and one broadcast
+        if self.apply_edits(edits, client_id):
+            self.doc_ver += 1
+            self.broadcast()
+        self.send_result(client_id, "FIND", {"pattern": op["pattern"], "ver": self.doc_ver, "replaced": count, "matches": []})
+
+    def broadcast(self):
+        self.versions.commit(self.doc_ver, self.doc)
+        for client_id in list(self.clients.keys()):
+            print("Sending file to clients...")
+            try:
+                viewport = self.viewports.get(client_id)
+                if client_id in self.crdt_peers:
+                    if self.crdt_bridge.outbox:
+                        self.send_result(client_id, "CRDT", {"ops": self.crdt_bridge.outbox, "epoch": self.crdt.epoch})
+                    self.caught_up(client_id)
+                elif viewport is not None and not self.change_tracker.touches(viewport):
+                    self.send_line_count(client_id)
+                else:
+                    self.send_file(client_id)
+            except OSError:
+                # the client's handler will queue its disconnect
+                pass
+        self.change_tracker.reset()
+        if self.highlighters:
+            self.send_tokens()
+        elif self.syntax.spans:
+            # nobody is highlighting any more, stop keeping tokens up to date
+            self.syntax.reset()
+        if self.crdt is not None:
+            self.crdt_bridge.outbox = []
+            if self.doc_ver % CRDT_GC_INTERVAL == 0:
+                self.crdt.gc()
+        # viewers get one shared frame; fanning it out happens off this thread
+        if len(self.viewer_hub):
+            self.viewer_hub.publish(self.doc_ver, self.render_frame("1.0"))
+        if self.replicas:
+            self.replicate()
+        if self.autosaver is not None:
+            self.autosaver.notify()
+
+    def send_tokens(self):
+        # re-lex only what this version touched and send highlighters just those lines
+        if self.syntax.refresh(self.doc):
+            payload = {"ver": self.doc_ver, "full": True, "lines": list(self.syntax.spans)}
+        else:
+            payload = dict(self.syntax.take_changes(), ver=self.doc_ver, full=False)
+        for client_id in list(self.highlighters):
+            try:
+                self.send_result(client_id, "TOKENS", payload)
+            except (OSError, KeyError):
+                self.highlighters.discard(client_id)
+
     def doc_updater(self):
         while True:
             if self.op_queue:
+                op = self.op_queue.get()
                 print("Processing operations...")
-                self.process_op(self.op_queue.get())
+                with self.data_lock:
+                    try:
+                        self.process_op(op)
+                    except Exception as e:
+                        # a malformed op (a missing field, a count that isn't a number) costs its
+                        # sender an error reply; letting it out would stop the server applying edits
+                        self.reject_op(op, e)
+                    self.ops_processed += 1
+
+    def reject_op(self, op, error):
+        print(f"Dropping {op.get('opcode')} from client {op.get('id')}: {error!r}")
+        traceback.print_exc()
+        try:
+            self.send_result(op.get("id"), "ERROR", {"opcode": op.get("opcode"), "error": f"malformed op: {error!r}"})
+        except OSError:
+            # its handler queues the disconnect
+            pass
 
 
 def main():
@@ -214,16 +1018,77 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("host", help="Server's IP address")
     parser.add_argument("port", help="Server's port number")
+    parser.add_argument("--undo-budget", type=int, default=DEFAULT_UNDO_BUDGET, help="Bytes of undo history kept per client")
+    parser.add_argument("--engine", choices=["server", "crdt"], default="server", help="Resolve edits on the server alone, or also merge CRDT ops from peers")
+    parser.add_argument("--replay-versions", type=int, default=DEFAULT_REPLAY_VERSIONS, help="Versions of edits kept for catching up reconnecting clients")
+    parser.add_argument("--rate-limit", type=float, default=DEFAULT_RATE, help="Ops per second each client can sustain (0 for no limit)")
+    parser.add_argument("--burst", type=int, default=DEFAULT_BURST, help="Ops a client can send at once before the rate limit applies")
+    parser.add_argument("--autosave", metavar="FILE", help="Load FILE if it exists and save the doc back to it in the background")
+    parser.add_argument("--autosave-delay", type=float, default=AUTOSAVE_DELAY, help="Seconds without edits before autosaving")
+    parser.add_argument("--standby-of", metavar="HOST:PORT", help="Follow this primary as a hot standby and take over when it goes away")
+    parser.add_argument("--primary-key", help="Key the standby authenticates to its primary with")
+    parser.add_argument("--checkpoint-every", type=int, default=DEFAULT_CHECKPOINT_EVERY, help="Versions between the doc checkpoints kept for history queries")
+    parser.add_argument("--max-checkpoints", type=int, default=DEFAULT_MAX_CHECKPOINTS, help="Checkpoints kept, older versions are forgotten")
+    parser.add_argument("--history-dir", metavar="DIR", help="Keep history checkpoints in DIR instead of in memory")
+    parser.add_argument("--memory-budget", type=float, metavar="MB", help="Keep about MB megabytes of the doc in memory and page the rest out to a scratch file")
+    parser.add_argument("--scratch-dir", metavar="DIR", help="Where the paged out doc and, without --history-dir, the history checkpoints go")
+    parser.add_argument("--auth", metavar="FILE", help="Require clients to authenticate with a key from FILE, one '<key> <read|write|admin>' per line")
+    parser.add_argument("--admin", metavar="PATH", help="Serve operator commands (sessions, stats, resync, save...) on a unix socket at PATH")
+    parser.add_argument("--profile", metavar="FILE", help="Profile from startup and write collapsed stacks to FILE on exit")
+    parser.add_argument("--profile-mode", choices=["timing", "sample"], default="timing", help="Time the hot methods, or sample every thread's stack")
     args = parser.parse_args()
 
     # define host ip and port
     HOST = args.host
     PORT = int(args.port)
 
-    server = Server(HOST, PORT)
+    history_dir = args.history_dir
+    memory_budget = None
+    scratch_history = None
+    if args.memory_budget is not None:
+        memory_budget = int(args.memory_budget * 1024 * 1024)
+        if history_dir is None:
+            # checkpoints held in memory would be whole copies of the doc
+            history_dir = scratch_history = tempfile.mkdtemp(prefix="history-", dir=args.scratch_dir)
+    if history_dir:
+        os.makedirs(history_dir, exist_ok=True)
+    server = Server(HOST, PORT, undo_budget=args.undo_budget, engine=args.engine, replay_versions=args.replay_versions,
+                    rate_limit=args.rate_limit, burst=args.burst, auth_keys=load_keys(args.auth) if args.auth else None,
+                    checkpoint_every=args.checkpoint_every, max_checkpoints=args.max_checkpoints, history_dir=history_dir,
+                    memory_budget=memory_budget, scratch_dir=args.scratch_dir)
+
+    if args.autosave:
+        if os.path.exists(args.autosave):
+            server.open_file(args.autosave)
+        server.enable_autosave(args.autosave, args.autosave_delay)
+
+    admin = None
+    if args.admin:
+        admin = AdminChannel(server, args.admin)
+        admin.start()
+
+    # SIGUSR1 toggles profiling on a running server; stopping writes the collapsed stacks out
+    profile_path = args.profile or "server_profile.folded"
+    profiler = Profiler(server, args.profile_mode)
+    if args.profile:
+        profiler.start()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.toggle(profile_path))
 
     # start a listener thread for the server
     try:
+        if args.standby_of:
+            # mirror the primary until it goes away, then carry on serving as the primary below;
+            # clients connecting meanwhile wait in the listen backlog
+            primary_host, primary_port = args.standby_of.rsplit(":", 1)
+            standby = Standby(server, primary_host, int(primary_port), key=args.primary_key)
+            standby.connect()
+            threading.Thread(target=standby.report, daemon=True, name="report_thread").start()
+            standby.follow()
+            print(f"Taking over as primary at version {server.doc_ver}")
+            server.search_index.reset()
+            server.syntax.reset()
+            server.line_hashes.reset()
         main_thread = threading.Thread(target=server.connection_listener, daemon=True, name="main_thread")
         updater_thread = threading.Thread(target=server.doc_updater, daemon=True, name="updater_thread")
         main_thread.start()
@@ -233,6 +1098,16 @@ def main():
     except KeyboardInterrupt:
         print("\nShutting down server...")
     finally:
+        if profiler.running:
+            profiler.stop()
+            profiler.dump(profile_path)
+        if server.autosaver is not None:
+            server.autosaver.stop()
+        if admin is not None:
+            admin.stop()
+        server.versions.flush()
+        if scratch_history is not None:
+            shutil.rmtree(scratch_history, ignore_errors=True)
         server.server_socket.close()
         print("Done.")
 
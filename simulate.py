@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import random
+import statistics
+import sys
+import time
+from history import apply_to_lines
+from server import Server
+
+DELIMITER = "\u001D"
+FRAME_END = "\u001E"
+
+# deterministic simulation of editors typing into one Server at once. Nothing touches the
+# network or the clock: the server's op handling runs in-process, frames and ops travel over
+# virtual links with seeded random latency, and connections get dropped and resumed. Each
+# scenario types for a while, lets the network drain and then checks every client ended up
+# with the server's doc and version. `python simulate.py --scenarios 1000` runs a batch; a
+# failing seed replays exactly with --seed.
+
+CLIENTS = 3
+STEPS = 20           # ops typed per scenario, across all clients
+THINK_TIME = 0.05    # SECONDS between an editor's keystrokes, on average
+LATENCY = 0.02       # SECONDS one way, on average
+JITTER = 0.03        # SECONDS of random extra latency per message
+DROP_RATE = 0.02     # chance each op also kills its connection
+RECONNECT_DELAY = 0.1
+KEYS = ["a", "b", "c", "space", "Return", "BackSpace", "BackSpace"]
+
+
+class Network(object):
+    # virtual time and an event queue. Links deliver in order, like TCP, but every message
+    # takes its own random time, so traffic on different links interleaves arbitrarily
+    def __init__(self, rng, latency=LATENCY, jitter=JITTER):
+        self.rng = rng
+        self.latency = latency
+        self.jitter = jitter
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+
+    def at(self, when, action):
+        self.seq += 1
+        heapq.heappush(self.events, (when, self.seq, action))
+
+    def deliver(self, link, action):
+        # a link's messages can't overtake each other
+        when = max(link.last, self.now + self.latency + self.rng.random() * self.jitter)
+        link.last = when
+        self.at(when, lambda: link.alive and action())
+
+    def run(self, until=None):
+        while self.events and (until is None or self.events[0][0] <= until):
+            self.now, seq, action = heapq.heappop(self.events)
+            action()
+        if until is not None:
+            self.now = max(self.now, until)
+
+
+class Link(object):
+    # one connection; dropping it loses whatever is still in flight both ways
+    def __init__(self):
+        self.alive = True
+        self.last = 0.0
+
+
+class SimSocket(object):
+    # the server's end of a connection, frames it sends go over the link to the client
+    def __init__(self, network, link, client):
+        self.network = network
+        self.link = link
+        self.client = client
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        if not self.link.alive:
+            raise OSError("connection dropped")
+        self.network.deliver(self.link, lambda: self.client.receive(data))
+
+    def close(self):
+        self.link.alive = False
+
+
+class SimClient(object):
+    # what client.Client does with frames, minus tk and threads
+    def __init__(self, sim, name):
+        self.sim = sim
+        self.name = name
+        self.doc = []
+        self.doc_version = 0
+        self.cursor = "1.0"
+        self.id = None
+        self.link = None
+        self.buffer = b""
+
+    def connect(self):
+        self.link = Link()
+        self.buffer = b""
+        prev_id = self.id
+        self.id = self.sim.accept(self)
+        if prev_id is not None:
+            # resumes under the old id; the server's connection handler does the same switch
+            ver = self.doc_version if self.doc else -1
+            self.send({"opcode": "RESUME", "prev_id": prev_id, "ver": ver})
+            self.id = prev_id
+
+    def drop(self):
+        self.link.alive = False
+        self.sim.disconnect(self)
+        self.sim.network.at(self.sim.network.now + RECONNECT_DELAY, self.connect)
+
+    def send(self, op):
+        op["id"] = self.id
+        self.sim.network.deliver(self.link, lambda: self.sim.process(op))
+
+    def receive(self, data):
+        self.buffer += data
+        *frames, self.buffer = self.buffer.split(FRAME_END.encode())
+        for frame in frames:
+            frame = frame.decode("utf-8")
+            if frame.startswith("VERSION: "):
+                fields = frame.split(DELIMITER)
+                self.doc_version = int(fields[0][len("VERSION: "):])
+                self.cursor = fields[1][len("CURSOR: "):]
+                self.doc = fields[2:]
+                self.sim.observe(self.doc_version)
+                continue
+            kind, payload = frame.split(": ", 1)
+            payload = json.loads(payload)
+            if kind == "RESUME" and payload["mode"] == "delta" and self.doc_version == payload["from"]:
+                for ver, edits in payload["edits"]:
+                    for edit in edits:
+                        apply_to_lines(self.doc, edit)
+                self.doc_version = payload["to"]
+                self.cursor = payload["cursor"]
+                self.sim.observe(self.doc_version)
+
+    def type(self, rng):
+        # one random keystroke somewhere in the doc as this client last saw it
+        line = rng.randint(1, max(1, len(self.doc)))
+        text = self.doc[line - 1].rstrip("\n") if self.doc else ""
+        idx = rng.randint(0, len(text))
+        roll = rng.random()
+        if roll < 0.75:
+            op = {"opcode": "MODIFY", "char": rng.choice(KEYS)}
+        elif roll < 0.85:
+            op = {"opcode": rng.choice(["UNDO", "REDO"]), "char": ""}
+        elif roll < 0.95:
+            op = {"opcode": "CURSOR", "char": rng.choice(["Left", "Right", "Up", "Down"])}
+        else:
+            op = {"opcode": "MULTI", "char": rng.choice(KEYS + ["Indent", "Dedent"]),
+                  "ranges": [[line, idx, line, idx], [rng.randint(1, max(1, len(self.doc))), 0] * 2]}
+        op.update({"line": str(line), "idx": str(idx), "ver": self.doc_version})
+        self.send(op)
+
+
+class Simulation(object):
+    def __init__(self, seed, clients=CLIENTS, steps=STEPS, drop_rate=DROP_RATE, doc=None):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.steps = steps
+        self.drop_rate = drop_rate
+        self.network = Network(self.rng)
+        self.server = Server("127.0.0.1", 0)
+        self.server.server_socket.close()
+        self.server.doc = list(doc) if doc is not None else ["hello\n", "world"]
+        self.next_id = 0
+        self.sockets = {}
+        self.produced = {0: 0.0} # doc version -> virtual time the server made it
+        self.latencies = []
+        self.clients = [SimClient(self, f"c{i}") for i in range(clients)]
+
+    def accept(self, client):
+        # what connection_listener does for a new connection, and the greeting's frame
+        self.next_id += 1
+        sock = SimSocket(self.network, client.link, client)
+        self.sockets[client] = sock
+        self.server.clients[self.next_id] = sock
+        self.server.client_cursors[self.next_id] = "1.0"
+        self.server.send_file(self.next_id)
+        return self.next_id
+
+    def disconnect(self, client):
+        # the handler notices a moment later and queues the disconnect
+        op = {"opcode": "DISCONNECT", "id": client.id, "socket": self.sockets[client]}
+        self.network.at(self.network.now + self.network.latency, lambda: self.process(op))
+
+    def process(self, op):
+        ver = self.server.doc_ver
+        with self.server.data_lock:
+            self.server.process_op(op)
+        if self.server.doc_ver != ver:
+            self.produced[self.server.doc_ver] = self.network.now
+
+    def observe(self, ver):
+        produced = self.produced.get(ver)
+        if produced is not None:
+            self.latencies.append(self.network.now - produced)
+
+    def editor(self, client, remaining):
+        if remaining[0] <= 0:
+            return
+        remaining[0] -= 1
+        if client.link.alive:
+            client.type(self.rng)
+            if self.rng.random() < self.drop_rate:
+                client.drop()
+        self.network.at(self.network.now + self.rng.expovariate(1 / THINK_TIME), lambda: self.editor(client, remaining))
+
+    def run(self):
+        # returns a list of what didn't converge, empty if every client matches the server
+        for client in self.clients:
+            client.connect()
+        remaining = [self.steps]
+        for client in self.clients:
+            self.network.at(self.rng.random() * THINK_TIME, lambda client=client: self.editor(client, remaining))
+        self.network.run()
+        problems = []
+        for client in self.clients:
+            if client.doc != self.server.doc or client.doc_version != self.server.doc_ver:
+                problems.append(f"seed {self.seed}: {client.name} has version {client.doc_version} {client.doc!r}, "
+                                f"server has {self.server.doc_ver} {self.server.doc!r}")
+        return problems
+
+
+def run_batch(seeds, **options):
+    # (failures, convergence latencies in SECONDS of virtual time, wall seconds)
+    failures, latencies = [], []
+    start = time.perf_counter()
+    # the server narrates every op on stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        for seed in seeds:
+            sim = Simulation(seed, **options)
+            try:
+                failures += sim.run()
+            except Exception as e:
+                failures.append(f"seed {seed}: {type(e).__name__}: {e}")
+            latencies += sim.latencies
+    return failures, latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", type=int, default=1000, help="How many seeded scenarios to run")
+    parser.add_argument("--seed", type=int, help="Run just this scenario")
+    parser.add_argument("--clients", type=int, default=CLIENTS, help="Editors per scenario")
+    parser.add_argument("--steps", type=int, default=STEPS, help="Ops typed per scenario")
+    parser.add_argument("--drop-rate", type=float, default=DROP_RATE, help="Chance an op also drops its connection")
+    args = parser.parse_args()
+
+    seeds = [args.seed] if args.seed is not None else range(args.scenarios)
+    failures, latencies, elapsed = run_batch(seeds, clients=args.clients, steps=args.steps, drop_rate=args.drop_rate)
+    for failure in failures[:20]:
+        print(failure)
+    latencies.sort()
+    print(f"{len(seeds)} scenarios in {elapsed:.2f}s ({len(seeds) / elapsed:.0f}/s), {len(failures)} failed")
+    if latencies:
+        print(f"convergence latency: mean {statistics.fmean(latencies) * 1000:.1f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms (virtual)")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import pytest
+import json
+import socket
+import threading
+import time
+from server import Server
+from client import Client
+from admin import AdminChannel
+
+
+class TestAdmin:
+    """Tests for the admin control channel"""
+
+    @pytest.fixture
+    def server_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        return port
+
+    @pytest.fixture
+    def admin(self, server_port, tmp_path):
+        """A running server with its admin socket in tmp_path"""
+        server = Server('127.0.0.1', server_port)
+        server.doc = ["hello world\n", "line two"]
+        threading.Thread(target=server.connection_listener, daemon=True).start()
+        threading.Thread(target=server.doc_updater, daemon=True).start()
+        admin = AdminChannel(server, str(tmp_path / "admin.sock"))
+        admin.start()
+        time.sleep(0.1)
+
+        yield admin
+
+        admin.stop()
+        server.server_socket.close()
+
+    def ask(self, admin, *commands):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(admin.path)
+            with sock.makefile("rw", encoding="utf-8") as f:
+                replies = []
+                for command in commands:
+                    f.write(command + "\n")
+                    f.flush()
+                    replies.append(json.loads(f.readline()))
+        return replies
+
+    def test_sessions_and_stats(self, admin, server_port):
+        """Test that sessions show bytes sent and lag, and stats count processed ops"""
+        client = Client('127.0.0.1', server_port)
+        threading.Thread(target=client.receive_file, daemon=True).start()
+        time.sleep(0.2)
+        client.send({"opcode": "MODIFY", "line": "1", "idx": "0", "char": "X", "ver": 0, "id": client.id})
+        time.sleep(0.3)
+
+        sessions, stats = self.ask(admin, "sessions", "stats")
+
+        assert sessions["ver"] == 1
+        session, = sessions["sessions"]
+        assert session["id"] == client.id and session["connected"]
+        assert session["bytes"] > len("hello world\n")
+        assert session["lag"] == 0
+        assert stats["ver"] == 1 and stats["lines"] == 2
+        assert stats["ops"] >= 1 and stats["queue"] == 0
+        assert stats["clients"] == 1
+
+        client.close()
+
+    def test_client_actions(self, admin, server_port):
+        """Test forcing a snapshot and a resync, then disconnecting a client that resumes"""
+        client = Client('127.0.0.1', server_port)
+        threading.Thread(target=client.receive_file, daemon=True).start()
+        time.sleep(0.2)
+
+        # a new connection has no doc until something is sent to it
+        snapshot, = self.ask(admin, f"snapshot {client.id}")
+        time.sleep(0.2)
+        with client.lock:
+            assert client.doc == admin.server.doc
+            client.doc[0] = "drifted\n"
+        resync, = self.ask(admin, f"resync {client.id}")
+        time.sleep(0.3)
+        with client.lock:
+            assert client.doc == admin.server.doc
+        client_id = client.id
+        disconnect, = self.ask(admin, f"disconnect {client_id}")
+        time.sleep(1.0)
+
+        assert snapshot == {"id": client_id, "action": "snapshot", "ver": 0}
+        assert resync["action"] == "resync" and disconnect["action"] == "disconnect"
+        # the client came back and resumed its session
+        assert client.id == client_id and client_id in admin.server.clients
+
+        client.close()
+
+    def test_save_and_errors(self, admin, tmp_path):
+        """Test saving to a file, and the replies to bad commands"""
+        replies = self.ask(admin, f"save {tmp_path / 'out.txt'}", "save", "snapshot 12345", "snapshot x", "reboot")
+
+        assert replies[0]["saved"] == str(tmp_path / "out.txt")
+        assert (tmp_path / "out.txt").read_text() == "hello world\nline two"
+        assert "error" in replies[1]
+        assert replies[2] == {"error": "no connected client 12345"}
+        assert "error" in replies[3] and "error" in replies[4]
+
+    def test_only_replaces_a_stale_socket(self, tmp_path):
+        """Test that a leftover socket is replaced but any other file at the path is left alone"""
+        path = tmp_path / "admin.sock"
+        path.write_text("not a socket")
+        with pytest.raises(FileExistsError):
+            AdminChannel(None, str(path))
+        assert path.read_text() == "not a socket"
+
+        path.unlink()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(str(path))
+        stale.close()
+        admin = AdminChannel(None, str(path))
+        admin.stop()
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from server import Server
+from autosave import Autosaver, write_atomic
+
+
+def make_server(doc):
+    server = Server.__new__(Server)
+    server.doc = doc
+    server.doc_ver = 0
+    server.data_lock = threading.Lock()
+    return server
+
+
+class TestAutosave:
+    """Unit tests for the background autosaver"""
+
+    def test_write_atomic_replaces_file(self, tmp_path):
+        """Test that an atomic write swaps the whole file and leaves no temp files"""
+        path = tmp_path / "doc.txt"
+        path.write_text("old\n")
+        write_atomic(str(path), ["new\n", "text"])
+        assert path.read_text() == "new\ntext"
+        assert os.listdir(tmp_path) == ["doc.txt"]
+
+    def test_saves_only_new_versions(self, tmp_path):
+        """Test that save() skips an unchanged doc_ver"""
+        path = tmp_path / "doc.txt"
+        server = make_server(["hello"])
+        saver = Autosaver(server, str(path))
+        assert not saver.save()
+        assert not path.exists()
+
+        server.doc_ver = 1
+        assert saver.save()
+        assert path.read_text() == "hello"
+        assert not saver.save()
+
+    def test_debounces_bursts(self, tmp_path):
+        """Test that a burst of versions is written once, after the edits pause"""
+        path = tmp_path / "doc.txt"
+        server = make_server(["a"])
+        saver = Autosaver(server, str(path), delay=0.1, max_delay=5)
+        saves = []
+        original = saver.save
+        saver.save = lambda: saves.append(server.doc_ver) or original()
+        saver.start()
+        for ver in range(1, 6):
+            server.doc_ver = ver
+            server.doc[0] += "a"
+            saver.notify()
+            time.sleep(0.02)
+        assert saves == []
+
+        time.sleep(0.3)
+        assert saves == [5]
+        assert path.read_text() == "aaaaaa"
+        saver.stop()
+
+    def test_stop_flushes(self, tmp_path):
+        """Test that stopping writes out an edit still waiting for its delay"""
+        path = tmp_path / "doc.txt"
+        server = make_server(["x"])
+        saver = Autosaver(server, str(path), delay=60)
+        saver.start()
+        server.doc_ver = 1
+        saver.notify()
+        saver.stop()
+        assert path.read_text() == "x"
@@ -0,0 +1,29 @@
+from bench import fit_slope, report, make_server, case_process_op, measure
+
+
+class TestBench:
+    """Unit tests for the benchmark harness itself"""
+
+    def test_fit_slope(self):
+        """Test that the log-log slope recovers the exponent"""
+        sizes = [10, 100, 1000]
+        assert abs(fit_slope(sizes, [5e-6] * 3)) < 1e-9
+        assert abs(fit_slope(sizes, [n * 1e-6 for n in sizes]) - 1) < 1e-9
+        assert abs(fit_slope(sizes, [n * n * 1e-9 for n in sizes]) - 2) < 1e-9
+
+    def test_report_flags_regressions(self):
+        """Test that a case over its complexity budget is reported as a failure"""
+        results = {("insert_char", "lines"): [(n, [n * n * 1e-9] * 3) for n in (10, 100, 1000)],
+                   ("send_file", "lines"): [(n, [n * 1e-6] * 3) for n in (10, 100, 1000)]}
+        lines, failures = report(results)
+        assert [(case, axis) for case, axis, slope, budget in failures] == [("insert_char", "lines")]
+        assert any("REGRESSION" in line for line in lines)
+
+    def test_cases_run(self, capsys):
+        """Test that a benchmark case really edits and broadcasts"""
+        func, restore = case_process_op(lines=10, line_length=4, clients=2)
+        times = measure(func, rounds=5)
+        assert len(times) >= 5
+        server = make_server(lines=3, line_length=2, clients=2)
+        assert server.doc == ["xx\n", "xx\n", "xx"]
+        assert server.client_cursors == {1: "1.0", 2: "2.0"}
@@ -0,0 +1,37 @@
+from columns import ColumnMap, cluster_start, cluster_end
+
+
+class TestColumns:
+    """Unit tests for grapheme clusters and tk column conversion"""
+
+    def test_clusters(self):
+        """Test that combining marks, ZWJ sequences, modifiers and flags stay whole"""
+        family = "\U0001f468\u200d\U0001f469\u200d\U0001f467"
+        text = "a" + "e\u0301" + family + "\U0001f44d\U0001f3fd" + "\U0001f1e9\U0001f1ea\U0001f1eb\U0001f1f7" + "z"
+        bounds = [0]
+        while bounds[-1] < len(text):
+            bounds.append(cluster_end(text, bounds[-1]))
+        assert [text[a:b] for a, b in zip(bounds, bounds[1:])] == [
+            "a", "e\u0301", family, "\U0001f44d\U0001f3fd", "\U0001f1e9\U0001f1ea", "\U0001f1eb\U0001f1f7", "z"]
+        for a, b in zip(bounds, bounds[1:]):
+            assert cluster_start(text, b) == a
+        assert cluster_start("abc", 2) == 1 and cluster_end("abc", 3) == 3
+
+    def test_columns_round_trip(self):
+        """Test code point <-> tk column conversion where emoji take two columns"""
+        columns = ColumnMap(astral_width=2)
+        text = "a\U0001f600b中\U0001f600\n"
+
+        assert [columns.to_column(text, i) for i in range(len(text) + 1)] == [0, 1, 3, 4, 5, 7, 8]
+        assert [columns.to_index(text, c) for c in range(9)] == [0, 1, 1, 2, 3, 4, 4, 5, 6]
+        # past the end keeps counting, like tk clamping later
+        assert columns.to_index(text, 10) == 8 and columns.to_column(text, 8) == 10
+
+    def test_plain_lines_need_no_table(self):
+        """Test that ASCII and BMP-only lines convert as identity without caching anything"""
+        columns = ColumnMap(astral_width=2)
+
+        assert columns.to_column("hello", 3) == 3
+        assert columns.to_index("中文 text", 2) == 2
+        assert columns.tables == {"中文 text": None}
+        assert ColumnMap(astral_width=1).to_index("\U0001f600x", 1) == 1
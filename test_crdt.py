@@ -0,0 +1,131 @@
+import random
+from crdt import CRDTDocument, text_to_lines, offset_to_line, line_offset
+
+
+class TestCRDT:
+    """Unit tests for the sequence CRDT"""
+
+    def sync(self, *peers):
+        """Deliver every peer's full state to every other peer"""
+        for peer in peers:
+            for other in peers:
+                if other is not peer:
+                    other.apply(peer.ops_since(other.version()))
+
+    def test_local_edits(self):
+        """Test that inserts and deletes produce the expected text"""
+        doc = CRDTDocument(site=1)
+        doc.insert(0, "hello world")
+        doc.delete(5, 6)
+        doc.insert(5, "!")
+
+        assert doc.text() == "hello!"
+
+    def test_typing_stays_one_run(self):
+        """Test that sequential typing is stored as a single run"""
+        doc = CRDTDocument(site=1)
+        for i, char in enumerate("the quick brown fox"):
+            doc.insert(i, char)
+
+        assert len(doc.items) == 1
+        assert doc.stats()["chars"] == 19
+
+    def test_concurrent_inserts_converge(self):
+        """Test that concurrent inserts at the same place merge the same way everywhere"""
+        a, b = CRDTDocument(site=1), CRDTDocument(site=2)
+        b.apply(a.insert(0, "ac"))
+        ops_a = a.insert(1, "X")
+        ops_b = b.insert(1, "Y")
+
+        a.apply(ops_b)
+        b.apply(ops_a)
+
+        assert a.text() == b.text()
+        assert sorted(a.text()) == sorted("acXY")
+
+    def test_out_of_order_ops_wait_for_dependencies(self):
+        """Test that an op arriving before its origin is parked and applied later"""
+        a, b = CRDTDocument(site=1), CRDTDocument(site=2)
+        first = a.insert(0, "ab")
+        second = a.insert(1, "Z")
+
+        assert b.apply(second) == []
+        assert b.pending
+        b.apply(first)
+
+        assert b.text() == "aZb"
+        assert not b.pending
+
+    def test_offline_peer_syncs_later(self):
+        """Test that a peer editing offline catches up through version vectors"""
+        a, b = CRDTDocument(site=1), CRDTDocument(site=2)
+        b.apply(a.insert(0, "shared\n"))
+        offline = b.insert(7, "from b")
+        a.insert(0, "from a ")
+        a.delete(7, 1)
+
+        a.apply(offline)
+        b.apply(a.ops_since(b.version()))
+
+        assert a.text() == b.text() == "from a hared\nfrom b"
+
+    def test_tombstones_drop_text_and_merge(self):
+        """Test that deleted runs keep no text and fold back into one run"""
+        doc = CRDTDocument(site=1)
+        doc.insert(0, "abcdefgh")
+        doc.delete(2, 1)
+        doc.delete(2, 1)
+        doc.delete(2, 1)
+
+        tombstones = [item for item in doc.items if item.text is None]
+        assert sum(item.length for item in tombstones) == 3
+        doc.gc()
+        assert [item.text for item in doc.items] == ["ab", None, "fgh"] # "fgh" was inserted after it
+
+    def test_gc_drops_acknowledged_tombstones(self):
+        """Test that tombstones are dropped once every peer has acknowledged their deletion"""
+        doc, peer = CRDTDocument(site=1), CRDTDocument(site=2)
+        peer.apply(doc.insert(0, "abcdefgh"))
+        doc.acknowledge(2, peer.version(), 0)
+        deletes = doc.delete(5, 3)
+
+        doc.gc()
+        assert doc.stats()["tombstones"] == 1 # the peer hasn't seen it deleted yet
+        peer.apply(deletes)
+        doc.acknowledge(2, peer.version(), doc.epoch)
+        doc.gc()
+        assert doc.stats()["tombstones"] == 0
+        assert doc.text() == peer.text() == "abcde"
+
+        # a late copy of the delete, and a new peer catching up, still work without it
+        assert doc.apply(deletes) == []
+        late = CRDTDocument(site=3)
+        late.apply(doc.ops_since({}))
+        assert late.text() == "abcde"
+
+    def test_random_concurrent_editing_converges(self):
+        """Test convergence of three peers under random concurrent edits"""
+        rng = random.Random(42)
+        peers = [CRDTDocument(site=i) for i in (1, 2, 3)]
+        for _ in range(50):
+            for peer in peers:
+                text = peer.text()
+                if text and rng.random() < 0.3:
+                    pos = rng.randrange(len(text))
+                    peer.delete(pos, rng.randint(1, 3))
+                else:
+                    peer.insert(rng.randint(0, len(text)), rng.choice(["a", "bc", "\n", "xyz"]))
+            if rng.random() < 0.4:
+                self.sync(*peers)
+        self.sync(*peers)
+        self.sync(*peers)
+
+        assert peers[0].text() == peers[1].text() == peers[2].text()
+
+    def test_line_helpers(self):
+        """Test conversions between flat offsets and the server's lines"""
+        doc = text_to_lines("ab\ncd\n")
+        assert doc == ["ab\n", "cd\n", ""]
+        assert offset_to_line(doc, 3) == (2, 0)
+        assert offset_to_line(doc, 6) == (3, 0)
+        assert line_offset(doc, 2, 1) == 4
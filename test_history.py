@@ -0,0 +1,103 @@
+from history import UndoHistory, EditLog, ReplayBuffer, apply_to_lines, transform_point, INSERT, DELETE, SPLIT, JOIN, RECORD_OVERHEAD
+
+class TestHistory:
+    """Unit tests for the compact undo history"""
+
+    def test_typed_chars_merge_into_one_record(self):
+        """Test that consecutive single-char inserts collapse into one run"""
+        history = UndoHistory()
+        for i, char in enumerate("hello"):
+            history.record(1, i + 1, (DELETE, 1, i, char))
+
+        stack = history.undo_stacks[1]
+        assert len(stack) == 1
+        assert stack.texts[-1] == "hello"
+
+    def test_backspaces_merge_into_one_record(self):
+        """Test that consecutive backspaces collapse into one reinsertion"""
+        history = UndoHistory()
+        history.record(1, 1, (INSERT, 1, 4, "o"))
+        history.record(1, 2, (INSERT, 1, 3, "l"))
+
+        group = history.pop_undo(1)
+        assert len(group) == 1
+        assert history.transform(group[0]) == (INSERT, 1, 3, "lo")
+
+    def test_interleaved_edit_breaks_run(self):
+        """Test that another client's edit in between starts a new record"""
+        history = UndoHistory()
+        history.record(1, 1, (DELETE, 1, 0, "a"))
+        history.record(2, 2, (DELETE, 2, 0, "z"))
+        history.record(1, 3, (DELETE, 1, 1, "b"))
+
+        assert len(history.undo_stacks[1]) == 2
+
+    def test_budget_evicts_oldest(self):
+        """Test that the per-client budget drops the oldest records first"""
+        history = UndoHistory(budget=3 * (RECORD_OVERHEAD + 1))
+        for i in range(10):
+            history.record(1, i + 1, (SPLIT, i + 1, 0, ""))
+            history.record(1, i + 1, (DELETE, 1, 0, "x"))
+
+        stack = history.undo_stacks[1]
+        assert len(stack) <= 3
+        assert stack.size <= history.budget
+        assert stack.vers[-1] == 10
+
+    def test_log_eviction_invalidates_old_records(self):
+        """Test that records older than the retained log are discarded"""
+        history = UndoHistory(log_limit=4)
+        history.record(1, 1, (DELETE, 1, 0, "a"))
+        for i in range(10):
+            history.record(2, i + 2, (DELETE, 2, i, "b"))
+
+        assert history.pop_undo(1) == []
+
+    def test_transform_point_across_split_and_join(self):
+        """Test position transforms across line breaks"""
+        assert transform_point(1, 7, SPLIT, 1, 5, 0) == (2, 2)
+        assert transform_point(3, 1, SPLIT, 1, 5, 0) == (4, 1)
+        assert transform_point(2, 2, JOIN, 2, 5, 0) == (1, 7)
+        assert transform_point(1, 5, INSERT, 1, 5, 3, stick_left=True) == (1, 5)
+
+    def test_edit_log_compacts(self):
+        """Test that the edit log stays bounded and keeps sequence numbers stable"""
+        log = EditLog(limit=100)
+        for i in range(1000):
+            seq = log.append(INSERT, 1, 0, 1)
+        assert seq == 999
+        assert len(log.kinds) <= 200
+        assert log.covers(998)
+        assert not log.covers(10)
+
+    def test_replay_buffer_replays_edits(self):
+        """Test that replayed edits rebuild the doc from an older copy"""
+        before = ["hello\n", "world"]
+        after = list(before)
+        buffer = ReplayBuffer()
+        # inverse records as the server stores them
+        apply_to_lines(after, (INSERT, 1, 5, "!"))
+        buffer.record(1, (DELETE, 1, 5, "!"))
+        apply_to_lines(after, (SPLIT, 2, 2, ""))
+        buffer.record(2, (JOIN, 3, 2, ""))
+        apply_to_lines(after, (DELETE, 1, 0, 2))
+        buffer.record(2, (INSERT, 1, 0, "he"))
+        apply_to_lines(after, (JOIN, 2, 0, 0))
+        buffer.record(3, (SPLIT, 1, 4, ""))
+
+        for ver, edits in buffer.since(0):
+            for edit in edits:
+                apply_to_lines(before, edit)
+        assert before == after == ["llo!wo\n", "rld"]
+        assert [ver for ver, edits in buffer.since(1)] == [2, 3]
+
+    def test_replay_buffer_is_bounded(self):
+        """Test that versions older than the buffer can no longer be replayed"""
+        buffer = ReplayBuffer(max_versions=3)
+        for ver in range(1, 11):
+            buffer.record(ver, (DELETE, 1, 0, "x"))
+        assert buffer.since(6) is None
+        assert len(buffer.since(7)) == 3
+        buffer.reset(10)
+        assert buffer.since(9) is None
+        assert buffer.since(10) == []
@@ -3,8 +3,14 @@ import socket
 import threading
 import time
 import json
+import os
+import queue
+import subprocess
+import sys
 from server import Server
 from client import Client
+from relay import Relay
+from transfer import Transfer
 
 DELIMITER = "\u001D"
 
@@ -48,7 +54,7 @@ class TestIntegration:
         assert isinstance(client.id, int)
         assert client.id in running_server.clients
 
-        client.client_socket.close()
+        client.close()
 
     def test_client_receives_initial_doc(self, running_server, server_port):
         """Test that client receives the initial document"""
@@ -68,7 +74,7 @@ class TestIntegration:
             assert client.doc == running_server.doc
             assert client.doc_version == running_server.doc_ver
 
-        client.client_socket.close()
+        client.close()
 
     def test_client_sends_operation(self, running_server, server_port):
         """Test that client can send an operation that server processes"""
@@ -102,7 +108,7 @@ class TestIntegration:
         assert running_server.doc[0].startswith("X")
         assert running_server.doc_ver == initial_doc_ver + 1
 
-        client.client_socket.close()
+        client.close()
 
     def test_multiple_clients_sync(self, running_server, server_port):
         """Test that multiple clients stay synchronized"""
@@ -148,8 +154,8 @@ class TestIntegration:
         assert ver1 == ver2
         assert doc1[0].startswith("A")
 
-        client1.client_socket.close()
-        client2.client_socket.close()
+        client1.close()
+        client2.close()
 
     def test_cursor_synchronization(self, running_server, server_port):
         """Test that cursor positions are tracked for multiple clients"""
@@ -185,8 +191,8 @@ class TestIntegration:
         # Client 2's cursor should not have changed
         assert running_server.client_cursors[client2.id] == "1.0"
 
-        client1.client_socket.close()
-        client2.client_socket.close()
+        client1.close()
+        client2.close()
 
     def test_insert_updates_other_cursors_integration(self, running_server, server_port):
         """Test that when one client inserts, other cursors are updated"""
@@ -222,8 +228,8 @@ class TestIntegration:
         # Client 2's cursor should have moved forward
         assert running_server.client_cursors[client2.id] == "1.6"
 
-        client1.client_socket.close()
-        client2.client_socket.close()
+        client1.close()
+        client2.close()
 
     def test_backspace_line_break(self, running_server, server_port):
         """Test backspace at start of line (removing line break)"""
@@ -254,7 +260,7 @@ class TestIntegration:
         # Document should have one less line
         assert len(running_server.doc) == initial_doc_length - 1
 
-        client.client_socket.close()
+        client.close()
 
     def test_enter_key(self, running_server, server_port):
         """Test enter/return key creates new line"""
@@ -287,7 +293,7 @@ class TestIntegration:
         # First line should end with newline
         assert running_server.doc[0].endswith("\n")
 
-        client.client_socket.close()
+        client.close()
 
     def test_sequence_of_operations(self, running_server, server_port):
         """Test a realistic sequence of typing operations"""
@@ -354,7 +360,361 @@ class TestIntegration:
 
         assert running_server.doc[0] == "hello world"
 
-        client.client_socket.close()
+        client.close()
+
+    def test_viewer_receives_updates_and_cannot_edit(self, running_server, server_port):
+        """Test that a read-only viewer follows edits and its own ops are ignored"""
+        editor = Client('127.0.0.1', server_port)
+        viewer = Client('127.0.0.1', server_port, read_only=True)
+
+        receiver = threading.Thread(target=viewer.receive_file, daemon=True)
+        receiver.start()
+        time.sleep(0.2)
+
+        assert viewer.id not in running_server.clients
+        assert len(running_server.viewer_hub) == 1
+
+        # a viewer trying to edit is dropped before reaching the op queue
+        op = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "V", "ver": 0, "id": viewer.id}
+        viewer.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        op = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "E", "ver": 0, "id": editor.id}
+        editor.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        time.sleep(0.3)
+
+        assert running_server.doc[0] == "Ehello world\n"
+        with viewer.lock:
+            assert viewer.doc == running_server.doc
+
+        editor.close()
+        viewer.close()
+
+    def test_relay_fans_out_to_viewers(self, running_server, server_port):
+        """Test that viewers behind a relay see the same document with one upstream subscription"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('127.0.0.1', 0))
+            relay_port = s.getsockname()[1]
+        relay = Relay('127.0.0.1', server_port, '127.0.0.1', relay_port)
+        threading.Thread(target=relay.upstream_reader, daemon=True).start()
+        threading.Thread(target=relay.connection_listener, daemon=True).start()
+
+        editor = Client('127.0.0.1', server_port)
+        viewers = [Client('127.0.0.1', relay_port, read_only=True) for _ in range(5)]
+        for viewer in viewers:
+            threading.Thread(target=viewer.receive_file, daemon=True).start()
+        time.sleep(0.2)
+
+        op = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "R", "ver": 0, "id": editor.id}
+        editor.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        time.sleep(0.3)
+
+        # the server only ever sees the relay as its single viewer
+        assert len(running_server.viewer_hub) == 1
+        for viewer in viewers:
+            with viewer.lock:
+                assert viewer.doc == running_server.doc
+                assert viewer.doc_version == running_server.doc_ver
+
+        editor.close()
+        for viewer in viewers:
+            viewer.close()
+        relay.server_socket.close()
+        relay.upstream.close()
+
+    def test_client_viewport_holds_only_its_range(self, running_server, server_port):
+        """Test that a viewport client keeps only the requested lines and follows scrolling"""
+        running_server.doc = [f"line {i}\n" for i in range(1, 501)]
+        client = Client('127.0.0.1', server_port, viewport=20)
+
+        receiver = threading.Thread(target=client.receive_file, daemon=True)
+        receiver.start()
+        time.sleep(0.2)
+
+        with client.lock:
+            assert client.doc == running_server.doc[:20]
+            assert client.line_count == 500
+
+        client.scroll(100)
+        time.sleep(0.2)
+
+        with client.lock:
+            assert client.first_line == 101
+            assert client.doc == running_server.doc[100:120]
+
+        client.close()
+
+    def test_client_resumes_after_dropped_connection(self, running_server, server_port):
+        """Test that a client reconnects under its old id and catches up on missed edits"""
+        client = Client('127.0.0.1', server_port)
+        other = Client('127.0.0.1', server_port)
+        for c in (client, other):
+            threading.Thread(target=c.receive_file, daemon=True).start()
+        time.sleep(0.2)
+        client_id = client.id
+        op = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "X", "ver": 0, "id": other.id}
+        other.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        time.sleep(0.2)
+
+        # drop the connection from the server's side, then edit while the client is away
+        running_server.clients[client_id].shutdown(socket.SHUT_RDWR)
+        op = {"opcode": "MODIFY", "line": "2", "idx": "0", "char": "Y", "ver": 1, "id": other.id}
+        other.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        time.sleep(1.0)
+
+        assert client.id == client_id
+        assert client_id in running_server.clients
+        with client.lock:
+            assert client.doc == running_server.doc
+            assert client.doc_version == running_server.doc_ver
+
+        client.close()
+        other.close()
+
+    def test_client_resyncs_by_hashes(self, server_port):
+        """Test that a client too far behind for the replay buffer catches up from block hashes"""
+        server = Server('127.0.0.1', server_port, replay_versions=1)
+        server.doc = [f"line {i}\n" for i in range(300)]
+        threading.Thread(target=server.connection_listener, daemon=True).start()
+        threading.Thread(target=server.doc_updater, daemon=True).start()
+        time.sleep(0.1)
+        client = Client('127.0.0.1', server_port)
+        other = Client('127.0.0.1', server_port)
+        for c in (client, other):
+            threading.Thread(target=c.receive_file, daemon=True).start()
+        time.sleep(0.2)
+        results = []
+        send_result = server.send_result
+        server.send_result = lambda client_id, kind, payload: (results.append(kind), send_result(client_id, kind, payload))
+
+        for line in ("1", "200", "2"):
+            op = {"opcode": "MODIFY", "line": line, "idx": "0", "char": "Z", "ver": 0, "id": other.id}
+            other.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        time.sleep(0.2)
+        # the client drifted and its version is older than anything the buffer holds
+        with client.lock:
+            client.doc[150] = "stale\n"
+            client.doc_version = 1
+        server.clients[client.id].shutdown(socket.SHUT_RDWR)
+        time.sleep(1.0)
+
+        assert "RESYNC" in results
+        with client.lock:
+            assert client.doc == server.doc
+            assert client.doc_version == server.doc_ver
+
+        client.close()
+        other.close()
+        server.server_socket.close()
+
+    def test_authenticated_clients_and_resume(self, server_port):
+        """Test that keys set each connection's role and the session token survives a reconnect"""
+        server = Server('127.0.0.1', server_port, auth_keys={"wkey": "write", "rkey": "read"})
+        server.doc = ["hello world\n", "line two"]
+        threading.Thread(target=server.connection_listener, daemon=True).start()
+        threading.Thread(target=server.doc_updater, daemon=True).start()
+        time.sleep(0.1)
+
+        writer = Client('127.0.0.1', server_port, key="wkey")
+        reader = Client('127.0.0.1', server_port, key="rkey")
+        for c in (writer, reader):
+            threading.Thread(target=c.receive_file, daemon=True).start()
+        time.sleep(0.2)
+        assert (writer.role, reader.role) == ("write", "read")
+        writer_id = writer.id
+
+        # the reader's edit is dropped at the door, even when it claims to be the writer
+        op = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "R", "ver": 0, "id": writer_id}
+        reader.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        op = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "W", "ver": 0, "id": writer_id}
+        writer.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        time.sleep(0.2)
+        assert server.doc[0] == "Whello world\n"
+
+        server.clients[writer_id].shutdown(socket.SHUT_RDWR)
+        time.sleep(1.0)
+        assert writer.id == writer_id
+        assert server.sessions[writer.token] == writer_id
+        with writer.lock:
+            assert writer.doc == server.doc
+
+        refused = Client('127.0.0.1', server_port, key="nope")
+        refused.receive_file()
+        assert refused.closed and refused.token is None
+
+        for c in (writer, reader, refused):
+            c.close()
+        server.server_socket.close()
+
+    def test_standby_takes_over_from_primary(self):
+        """Test that a standby process follows the primary and serves clients once it dies"""
+        ports = []
+        for i in range(2):
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.bind(('127.0.0.1', 0))
+                ports.append(s.getsockname()[1])
+        here = os.path.dirname(os.path.abspath(__file__))
+        server_py = os.path.join(here, "server.py")
+
+        def spawn(*args):
+            return subprocess.Popen([sys.executable, server_py, "127.0.0.1", *args], cwd=here,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        def wait_for(port):
+            for i in range(50):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    return
+                except OSError:
+                    time.sleep(0.1)
+
+        primary = spawn(str(ports[0]))
+        wait_for(ports[0])
+        standby = spawn(str(ports[1]), "--standby-of", f"127.0.0.1:{ports[0]}")
+        time.sleep(0.5)
+        try:
+            client = Client('127.0.0.1', ports[0], fallbacks=[('127.0.0.1', ports[1])])
+            threading.Thread(target=client.receive_file, daemon=True).start()
+            op = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "A", "ver": 0, "id": client.id}
+            client.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+            time.sleep(0.3)
+
+            primary.kill()
+            primary.wait()
+            time.sleep(1.5)
+
+            # the client is on the standby now, which has the primary's doc and keeps editing it
+            assert client.address == ('127.0.0.1', ports[1])
+            op = {"opcode": "MODIFY", "line": "1", "idx": "1", "char": "B", "ver": client.doc_version, "id": client.id}
+            client.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+            time.sleep(0.3)
+            with client.lock:
+                assert client.doc[0].startswith("AB")
+            client.close()
+        finally:
+            primary.kill()
+            standby.kill()
+            primary.wait()
+            standby.wait()
+
+    def test_client_tokens_follow_edits(self, running_server, server_port):
+        """Test that a highlighting client's tokens stay in line with the server's after edits"""
+        running_server.doc = ["def f():\n", "    return 1"]
+        client = Client('127.0.0.1', server_port, highlight=True)
+        threading.Thread(target=client.receive_file, daemon=True).start()
+        time.sleep(0.2)
+
+        for line, idx, char in [("1", "0", "Return"), ("1", "0", "#")]:
+            op = {"opcode": "MODIFY", "line": line, "idx": idx, "char": char, "ver": client.doc_version, "id": client.id}
+            client.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+            time.sleep(0.2)
+
+        with client.lock:
+            assert client.tokens == running_server.syntax.spans
+            assert client.tokens[0] == [[0, 1, "comment"]]
+            assert client.tokens[2] == [[4, 10, "keyword"], [11, 12, "number"]]
+
+        client.close()
+
+    def test_crdt_clients_converge(self, server_port):
+        """Test that CRDT peers and a plain client converge through a CRDT server"""
+        server = Server('127.0.0.1', server_port)
+        server.doc = ["hello world\n", "line two"]
+        server.enable_crdt()
+        threading.Thread(target=server.connection_listener, daemon=True).start()
+        threading.Thread(target=server.doc_updater, daemon=True).start()
+        time.sleep(0.1)
+
+        peers = [Client('127.0.0.1', server_port, crdt=True) for _ in range(2)]
+        plain = Client('127.0.0.1', server_port)
+        for client in peers + [plain]:
+            threading.Thread(target=client.receive_file, daemon=True).start()
+        time.sleep(0.2)
+
+        peers[0].crdt_edit(1, 0, "A")
+        peers[1].crdt_edit(2, 4, "return")
+        op = {"opcode": "MODIFY", "line": "1", "idx": "5", "char": "P", "ver": 0, "id": plain.id}
+        plain.client_socket.sendall((json.dumps(op) + DELIMITER).encode())
+        time.sleep(0.4)
+
+        with peers[0].lock, peers[1].lock:
+            assert peers[0].doc == peers[1].doc == server.doc
+        assert "".join(server.doc) == server.crdt.text()
+        assert "A" in server.doc[0] and "P" in server.doc[0]
+
+        for client in peers + [plain]:
+            client.close()
+        server.server_socket.close()
+
+    def test_streaming_import_and_export(self, running_server, server_port, tmp_path):
+        """Test that a file streams into a live session in chunks and back out again"""
+        client = Client('127.0.0.1', server_port)
+        threading.Thread(target=client.receive_file, daemon=True).start()
+        source = tmp_path / "big.txt"
+        source.write_text("".join(f"line {i} \u00e9\U0001f600\n" for i in range(20000)) + "no newline")
+
+        importer = Transfer('127.0.0.1', server_port)
+        with open(source, encoding="utf-8") as f:
+            ver = importer.upload(f, chunk_chars=4096)
+        importer.close()
+        time.sleep(0.3)
+
+        assert ver == running_server.doc_ver
+        assert "".join(running_server.doc) == source.read_text(encoding="utf-8")
+        with client.lock:
+            assert client.doc == running_server.doc
+
+        exporter = Transfer('127.0.0.1', server_port)
+        assert "".join(exporter.download()) == source.read_text(encoding="utf-8")
+        exporter.close()
+        client.close()
+
+    def test_client_keeps_frame_behind_greeting(self):
+        """Test that a frame arriving in the same read as the greeting isn't lost"""
+        listener = socket.create_server(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        def greet():
+            conn, addr = listener.accept()
+            conn.sendall(("ID: 7" + DELIMITER + "VERSION: 3" + DELIMITER + "CURSOR: 1.0" + DELIMITER +
+                          "hello\n" + DELIMITER + "world\u001E").encode())
+            time.sleep(1)
+            conn.close()
+        threading.Thread(target=greet, daemon=True).start()
+
+        client = Client('127.0.0.1', port)
+        threading.Thread(target=client.receive_file, daemon=True).start()
+        time.sleep(0.3)
+
+        assert client.id == 7
+        with client.lock:
+            assert client.doc == ["hello\n", "world"] and client.doc_version == 3
+        client.close()
+        listener.close()
+
+    def test_client_coalesces_sends(self):
+        """Test that ops queued together reach the server whole and in order, without the caller blocking"""
+        client = Client.__new__(Client)
+        client.outgoing = queue.Queue()
+        client.send_lock = threading.Lock()
+        client.lock = threading.Lock()
+        client.client_socket, server_end = socket.socketpair()
+        client.sender_thread = threading.Thread(target=client.sender, daemon=True)
+        client.sender_thread.start()
+
+        for i in range(20):
+            client.send({"opcode": "MODIFY", "line": "1", "idx": str(i), "char": "a", "id": 1})
+        client.close()
+
+        writes = []
+        server_end.settimeout(0.5)
+        while True:
+            data = server_end.recv(65536)
+            if not data:
+                break
+            writes.append(data)
+        server_end.close()
+        ops = [json.loads(op) for op in b"".join(writes).decode().split(DELIMITER) if op]
+        # how the kernel hands the bytes over says nothing about how many writes there were,
+        # what matters is that every op arrived whole and in order
+        assert ops == [{"opcode": "MODIFY", "line": "1", "idx": str(i), "char": "a", "id": 1} for i in range(20)]
 
     def test_client_file_operations(self, tmp_path):
         """Test client file read/write operations (no server needed)"""
@@ -0,0 +1,50 @@
+import json
+from linehash import LineHashIndex, block_hashes, root_hash, rebuild, line_digest, BLOCK_LINES
+from history import apply_to_lines, INSERT, DELETE, SPLIT, JOIN
+
+
+class TestLineHash:
+    """Unit tests for the line hash index and hash based resync"""
+
+    def test_edits_keep_hashes_current(self):
+        """Test that incremental updates end up where hashing the doc from scratch does"""
+        doc = [f"line {i}\n" for i in range(1000)] + ["end"]
+        index = LineHashIndex()
+        index.refresh(doc)
+
+        for edit in ([INSERT, 3, 0, "x"], [DELETE, 700, 0, 2], [SPLIT, 400, 2, ""], [JOIN, 10, 0, 0], [SPLIT, 1, 0, ""]):
+            apply_to_lines(doc, edit)
+            kind, line, idx, payload = edit
+            index.on_edit(kind, line, idx, len(payload) if kind == INSERT else payload)
+        index.refresh(doc)
+
+        assert index.digests == [line_digest(text) for text in doc]
+        assert index.blocks == block_hashes(doc)
+        assert index.root(doc) == root_hash(block_hashes(doc), doc)
+
+    def test_diff_sends_only_changed_lines(self):
+        """Test that resyncing a mostly unchanged 100k line doc costs kilobytes"""
+        theirs = [f"line {i}\n" for i in range(100000)]
+        ours = list(theirs)
+        ours[5000] = "changed\n"
+        ours.insert(60000, "inserted\n") # shifts every later block
+        del ours[90000]
+        index = LineHashIndex()
+
+        blocks = block_hashes(theirs)
+        ops = index.diff(ours, blocks)
+
+        assert rebuild(theirs, ops) == ours
+        assert len(json.dumps(blocks)) < 20000
+        assert len(json.dumps(ops)) < 10 * BLOCK_LINES * 20
+        assert len(json.dumps(ours)) > 1000000
+
+    def test_diff_of_unrelated_docs(self):
+        """Test that a client with nothing in common just gets every line"""
+        ours = [f"a {i}\n" for i in range(300)]
+        theirs = [f"b {i}\n" for i in range(300)]
+
+        ops = LineHashIndex().diff(ours, block_hashes(theirs))
+
+        assert ops == ours
+        assert rebuild(theirs, ops) == ours
@@ -0,0 +1,81 @@
+import random
+import paging
+from paging import PagedDoc, LINE_OVERHEAD
+
+
+class TestPagedDoc:
+    """Unit tests for the paged line store"""
+
+    def test_matches_a_list(self):
+        """Test that random edits through a tiny budget leave the same lines as a plain list"""
+        rng = random.Random(1)
+        lines = [f"line {i}\n" for i in range(3000)]
+        doc = PagedDoc(iter(lines), budget=20000, page_lines=16)
+
+        for step in range(20000):
+            i = rng.randrange(len(lines))
+            roll = rng.random()
+            if roll < 0.4:
+                lines[i] = doc[i] = lines[i][:-1] + "x\n"
+            elif roll < 0.6:
+                lines.insert(i, "new\n")
+                doc.insert(i, "new\n")
+            elif roll < 0.8 and len(lines) > 1:
+                assert doc.pop(i) == lines.pop(i)
+            else:
+                assert doc[i] == lines[i]
+                assert doc[i:i + 40] == lines[i:i + 40]
+
+        assert doc == lines
+        assert list(doc) == lines and doc[-1] == lines[-1] and len(doc) == len(lines)
+        assert doc.resident_bytes == sum(page.size for page in doc.resident)
+
+    def test_stays_within_budget(self):
+        """Test that only about the budget's worth of lines stays in memory"""
+        lines = [f"line {i}\n" for i in range(100000)]
+        doc = PagedDoc(lines, budget=100000)
+
+        for i in range(0, 100000, 997):
+            doc[i] = "edited\n"
+
+        assert doc.resident_bytes <= 100000
+        assert len(doc.resident) < len(doc.pages) // 10
+        assert doc.end > sum(map(len, lines)) # the rest went to the scratch file
+        assert doc[997] == "edited\n" and doc[998] == "line 998\n"
+
+    def test_scan_keeps_hot_pages(self):
+        """Test that reading the whole doc doesn't load cold pages or evict the one being edited"""
+        lines = [f"line {i}\n" for i in range(10000)]
+        doc = PagedDoc(lines, budget=20000, page_lines=16)
+        doc[5000] = "hot\n"
+        hot = doc.pages[doc.locate(5000)[0]]
+        resident = list(doc.resident)
+
+        assert "".join(doc) == "".join(lines[:5000]) + "hot\n" + "".join(lines[5001:])
+        assert list(doc.resident) == resident and doc.resident_bytes <= 20000
+        assert hot.lines is not None and list(doc.resident)[-1] is hot
+
+    def test_scratch_file_is_compacted(self, monkeypatch):
+        """Test that rewriting pages over and over doesn't grow the scratch file without bound"""
+        monkeypatch.setattr(paging, "COMPACT_MIN", 10000)
+        doc = PagedDoc([f"line {i}\n" for i in range(2000)], budget=2000, page_lines=16)
+        live = 2000 * (len("line 1000\n") + 4)
+
+        for rounds in range(20):
+            for i in range(0, 2000, 16):
+                doc[i] = f"round {rounds}\n"
+
+        assert doc.end < 3 * live
+        assert doc[16] == "round 19\n" and doc[17] == "line 17\n"
+
+    def test_page_splits(self):
+        """Test that typing Return over and over in one spot splits the page instead of growing it"""
+        doc = PagedDoc(["a\n"] * 10, page_lines=4)
+
+        for i in range(100):
+            doc.insert(5, "b\n")
+
+        assert len(doc) == 110
+        assert max(doc.counts) <= 8
+        assert doc.resident_bytes == sum(page.size for page in doc.pages) == 110 * (2 + LINE_OVERHEAD)
+        assert doc[:5] == ["a\n"] * 5 and doc[5:105] == ["b\n"] * 100
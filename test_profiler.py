@@ -0,0 +1,85 @@
+import pytest
+import time
+from profiler import Profiler, HOT_PATHS
+from server import Server
+
+
+class Target:
+    """Stand-in for the server with a small call tree"""
+
+    def process_op(self, op):
+        self.broadcast()
+        return op
+
+    def broadcast(self):
+        self.send_file(1)
+
+    def send_file(self, client_id):
+        time.sleep(0.001)
+
+
+class TestProfiler:
+    """Unit tests for the profiling hooks"""
+
+    def test_disabled_profiler_leaves_methods_alone(self):
+        """Test that a profiler that was never started wraps nothing"""
+        target = Target()
+        Profiler(target, hot_paths=("process_op", "broadcast", "send_file"))
+
+        assert "process_op" not in target.__dict__
+
+    def test_timing_records_collapsed_stacks(self):
+        """Test that timing mode produces nested collapsed stacks and call counts"""
+        target = Target()
+        profiler = Profiler(target, hot_paths=("process_op", "broadcast", "send_file"))
+
+        profiler.start()
+        for _ in range(3):
+            assert target.process_op("op") == "op"
+        profiler.stop()
+
+        stacks = dict(line.rsplit(" ", 1) for line in profiler.collapsed())
+        leaf = [stack for stack in stacks if stack.endswith("process_op;broadcast;send_file")]
+        assert len(leaf) == 1
+        assert int(stacks[leaf[0]]) >= 3000
+        assert profiler.summary()["send_file"]["calls"] == 3
+
+    def test_stop_restores_instance_overrides(self):
+        """Test that stopping puts back methods that were overridden on the instance"""
+        target = Target()
+        override = lambda client_id: None
+        target.send_file = override
+        profiler = Profiler(target, hot_paths=("process_op", "send_file"))
+
+        profiler.start()
+        target.process_op("op")
+        profiler.stop()
+
+        assert target.send_file is override
+        assert "process_op" not in target.__dict__
+
+    def test_sample_mode_and_dump(self, tmp_path):
+        """Test that sampling collects stacks from other threads and dumps them"""
+        target = Target()
+        profiler = Profiler(target, mode="sample", interval=0.001)
+
+        profiler.start()
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            target.process_op("op")
+        profiler.stop()
+
+        path = tmp_path / "profile.folded"
+        profiler.dump(str(path))
+        lines = path.read_text().splitlines()
+        assert any("test_profiler.py:send_file" in line for line in lines)
+
+    def test_unknown_mode_rejected(self):
+        """Test that an unknown profiling mode is refused up front"""
+        with pytest.raises(ValueError):
+            Profiler(Target(), mode="flame")
+
+    def test_hot_paths_exist_on_server(self):
+        """Test that every default hot path is a real server method"""
+        for name in HOT_PATHS:
+            assert callable(getattr(Server, name, None)), name
@@ -0,0 +1,27 @@
+import pytest
+import socket
+from protocol import read_greeting
+
+
+class TestProtocol:
+    """Unit tests for the connection greeting"""
+
+    def test_greeting_keeps_what_follows(self):
+        """Test that a greeting split over reads is put together and the bytes after it are returned"""
+        ours, theirs = socket.socketpair()
+        theirs.sendall(b"ID: 4")
+        theirs.sendall(b"2\x1dVERSION: 1\x1d")
+
+        assert read_greeting(ours) == (42, b"VERSION: 1\x1d")
+        ours.close()
+        theirs.close()
+
+    def test_closed_before_greeting(self):
+        """Test that a connection closed before the greeting is complete raises"""
+        ours, theirs = socket.socketpair()
+        theirs.sendall(b"ID: 4")
+        theirs.close()
+
+        with pytest.raises(ConnectionError):
+            read_greeting(ours, "Primary server")
+        ours.close()
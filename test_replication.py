@@ -0,0 +1,50 @@
+import threading
+import time
+from server import Server
+from history import ReplayBuffer, INSERT, SPLIT
+from replication import Standby
+from versions import VersionStore
+
+
+class FakeSocket:
+    """Records what the standby sends upstream"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+class TestStandby:
+    """Unit tests for applying a primary's replication stream"""
+
+    def make_standby(self):
+        server = Server.__new__(Server)
+        server.doc = [""]
+        server.doc_ver = 0
+        server.memory_budget = None
+        server.replay = ReplayBuffer()
+        server.versions = VersionStore()
+        server.data_lock = threading.Lock()
+        server.autosaver = None
+        standby = Standby(server, "127.0.0.1", 0)
+        standby.upstream = FakeSocket()
+        standby.id = 5
+        return standby
+
+    def test_snapshot_then_versions(self):
+        """Test that the standby mirrors the doc, version and replay buffer"""
+        standby = self.make_standby()
+        standby.apply("SNAPSHOT", {"ver": 3, "doc": ["hello"], "time": time.time()})
+        standby.apply("REPL", {"ver": 5, "versions": [[4, [[INSERT, 1, 5, " world"]]], [5, [[SPLIT, 1, 5, ""]]]],
+                               "time": time.time()})
+
+        server = standby.server
+        assert server.doc == ["hello\n", " world"]
+        assert server.doc_ver == 5
+        assert [ver for ver, edits in server.replay.since(3)] == [4, 5]
+        assert server.replay.since(2) is None
+        assert server.versions.doc_at(4) == ["hello world"]
+        assert standby.lag is not None and standby.status()["synced"]
+        assert b'"opcode": "ACK", "ver": 5' in standby.upstream.sent[-1]
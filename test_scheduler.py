@@ -0,0 +1,84 @@
+import threading
+import time
+from scheduler import FairQueue, TokenBucket
+
+
+def op(client_id, n=0, opcode="MODIFY"):
+    return {"opcode": opcode, "id": client_id, "n": n}
+
+
+class TestScheduler:
+    """Unit tests for the per-client fair op queue"""
+
+    def test_round_robin_across_clients(self):
+        """Test that a flood from one client doesn't hold back another's ops"""
+        queue = FairQueue(rate=0)
+        for n in range(100):
+            queue.put(op(1, n))
+        queue.put(op(2, 0))
+        queue.put(op(2, 1))
+
+        order = [queue.get()["id"] for i in range(5)]
+
+        assert order == [1, 2, 1, 2, 1]
+        assert queue.qsize() == 97
+
+    def test_per_client_order_is_kept(self):
+        """Test that one client's ops come out in the order they went in"""
+        queue = FairQueue(rate=0)
+        for n in range(10):
+            queue.put(op(1, n))
+            queue.put(op(2, n))
+        ones = [o["n"] for o in (queue.get() for i in range(20)) if o["id"] == 1]
+        assert ones == list(range(10))
+
+    def test_token_bucket_refills(self):
+        """Test that a bucket allows a burst and then its rate"""
+        bucket = TokenBucket(rate=10, burst=3, now=0.0)
+        assert [bucket.take(0.0) for i in range(4)] == [True, True, True, False]
+        assert abs(bucket.wait_time() - 0.1) < 1e-9
+        assert bucket.take(0.1)
+        assert not bucket.take(0.1)
+
+    def test_rate_limited_client_yields_to_others(self):
+        """Test that a client out of tokens waits while others are served right away"""
+        queue = FairQueue(rate=10, burst=2)
+        for n in range(5):
+            queue.put(op(1, n))
+        assert [queue.get()["id"] for i in range(2)] == [1, 1]
+
+        queue.put(op(2))
+        start = time.monotonic()
+        assert queue.get()["id"] == 2
+        assert time.monotonic() - start < 0.05
+        # the flooder gets its next op once a token has refilled
+        assert queue.get()["id"] == 1
+        assert time.monotonic() - start >= 0.05
+
+    def test_disconnect_skips_the_rate_limit(self):
+        """Test that a disconnect isn't held back and resets the client's bucket"""
+        queue = FairQueue(rate=1, burst=1)
+        queue.put(op(1))
+        queue.get()
+        queue.put(op(1, opcode="DISCONNECT"))
+        start = time.monotonic()
+        assert queue.get()["opcode"] == "DISCONNECT"
+        assert time.monotonic() - start < 0.5
+        assert queue.buckets == {} and queue.queues == {}
+
+    def test_full_queue_blocks_only_that_client(self):
+        """Test that a client with a full sub-queue blocks until the updater catches up"""
+        queue = FairQueue(rate=0, max_pending=2)
+        queue.put(op(1))
+        queue.put(op(1))
+        blocked = threading.Thread(target=queue.put, args=(op(1),), daemon=True)
+        blocked.start()
+        blocked.join(0.1)
+        assert blocked.is_alive()
+
+        queue.put(op(2))
+        assert queue.qsize() == 3
+        queue.get()
+        blocked.join(0.5)
+        assert not blocked.is_alive()
+        assert queue.qsize() == 3
@@ -1,6 +1,48 @@
 import pytest
 import json
+import random
+import threading
+import time
 from server import Server
+from history import UndoHistory, ReplayBuffer
+from relay import ViewerHub
+from search import SearchIndex
+from viewport import ChangeTracker
+from tokenizer import SyntaxIndex
+from scheduler import FairQueue
+from versions import VersionStore
+from linehash import LineHashIndex, block_hashes, root_hash, rebuild, BLOCK_LINES
+from paging import PagedDoc
+
+class FakeSocket:
+    """Records what the server sends instead of writing to the network"""
+
+    def __init__(self):
+        self.sent = []
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+class ScriptedSocket(FakeSocket):
+    """A client connection that sends the given ops and then hangs up"""
+
+    def __init__(self, *ops):
+        super().__init__()
+        self.chunks = [(json.dumps(op) + "\u001D").encode() for op in ops]
+
+    def getsockname(self):
+        return ("127.0.0.1", 0)
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
 
 class TestServer:
     """Unit tests for Server document operations"""
@@ -12,10 +54,44 @@ class TestServer:
         server = Server.__new__(Server)
         server.doc = [""] * 10
         server.doc_ver = 0
+        server.memory_budget = None
+        server.scratch_dir = None
         server.clients = {}
         server.client_cursors = {}
+        server.history = UndoHistory()
+        server.replay = ReplayBuffer()
+        server.versions = VersionStore()
+        server.departed = {}
+        server.replicas = {}
+        server.autosaver = None
+        server.import_broadcast = 0.0
+        server.auth_keys = None
+        server.sessions = {}
+        server.tokens = {}
+        server.traffic = {}
+        server.data_lock = threading.Lock()
+        server.viewer_hub = ViewerHub()
+        server.search_index = SearchIndex()
+        server.viewports = {}
+        server.change_tracker = ChangeTracker()
+        server.syntax = SyntaxIndex()
+        server.highlighters = set()
+        server.line_hashes = LineHashIndex()
+        server.edit_listeners = [server.search_index, server.change_tracker, server.syntax, server.line_hashes]
+        server.crdt = None
+        server.crdt_peers = set()
         return server
 
+    def send_key(self, server, client_id, line, idx, char, opcode="MODIFY"):
+        server.process_op({
+            "opcode": opcode,
+            "line": str(line),
+            "idx": str(idx),
+            "char": char,
+            "ver": server.doc_ver,
+            "id": client_id
+        })
+
     def test_insert_char_basic(self, server):
         """Test basic character insertion"""
         server.client_cursors[1] = "1.0"
@@ -222,6 +298,19 @@ class TestServer:
 
         assert server.doc[0] == "hell"
 
+    def test_process_op_stale_position(self, server):
+        """Test that a position past the end of the doc, from a client that missed a delete, is clamped"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["hello"]
+        server.send_file = lambda x: None
+
+        server.process_op({"opcode": "MODIFY", "line": "3", "idx": "9", "char": "!", "ver": 0, "id": 1})
+        server.process_op({"opcode": "CURSOR", "line": "2", "idx": "9", "char": "right", "ver": 1, "id": 1})
+
+        assert server.doc == ["hello!"]
+        assert server.client_cursors[1] == "1.6"
+
     def test_process_op_cursor_left(self, server):
         """Test cursor movement left"""
         server.client_cursors[1] = "1.5"
@@ -394,3 +483,779 @@ class TestServer:
         server.open_file(str(test_file))
 
         assert server.doc == ["hello\n", "world\n", "test"]
+
+    def test_paged_doc(self, server, tmp_path):
+        """Test editing a file opened with a memory budget far smaller than it"""
+        test_file = tmp_path / "big.txt"
+        test_file.write_text("".join(f"line {i}\n" for i in range(20000)) + "end")
+        server.memory_budget = 50000
+        server.scratch_dir = str(tmp_path)
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+
+        server.open_file(str(test_file))
+        self.send_key(server, 1, 15000, 4, "X")
+        self.send_key(server, 1, 10, 4, "Return")
+        self.send_key(server, 1, 20002, 0, "BackSpace")
+        self.send_key(server, 1, 1, 0, "UNDO", opcode="UNDO")
+
+        assert isinstance(server.doc, PagedDoc)
+        assert server.doc.resident_bytes <= 50000
+        assert len(server.doc) == 20002
+        assert server.doc[9:11] == ["line\n", " 9\n"]
+        assert server.doc[15000] == "lineX 14999\n"
+        assert server.doc[-2:] == ["line 19999\n", "end"] # the undo put back the line break
+
+    def test_paged_export_streams_a_snapshot(self, server, tmp_path):
+        """Test that exporting a paged doc sends it as of the request, without reading it into memory"""
+        test_file = tmp_path / "big.txt"
+        lines = [f"line {i}\n" for i in range(20000)]
+        test_file.write_text("".join(lines))
+        server.memory_budget = 50000
+        server.scratch_dir = str(tmp_path)
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+        server.open_file(str(test_file))
+        sock = FakeSocket()
+        release = threading.Event()
+        sendall = sock.sendall
+        sock.sendall = lambda data: (release.wait(1), sendall(data))
+        server.clients[2] = sock
+        server.client_cursors[2] = "1.0"
+
+        server.process_op({"opcode": "EXPORT", "id": 2})
+        for line in range(1, 20000, 500):
+            self.send_key(server, 1, line, 0, "X")
+        release.set()
+        for attempt in range(200):
+            if sock.sent and b'"done": true' in sock.sent[-1]:
+                break
+            time.sleep(0.01)
+
+        frames = [json.loads(data.decode()[len("EXPORT: "):-1]) for data in sock.sent]
+        assert [line for frame in frames for line in frame["lines"]] == lines
+        assert server.doc.resident_bytes <= 50000 and server.doc[0] == "Xline 0\n"
+
+    def test_undo_typed_run(self, server):
+        """Test that consecutive typed chars are undone as one run"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["hello"]
+        server.send_file = lambda x: None
+
+        for i, char in enumerate("abc"):
+            self.send_key(server, 1, 1, 5 + i, char)
+        assert server.doc[0] == "helloabc"
+
+        self.send_key(server, 1, 1, 8, "", opcode="UNDO")
+
+        assert server.doc[0] == "hello"
+        assert server.client_cursors[1] == "1.5"
+        assert server.doc_ver == 4
+
+    def test_redo_restores_run(self, server):
+        """Test that redo reapplies an undone run and a new edit clears redo"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["hello"]
+        server.send_file = lambda x: None
+
+        for i, char in enumerate("ab"):
+            self.send_key(server, 1, 1, 5 + i, char)
+        self.send_key(server, 1, 1, 7, "", opcode="UNDO")
+        self.send_key(server, 1, 1, 5, "", opcode="REDO")
+        assert server.doc[0] == "helloab"
+
+        self.send_key(server, 1, 1, 5, "", opcode="UNDO")
+        self.send_key(server, 1, 1, 5, "X")
+        self.send_key(server, 1, 1, 6, "", opcode="REDO")
+        assert server.doc[0] == "helloX"
+
+    def test_undo_own_edit_after_undoing_later_one(self, server):
+        """Test that undoing a char after undoing the backspace that removed it takes it out again"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["abc\n"]
+        server.send_file = lambda x: None
+
+        self.send_key(server, 1, 1, 0, "x")
+        self.send_key(server, 1, 1, 1, "backspace")
+        self.send_key(server, 1, 1, 0, "", opcode="UNDO")
+        assert server.doc == ["xabc\n"]
+        self.send_key(server, 1, 1, 1, "", opcode="UNDO")
+
+        assert server.doc == ["abc\n"]
+        assert server.doc_ver == 4
+
+    def test_undo_random_edits_back_to_start(self, server):
+        """Test that undoing everything one client did, with undos and redos along the way, restores the doc"""
+        server.clients[1] = None
+        server.send_file = lambda x: None
+        keys = ["a", "b", "return", "backspace", "backspace", "UNDO", "REDO"]
+
+        for seed in range(50):
+            rng = random.Random(seed)
+            start = ["abc\n", "def\n", "ghi"]
+            server.doc = list(start)
+            server.history = UndoHistory()
+            server.client_cursors[1] = "1.0"
+            for step in range(30):
+                key = rng.choice(keys)
+                line = rng.randint(1, len(server.doc))
+                idx = rng.randint(0, len(server.doc[line - 1].rstrip("\n")))
+                if key in ("UNDO", "REDO"):
+                    self.send_key(server, 1, line, idx, "", opcode=key)
+                else:
+                    self.send_key(server, 1, line, idx, key)
+            while server.history.undo_stacks.get(1):
+                self.send_key(server, 1, 1, 0, "", opcode="UNDO")
+
+            assert server.doc == start, seed
+
+    def test_undo_backspace_and_line_join(self, server):
+        """Test undoing backspaces, including one that joined two lines"""
+        server.client_cursors[1] = "2.0"
+        server.clients[1] = None
+        server.doc = ["hello\n", "world"]
+        server.send_file = lambda x: None
+
+        self.send_key(server, 1, 2, 0, "backspace")
+        assert server.doc == ["helloworld"]
+        self.send_key(server, 1, 1, 5, "backspace")
+        self.send_key(server, 1, 1, 4, "backspace")
+        assert server.doc == ["helworld"]
+
+        self.send_key(server, 1, 1, 3, "", opcode="UNDO")
+        assert server.doc == ["helloworld"]
+        self.send_key(server, 1, 1, 5, "", opcode="UNDO")
+        assert server.doc == ["hello\n", "world"]
+
+    def test_undo_transformed_against_other_client(self, server):
+        """Test that undo targets the right text after another client edits before it"""
+        server.client_cursors[1] = "1.0"
+        server.client_cursors[2] = "1.0"
+        server.clients[1] = None
+        server.clients[2] = None
+        server.doc = ["world"]
+        server.send_file = lambda x: None
+
+        # client 1 types at the end, client 2 then adds a line and text before it
+        self.send_key(server, 1, 1, 5, "!")
+        self.send_key(server, 2, 1, 0, "return")
+        self.send_key(server, 2, 1, 0, "X")
+
+        self.send_key(server, 1, 2, 6, "", opcode="UNDO")
+
+        assert server.doc == ["X\n", "world"]
+
+    def test_undo_with_empty_history(self, server):
+        """Test that undo with nothing recorded leaves the doc and version alone"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["hello"]
+        server.send_file = lambda x: None
+
+        self.send_key(server, 1, 1, 0, "", opcode="UNDO")
+
+        assert server.doc == ["hello"]
+        assert server.doc_ver == 0
+
+    def test_subscribe_moves_client_to_viewers(self, server):
+        """Test that a subscribing client leaves the editor set and gets the doc once, from the fan-out thread"""
+        sock = FakeSocket()
+        release = threading.Event()
+        sendall = sock.sendall
+        sock.sendall = lambda data: (release.wait(1), sendall(data))
+        server.clients[1] = sock
+        server.client_cursors[1] = "1.0"
+        server.doc = ["hello"]
+
+        server.process_op({"opcode": "SUBSCRIBE", "id": 1})
+
+        assert 1 not in server.clients
+        assert 1 not in server.client_cursors
+        assert len(server.viewer_hub) == 1
+        # the updater only handed the frame over, a slow viewer doesn't hold it up
+        assert sock.sent == []
+        release.set()
+        for attempt in range(100):
+            if sock.sent:
+                break
+            time.sleep(0.01)
+        assert len(sock.sent) == 1 and sock.sent[0].decode().endswith("hello\u001E")
+
+    def test_broadcast_publishes_one_frame_for_viewers(self, server):
+        """Test that edits hand viewers a single shared frame instead of per-viewer sends"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["hello"]
+        server.send_file = lambda x: None
+        for viewer_id in range(100, 110):
+            server.viewer_hub.viewers[viewer_id] = FakeSocket()
+
+        self.send_key(server, 1, 1, 5, "!")
+
+        assert server.viewer_hub.latest_ver == 1
+        assert server.viewer_hub.latest.decode().endswith("hello!\u001E")
+
+    def test_disconnect_keeps_session_for_resume(self, server, monkeypatch):
+        """Test that a disconnect parks the cursor and only forgets history once evicted"""
+        monkeypatch.setattr("server.MAX_DEPARTED", 1)
+        sock = FakeSocket()
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = sock
+        server.doc = ["hello"]
+        server.send_file = lambda x: None
+        self.send_key(server, 1, 1, 5, "!")
+
+        server.process_op({"opcode": "DISCONNECT", "id": 1, "socket": sock})
+
+        assert server.clients == {}
+        assert server.client_cursors == {1: "1.6"}
+        assert list(server.departed) == [1]
+
+        server.clients[2] = other = FakeSocket()
+        server.client_cursors[2] = "1.0"
+        server.process_op({"opcode": "DISCONNECT", "id": 2, "socket": other})
+
+        assert list(server.departed) == [2]
+        assert server.client_cursors == {2: "1.0"}
+        assert server.history.pop_undo(1) == []
+
+    def test_resume_sends_missed_edits(self, server):
+        """Test that a resuming client gets its old id back plus the edits since its version"""
+        server.doc = ["hello"]
+        old, new = FakeSocket(), FakeSocket()
+        server.clients[1] = old
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+        self.send_key(server, 1, 1, 5, "!")
+        server.process_op({"opcode": "DISCONNECT", "id": 1, "socket": old})
+        server.clients[2] = None
+        server.client_cursors[2] = "1.0"
+        self.send_key(server, 2, 1, 0, "Return")
+        self.send_key(server, 2, 1, 0, "A")
+
+        server.clients[3] = new
+        server.client_cursors[3] = "1.0"
+        server.process_op({"opcode": "RESUME", "prev_id": 1, "ver": 1, "id": 3})
+
+        assert 3 not in server.clients and server.clients[1] is new
+        kind, payload = new.sent[0].decode().rstrip("\u001E").split(": ", 1)
+        payload = json.loads(payload)
+        assert kind == "RESUME"
+        assert payload["id"] == 1 and payload["mode"] == "delta"
+        assert payload["from"] == 1 and payload["to"] == 3
+        assert [ver for ver, edits in payload["edits"]] == [2, 3]
+        assert payload["cursor"] == "2.6"
+        # an old connection noticed late doesn't tear down the resumed session
+        server.process_op({"opcode": "DISCONNECT", "id": 1, "socket": old})
+        assert server.clients[1] is new
+
+    def test_resume_falls_back_to_snapshot(self, server):
+        """Test that a client behind the replay buffer gets a full frame"""
+        server.replay = ReplayBuffer(max_versions=2)
+        server.doc = ["hello"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+        for i in range(5):
+            self.send_key(server, 1, 1, i, "x")
+        results, snapshots = [], []
+        server.send_result = lambda client_id, kind, payload: results.append((kind, payload))
+        server.send_file = lambda client_id: snapshots.append(client_id)
+        server.clients[2] = FakeSocket()
+        server.client_cursors[2] = "1.0"
+
+        # an unknown session resumes as itself
+        server.process_op({"opcode": "RESUME", "prev_id": 2, "ver": 1, "id": 2})
+
+        assert results == [("RESUME", {"id": 2, "mode": "snapshot"})]
+        assert snapshots == [2]
+
+    def test_find_returns_matches(self, server):
+        """Test that FIND replies with every match position"""
+        server.client_cursors[1] = "1.0"
+        server.doc = ["foo bar foo\n", "bar\n", "food"]
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append((kind, payload))
+
+        server.process_op({"opcode": "FIND", "pattern": "foo", "id": 1})
+
+        kind, payload = results[0]
+        assert kind == "FIND"
+        assert payload["matches"] == [[1, 0, 3], [1, 8, 11], [3, 0, 3]]
+
+    def test_find_only_rescans_edited_lines(self, server):
+        """Test that a repeated search reuses cached spans for untouched lines"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["foo\n", "bar\n", "foo"]
+        server.send_file = lambda x: None
+        server.send_result = lambda client_id, kind, payload: None
+
+        server.process_op({"opcode": "FIND", "pattern": "foo", "id": 1})
+        self.send_key(server, 1, 2, 0, "return")
+
+        spans = next(iter(server.search_index.caches.values()))
+        assert spans == [[(0, 3)], None, None, [(0, 3)]]
+
+    def test_replace_all_is_one_version(self, server):
+        """Test that REPLACE_ALL applies every replacement as one version and one broadcast"""
+        server.client_cursors[1] = "1.0"
+        server.clients[1] = None
+        server.doc = ["a-1 b-2\n", "c-3"]
+        sent = []
+        server.send_file = lambda x: sent.append(x)
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append(payload)
+
+        server.process_op({"opcode": "REPLACE_ALL", "pattern": r"(\w)-(\d)", "replacement": r"\2\1",
+                           "regex": True, "id": 1})
+
+        assert server.doc == ["1a 2b\n", "3c"]
+        assert server.doc_ver == 1
+        assert len(sent) == 1
+        assert results[0]["replaced"] == 3
+
+        # and the whole batch undoes in one step
+        self.send_key(server, 1, 1, 0, "", opcode="UNDO")
+        assert server.doc == ["a-1 b-2\n", "c-3"]
+
+    def test_replace_all_rejects_expanded_line_breaks(self, server):
+        """Test that a regex replacement that expands to a line break is refused, not inserted"""
+        server.doc = ["a-1 b-2\n", "c-3"]
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append(payload)
+
+        server.process_op({"opcode": "REPLACE_ALL", "pattern": r"(\w)-(\d)", "replacement": r"\1\n\2",
+                           "regex": True, "id": 1})
+
+        assert results[0]["error"] == "replacement can't contain line breaks"
+        assert server.doc == ["a-1 b-2\n", "c-3"]
+        assert server.doc_ver == 0
+
+    def test_find_bad_regex_reports_error(self, server):
+        """Test that an invalid regex is reported instead of crashing the updater"""
+        server.doc = ["hello"]
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append(payload)
+
+        server.process_op({"opcode": "FIND", "pattern": "(", "regex": True, "id": 1})
+
+        assert "error" in results[0]
+        assert server.doc_ver == 0
+
+    def test_viewport_sends_only_requested_lines(self, server):
+        """Test that a client with a viewport receives just that range and the line count"""
+        sock = FakeSocket()
+        server.clients[1] = sock
+        server.client_cursors[1] = "1.0"
+        server.doc = [f"line {i}\n" for i in range(1, 1001)]
+
+        server.process_op({"opcode": "VIEWPORT", "first": 500, "count": 3, "id": 1})
+
+        fields = sock.sent[-1].decode().rstrip("\u001E").split("\u001D")
+        assert fields[2] == "RANGE: 500 1000"
+        assert fields[3:] == ["line 500\n", "line 501\n", "line 502\n"]
+
+    def test_edit_outside_viewport_sends_line_count(self, server):
+        """Test that edits away from the viewport are reduced to a line count update"""
+        sock = FakeSocket()
+        server.clients[1] = sock
+        server.client_cursors[1] = "1.0"
+        server.client_cursors[2] = "1.0"
+        server.doc = [f"line {i}\n" for i in range(1, 101)]
+        server.viewports[1] = (1, 10)
+
+        # client 2 adds a line far below client 1's viewport
+        self.send_key(server, 2, 50, 0, "return")
+
+        assert sock.sent[-1].decode() == "VERSION: 1\u001DCURSOR: 1.0\u001DLINES: 101\u001E"
+
+    def test_edit_above_viewport_resends_range(self, server):
+        """Test that a new line above the viewport resends it since its lines shifted"""
+        sock = FakeSocket()
+        server.clients[1] = sock
+        server.client_cursors[1] = "60.0"
+        server.client_cursors[2] = "1.0"
+        server.doc = [f"line {i}\n" for i in range(1, 101)]
+        server.viewports[1] = (60, 2)
+
+        self.send_key(server, 2, 1, 0, "return")
+
+        fields = sock.sent[-1].decode().rstrip("\u001E").split("\u001D")
+        assert fields[1] == "CURSOR: 61.0"
+        assert fields[2] == "RANGE: 60 101"
+        assert fields[3:] == ["line 59\n", "line 60\n"]
+
+    def test_crdt_ops_update_line_doc(self, server):
+        """Test that CRDT ops from a peer land on the line doc across line breaks"""
+        from crdt import CRDTDocument
+        server.doc = ["hello\n", "world"]
+        server.enable_crdt()
+        server.client_cursors[7] = "1.0"
+        server.clients[7] = None
+        server.send_file = lambda x: None
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append(payload)
+
+        server.process_op({"opcode": "CRDT_SYNC", "vector": {}, "ops": [], "id": 7})
+        peer = CRDTDocument(site=7)
+        peer.apply(results[-1]["ops"])
+        ops = peer.insert(5, " there\nbig") + peer.delete(0, 1)
+        server.process_op({"opcode": "CRDT", "ops": ops, "id": 7})
+
+        assert server.doc == ["ello there\n", "big\n", "world"]
+        assert "".join(server.doc) == server.crdt.text() == peer.text()
+        assert server.doc_ver == 1
+
+    def test_plain_edits_reach_crdt_peers(self, server):
+        """Test that keystrokes from a plain client are bridged into ops for CRDT peers"""
+        from crdt import CRDTDocument
+        server.doc = ["hello"]
+        server.enable_crdt()
+        for client_id in (1, 7):
+            server.client_cursors[client_id] = "1.0"
+            server.clients[client_id] = None
+        server.send_file = lambda x: None
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append(payload)
+
+        server.process_op({"opcode": "CRDT_SYNC", "vector": {}, "ops": [], "id": 7})
+        peer = CRDTDocument(site=7)
+        peer.apply(results[-1]["ops"])
+
+        self.send_key(server, 1, 1, 5, "return")
+        self.send_key(server, 1, 2, 0, "X")
+        self.send_key(server, 1, 1, 5, "backspace")
+        for payload in results[1:]:
+            peer.apply(payload["ops"])
+
+        assert peer.text() == "".join(server.doc)
+        assert server.doc == ["hell\n", "X"]
+
+    def test_replica_gets_snapshot_then_edits(self, server):
+        """Test that a standby is caught up with a snapshot and then streamed each version"""
+        server.doc = ["hello"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+        self.send_key(server, 1, 1, 5, "!")
+        standby = FakeSocket()
+        server.clients[2] = standby
+        server.client_cursors[2] = "1.0"
+
+        server.process_op({"opcode": "REPLICATE", "ver": -1, "id": 2})
+        self.send_key(server, 1, 1, 0, "A")
+
+        assert 2 not in server.clients and 2 in server.replicas
+        frames = [data.decode().rstrip("\u001E").split(": ", 1) for data in standby.sent]
+        assert frames[0][0] == "SNAPSHOT"
+        assert json.loads(frames[0][1])["doc"] == ["hello!"]
+        kind, payload = frames[1][0], json.loads(frames[1][1])
+        assert kind == "REPL"
+        assert payload["ver"] == 2
+        assert payload["versions"] == [[2, [[0, 1, 0, "A"]]]]
+
+        server.process_op({"opcode": "ACK", "ver": 2, "time": payload["time"], "id": 2})
+
+        status = server.replication_status()[2]
+        assert status["acked"] == 2 and status["behind"] == 0
+        assert status["lag"] >= 0
+
+    def test_multi_caret_typing_is_one_version(self, server):
+        """Test that typing at several carets bumps the version once and moves every cursor"""
+        server.doc = ["abc\n", "def\n", "ghi"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.client_cursors[2] = "3.2"
+        broadcasts, results = [], []
+        server.broadcast = lambda: broadcasts.append(server.doc_ver)
+        server.send_result = lambda client_id, kind, payload: results.append((kind, payload))
+
+        server.process_op({"opcode": "MULTI", "ranges": [[3, 0, 3, 0], [1, 1, 1, 1], [2, 1, 2, 1]], "char": "x", "id": 1})
+
+        assert server.doc == ["axbc\n", "dxef\n", "xghi"]
+        assert broadcasts == [1]
+        assert results == [("CARETS", {"carets": [(1, 2), (2, 2), (3, 1)]})]
+        assert server.client_cursors == {1: "1.2", 2: "3.3"}
+        # one undo step takes all three back
+        server.undo(1)
+        assert server.doc == ["abc\n", "def\n", "ghi"]
+
+    def test_multi_replaces_selection_across_lines(self, server):
+        """Test that typing over a multi-line selection deletes it first"""
+        server.doc = ["abc\n", "def\n", "ghi"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.broadcast = lambda: None
+        server.send_result = lambda client_id, kind, payload: None
+
+        server.process_op({"opcode": "MULTI", "ranges": [[3, 1, 1, 2]], "char": "Return", "id": 1})
+
+        assert server.doc == ["ab\n", "hi"]
+        assert server.client_cursors[1] == "2.0"
+
+    def test_multi_indent_and_dedent(self, server):
+        """Test that indent touches each selected line once"""
+        server.doc = ["a\n", "b\n", "c"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.broadcast = lambda: None
+        server.send_result = lambda client_id, kind, payload: None
+
+        server.process_op({"opcode": "MULTI", "ranges": [[1, 0, 2, 1], [2, 0, 2, 0]], "char": "Indent", "id": 1})
+        assert server.doc == ["    a\n", "    b\n", "c"]
+
+        server.process_op({"opcode": "MULTI", "ranges": [[2, 0, 3, 0]], "char": "Dedent", "id": 1})
+        assert server.doc == ["    a\n", "b\n", "c"]
+
+    def test_multi_selection_undo_and_redo(self, server):
+        """Test that undoing a multi-line selection edit puts back exactly the text it removed"""
+        server.clients[1] = None
+        server.broadcast = lambda: None
+        server.send_result = lambda client_id, kind, payload: None
+        server.send_file = lambda x: None
+        cases = [([[1, 1, 2, 1]], "BackSpace", ["aef\n", "ghi"]),
+                 ([[1, 0, 2, 1], [3, 1, 3, 1]], "BackSpace", ["ef\n", "hi"]),
+                 ([[1, 2, 3, 1]], "x", ["abxhi"]),
+                 ([[1, 1, 3, 2], [1, 0, 1, 0]], "Return", ["\n", "a\n", "i"])]
+
+        for ranges, key, edited in cases:
+            server.doc = ["abc\n", "def\n", "ghi"]
+            server.history = UndoHistory()
+            server.client_cursors[1] = "1.0"
+            server.process_op({"opcode": "MULTI", "ranges": ranges, "char": key, "id": 1})
+            assert server.doc == edited
+
+            self.send_key(server, 1, 1, 0, "", opcode="UNDO")
+            assert server.doc == ["abc\n", "def\n", "ghi"]
+            self.send_key(server, 1, 1, 0, "", opcode="REDO")
+            assert server.doc == edited
+            self.send_key(server, 1, 1, 0, "", opcode="UNDO")
+            assert server.doc == ["abc\n", "def\n", "ghi"]
+
+    def test_highlight_sends_only_relexed_lines(self, server):
+        """Test that highlighters get all tokens once and then just the lines an edit touched"""
+        server.doc = ["x = 1\n"] * 50 + ["y"]
+        server.clients[1] = FakeSocket()
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append((kind, payload))
+
+        server.process_op({"opcode": "HIGHLIGHT", "on": True, "id": 1})
+        self.send_key(server, 1, 51, 1, "Return")
+        self.send_key(server, 1, 52, 0, "#")
+
+        kind, full = results[0]
+        assert kind == "TOKENS" and full["full"] and len(full["lines"]) == 51
+        split, comment = results[1][1], results[2][1]
+        assert split["structure"] == [[2, 51]]
+        assert [line for line, spans in split["lines"]] == [51, 52]
+        assert comment["lines"] == [[52, [[0, 1, "comment"]]]]
+
+
+    def queued_ops(self, server, sock):
+        server.op_queue = FairQueue(rate=0)
+        server.connection_handler(sock, ("127.0.0.1", 0), 5)
+        return [server.op_queue.get() for i in range(server.op_queue.qsize())]
+
+    def test_malformed_op_doesnt_stop_updater(self, server):
+        """Test that a bad op gets an error reply and the ops after it are still applied"""
+        sock = FakeSocket()
+        server.clients[1] = sock
+        server.client_cursors[1] = "1.0"
+        server.doc = ["hello"]
+        server.ops_processed = 0
+        server.op_queue = FairQueue(rate=0)
+        server.op_queue.put({"opcode": "VIEWPORT", "first": 1, "count": "x", "id": 1}, 1)
+        server.op_queue.put({"opcode": "FIND", "id": 1}, 1)
+        server.op_queue.put({"opcode": "MODIFY", "line": "1", "idx": "5", "char": "!", "ver": 0, "id": 1}, 1)
+        # replies to a connection that already left the editors are dropped, not a KeyError
+        server.op_queue.put({"opcode": "HISTORY", "ver": 0, "id": 2}, 2)
+        threading.Thread(target=server.doc_updater, daemon=True).start()
+
+        for attempt in range(100):
+            if server.ops_processed == 4:
+                break
+            time.sleep(0.01)
+
+        assert server.ops_processed == 4
+        assert server.doc == ["hello!"] and server.doc_ver == 1
+        errors = [json.loads(frame.decode()[len("ERROR: "):-1]) for frame in sock.sent if frame.startswith(b"ERROR: ")]
+        assert [error["opcode"] for error in errors] == ["VIEWPORT", "FIND"]
+
+    def test_handler_binds_ops_to_connection(self, server):
+        """Test that ops act on the connection's session whatever id the payload claims"""
+        sock = ScriptedSocket({"opcode": "MODIFY", "line": "1", "idx": "0", "char": "a", "id": 9},
+                              {"opcode": "DISCONNECT", "id": 9, "socket": None})
+
+        ops = self.queued_ops(server, sock)
+
+        assert [(op["opcode"], op["id"]) for op in ops] == [("MODIFY", 5), ("DISCONNECT", 5)]
+        assert ops[-1]["socket"] is sock
+
+    def test_handler_enforces_role(self, server):
+        """Test that nothing but AUTH gets through before authenticating, and read keys can't edit"""
+        server.auth_keys = {"r": "read"}
+        modify = {"opcode": "MODIFY", "line": "1", "idx": "0", "char": "a"}
+        sock = ScriptedSocket(modify, {"opcode": "AUTH", "key": "r"}, modify, {"opcode": "FIND", "pattern": "a"})
+
+        ops = self.queued_ops(server, sock)
+
+        assert [op["opcode"] for op in ops] == ["SESSION", "FIND", "DISCONNECT"]
+        assert ops[0]["role"] == "read" and ops[0]["socket"] is sock
+
+    def test_handler_rejects_unknown_key(self, server):
+        """Test that a bad key gets an error frame and nothing else is processed"""
+        server.auth_keys = {"w": "write"}
+        sock = ScriptedSocket({"opcode": "AUTH", "key": "nope"}, {"opcode": "FIND", "pattern": "a"})
+
+        ops = self.queued_ops(server, sock)
+
+        assert [op["opcode"] for op in ops] == ["DISCONNECT"]
+        assert sock.sent == [b'AUTH: {"error": "unknown key"}\x1e']
+
+    def test_resume_needs_session_token(self, server):
+        """Test that only the token handed out at AUTH takes a session over"""
+        server.auth_keys = {"w": "write"}
+        server.doc = ["hello"]
+        old, new = FakeSocket(), FakeSocket()
+        server.process_op({"opcode": "SESSION", "id": 1, "token": "t1", "role": "write", "socket": old})
+        assert server.clients == {1: old}
+        assert json.loads(old.sent[0].decode().rstrip("\u001E").split(": ", 1)[1])["token"] == "t1"
+        server.process_op({"opcode": "DISCONNECT", "id": 1, "socket": old})
+
+        # a stranger guessing the id resumes only its own session
+        server.op_queue = FairQueue(rate=0)
+        stranger = ScriptedSocket({"opcode": "AUTH", "key": "w"}, {"opcode": "RESUME", "prev_id": 1, "token": "x", "ver": 0})
+        server.connection_handler(stranger, ("127.0.0.1", 0), 3)
+        assert server.op_queue.get()["opcode"] == "SESSION"
+        assert server.op_queue.get()["prev_id"] == 3
+
+        server.process_op({"opcode": "SESSION", "id": 2, "token": "t2", "role": "write", "socket": new})
+        server.process_op({"opcode": "RESUME", "id": 2, "prev_id": 1, "token": "t1", "ver": 0})
+        assert server.clients[1] is new and 2 not in server.clients
+        # the new connection's token now names the resumed session, the old one is spent
+        assert server.sessions == {"t2": 1} and server.tokens == {1: "t2"}
+
+    def test_resync_sends_only_differing_lines(self, server):
+        """Test that a client resyncing by hashes gets back just what it's missing"""
+        server.doc = [f"line {i}\n" for i in range(1000)]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append((kind, payload))
+        theirs = list(server.doc)
+        server.process_op({"opcode": "RESYNC", "blocks": block_hashes(theirs), "root": "", "id": 1})
+        self.send_key(server, 1, 500, 0, "Return")
+        self.send_key(server, 1, 3, 0, "x")
+        blocks = block_hashes(theirs)
+
+        server.process_op({"opcode": "RESYNC", "blocks": blocks, "root": root_hash(blocks, theirs), "id": 1})
+
+        kind, payload = results[-1]
+        assert kind == "RESYNC" and payload["ver"] == 2
+        assert rebuild(theirs, payload["ops"]) == server.doc
+        # the two edited blocks plus the tail that never fills one
+        assert sum(isinstance(op, str) for op in payload["ops"]) < 3 * BLOCK_LINES
+
+        blocks = block_hashes(server.doc)
+        server.process_op({"opcode": "RESYNC", "blocks": blocks, "root": root_hash(blocks, server.doc), "id": 1})
+        assert results[-1] == ("RESYNC", {"ver": 2, "cursor": "3.1", "same": True})
+
+    def test_history_queries(self, server):
+        """Test that past versions and diffs between them can be asked for"""
+        server.versions = VersionStore(checkpoint_every=2, max_checkpoints=2)
+        server.doc = ["abc"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+        results = []
+        server.send_result = lambda client_id, kind, payload: results.append(payload)
+        for i, char in enumerate("defgh"):
+            self.send_key(server, 1, 1, 3 + i, char)
+
+        server.process_op({"opcode": "HISTORY", "ver": 4, "id": 1})
+        server.process_op({"opcode": "HISTORY", "from": 3, "to": 5, "id": 1})
+        server.process_op({"opcode": "HISTORY", "ver": 1, "id": 1})
+        server.process_op({"opcode": "HISTORY", "from": 3, "id": 1})
+        server.process_op({"opcode": "HISTORY", "ver": "latest", "id": 1})
+        server.process_op({"opcode": "HISTORY", "from": None, "to": 5, "id": 1})
+
+        assert results[0] == {"ver": 4, "doc": ["abcdefg"]}
+        assert results[1]["diff"][-2:] == ["-abcdef", "+abcdefgh"]
+        # two checkpoints, at versions 3 and 5, so version 1 is gone
+        assert results[2] == {"error": "only versions 3 to 5 are kept"}
+        # malformed queries get an error instead of taking the updater down
+        assert all("error" in result for result in results[3:])
+
+    def test_parse_ops_keeps_partial_op(self, server):
+        """Test that an op split across reads, even inside a character, is parsed once it's whole"""
+        data = (json.dumps({"opcode": "MODIFY", "char": "a"}) + "\u001D" +
+                json.dumps({"opcode": "MODIFY", "char": "é"}, ensure_ascii=False) + "\u001D").encode()
+        cut = data.index("é".encode()) + 1
+
+        ops, rest = server.parse_ops(data[:cut])
+        assert [op["char"] for op in ops] == ["a"]
+        ops, rest = server.parse_ops(rest + data[cut:])
+        assert [op["char"] for op in ops] == ["é"] and rest == b""
+
+    def test_backspace_and_arrows_move_by_character(self, server):
+        """Test that backspace and left/right treat an emoji sequence as one character"""
+        thumbs = "\U0001f44d\U0001f3fd"
+        server.doc = ["a" + thumbs + "b"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.0"
+        server.send_file = lambda x: None
+
+        self.send_key(server, 1, 1, 1, "Right", opcode="CURSOR")
+        assert server.client_cursors[1] == "1.3"
+        self.send_key(server, 1, 1, 3, "Left", opcode="CURSOR")
+        assert server.client_cursors[1] == "1.1"
+        self.send_key(server, 1, 1, 3, "BackSpace")
+        assert server.doc == ["ab"]
+        # and it undoes as one step
+        self.send_key(server, 1, 1, 0, "", opcode="UNDO")
+        assert server.doc == ["a" + thumbs + "b"]
+
+    def test_import_replaces_doc_chunk_by_chunk(self, server):
+        """Test that IMPORT chunks append to a fresh doc, split lines included, one version each"""
+        server.doc = ["old text"]
+        server.clients[1] = None
+        server.client_cursors[1] = "1.5"
+        broadcasts, results = [], []
+        server.send_file = lambda x: broadcasts.append(server.doc_ver)
+        server.send_result = lambda client_id, kind, payload: results.append((kind, payload))
+
+        for seq, text in enumerate(["first\nsec", "ond\n", "third"]):
+            server.process_op({"opcode": "IMPORT", "seq": seq, "text": text, "start": seq == 0, "done": seq == 2, "id": 1})
+
+        assert server.doc == ["first\n", "second\n", "third"]
+        assert results == [("IMPORT", {"seq": i, "ver": i + 1}) for i in range(3)]
+        # the middle chunk came in right after a broadcast, so only the first and last broadcast
+        assert broadcasts == [1, 3]
+
+    def test_undo_after_import_leaves_new_doc_alone(self, server):
+        """Test that edits made before an IMPORT can't be undone into the imported doc"""
+        server.doc = ["old text"]
+        server.clients[1] = None
+        server.clients[2] = None
+        server.client_cursors[1] = "1.0"
+        server.client_cursors[2] = "1.0"
+        server.send_file = lambda x: None
+        server.send_result = lambda client_id, kind, payload: None
+        self.send_key(server, 2, 1, 8, "backspace")
+        self.send_key(server, 2, 1, 1, "backspace")
+
+        server.process_op({"opcode": "IMPORT", "seq": 0, "text": "new\nfile", "start": True, "done": True, "id": 1})
+        self.send_key(server, 2, 1, 0, "", opcode="UNDO")
+        self.send_key(server, 2, 1, 0, "", opcode="UNDO")
+
+        assert server.doc == ["new\n", "file"]
+        assert not server.history.undo_stacks.get(2)
@@ -0,0 +1,29 @@
+from simulate import Simulation, run_batch
+
+
+class TestSimulate:
+    """Seeded simulations of concurrent editors over a lossy virtual network"""
+
+    def test_scenarios_converge(self):
+        """Test that every client ends up with the server's doc across many seeds"""
+        failures, latencies, elapsed = run_batch(range(200))
+
+        assert failures == []
+        assert latencies
+
+    def test_converge_with_drops(self):
+        """Test that clients dropped often still catch up through resume"""
+        failures, latencies, elapsed = run_batch(range(50), clients=4, steps=60, drop_rate=0.2)
+
+        assert failures == []
+
+    def test_same_seed_same_run(self):
+        """Test that a seed replays exactly, so a failure can be reproduced"""
+        first, second = Simulation(7), Simulation(7)
+        first.run()
+        second.run()
+
+        assert first.server.doc == second.server.doc
+        assert first.server.doc_ver == second.server.doc_ver
+        assert first.latencies == second.latencies
+        assert first.network.now == second.network.now
@@ -0,0 +1,61 @@
+from tokenizer import lex_line, SyntaxIndex
+from history import INSERT, SPLIT, JOIN
+
+
+class TestTokenizer:
+    """Unit tests for the line lexer and the incremental syntax index"""
+
+    def test_lex_line(self):
+        """Test keywords, strings, numbers and comments on one line"""
+        spans, state = lex_line('def f(): return "a#b" + 12 # done')
+        assert spans == [[0, 3, "keyword"], [9, 15, "keyword"], [16, 21, "string"],
+                         [24, 26, "number"], [27, 33, "comment"]]
+        assert state is None
+
+    def test_triple_quotes_carry_over(self):
+        """Test that an open triple-quoted string is the state handed to the next line"""
+        spans, state = lex_line('x = """doc')
+        assert spans == [[4, 10, "string"]] and state == '"""'
+        spans, state = lex_line('still', state)
+        assert spans == [[0, 5, "string"]] and state == '"""'
+        spans, state = lex_line('end""" if', state)
+        assert spans == [[0, 6, "string"], [7, 9, "keyword"]] and state is None
+
+    def test_refresh_relexes_only_touched_lines(self):
+        """Test that an edit re-lexes its own line and nothing else"""
+        doc = ["a = 1\n"] * 100 + ["b"]
+        index = SyntaxIndex()
+        assert index.refresh(doc)
+
+        doc[49] = "a = 12\n"
+        index.on_edit(INSERT, 50, 5, 1)
+        assert not index.refresh(doc)
+        changes = index.take_changes()
+        assert changes == {"structure": [], "lines": [[50, [[4, 6, "number"]]]]}
+
+    def test_opening_a_string_cascades(self):
+        """Test that opening a triple quote re-lexes the lines below until the state settles"""
+        doc = ["a\n", "b\n", "c = '''\n", "d"]
+        index = SyntaxIndex()
+        index.refresh(doc)
+        doc[0] = "'''a\n"
+        index.on_edit(INSERT, 1, 0, 3)
+        index.refresh(doc)
+        # line 3's quote now closes the string instead of opening one, line 4 is code again
+        assert [line for line, spans in index.take_changes()["lines"]] == [1, 2, 3, 4]
+        assert index.spans[3] == []
+
+    def test_split_and_join_follow_the_doc(self):
+        """Test that line splits and joins keep spans aligned and are reported in order"""
+        doc = ["if x:\n", "pass"]
+        index = SyntaxIndex()
+        index.refresh(doc)
+        doc[:1] = ["if\n", " x:\n"]
+        index.on_edit(SPLIT, 1, 2, 0)
+        index.refresh(doc)
+        assert index.spans == [[[0, 2, "keyword"]], [], [[0, 4, "keyword"]]]
+        doc[:2] = ["if x:\n"]
+        index.on_edit(JOIN, 2, 2, 0)
+        index.refresh(doc)
+        assert index.spans == [[[0, 2, "keyword"]], [[0, 4, "keyword"]]]
+        assert index.take_changes()["structure"] == [[SPLIT, 1], [JOIN, 2]]
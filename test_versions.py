@@ -0,0 +1,117 @@
+import threading
+import versions
+from versions import VersionStore
+from history import INSERT, SPLIT
+from autosave import write_atomic
+from paging import PagedDoc
+
+
+class TestVersionStore:
+    """Unit tests for checkpointed version history"""
+
+    def make_history(self, store, versions=10):
+        # version v appends str(v) to the first line, every third one also splits it
+        doc = ["x"]
+        store.reset(0, doc)
+        docs = [list(doc)]
+        for v in range(1, versions + 1):
+            store.extend(v, [[INSERT, 1, len(doc[0]), str(v)]])
+            doc[0] += str(v)
+            if v % 3 == 0:
+                store.extend(v, [[SPLIT, 1, 1, ""]])
+                doc[0:1] = [doc[0][:1] + "\n", doc[0][1:]]
+            store.commit(v, doc)
+            docs.append(list(doc))
+        return docs
+
+    def test_doc_at_every_version(self):
+        """Test that any kept version is rebuilt from its checkpoint and the edits after it"""
+        store = VersionStore(checkpoint_every=4, max_checkpoints=10)
+        docs = self.make_history(store)
+
+        assert store.vers == [0, 4, 8]
+        for v, doc in enumerate(docs):
+            assert store.doc_at(v) == doc
+        assert store.doc_at(11) is None
+
+    def test_retention_drops_old_versions(self):
+        """Test that only max_checkpoints checkpoints and the edits after them are kept"""
+        store = VersionStore(checkpoint_every=2, max_checkpoints=2)
+        docs = self.make_history(store)
+
+        assert store.vers == [8, 10]
+        assert store.doc_at(7) is None
+        assert store.doc_at(9) == docs[9]
+        assert min(store.edits) == 9
+
+    def test_checkpoints_on_disk(self, tmp_path):
+        """Test that with a directory checkpoints are files, and dropped ones are deleted"""
+        store = VersionStore(checkpoint_every=3, max_checkpoints=2, directory=str(tmp_path))
+        docs = self.make_history(store)
+        store.flush()
+
+        assert all(doc is None for doc in store.checkpoints) and not store.pending
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["checkpoint-6.json", "checkpoint-9.json"]
+        assert store.doc_at(7) == docs[7]
+        assert store.diff(6, 10) is not None and store.diff(2, 10) is None
+
+    def test_checkpoint_written_in_background(self, tmp_path, monkeypatch):
+        """Test that taking a checkpoint doesn't wait for the disk, and it reads back before it lands"""
+        started, release = threading.Event(), threading.Event()
+        def slow_write(path, lines):
+            started.set()
+            release.wait()
+            write_atomic(path, lines)
+        monkeypatch.setattr(versions, "write_atomic", slow_write)
+        store = VersionStore(checkpoint_every=100, directory=str(tmp_path))
+
+        store.reset(0, ["a\n", "b"])
+        started.wait(1)
+
+        assert store.doc_at(0) == ["a\n", "b"]
+        assert not (tmp_path / "checkpoint-0.json").exists()
+        release.set()
+        store.flush()
+        assert (tmp_path / "checkpoint-0.json").exists() and not store.pending
+        assert store.doc_at(0) == ["a\n", "b"]
+
+    def test_paged_checkpoints_stay_within_budget(self, tmp_path, monkeypatch):
+        """Test that checkpointing a paged doc, mid-edit, neither reads it into memory nor sees later edits"""
+        started, release = threading.Event(), threading.Event()
+        def slow_write(path, lines):
+            started.set()
+            release.wait()
+            write_atomic(path, lines)
+        monkeypatch.setattr(versions, "write_atomic", slow_write)
+        lines = [f"line {i}\n" for i in range(20000)]
+        doc = PagedDoc(lines, budget=20000, page_lines=16)
+        store = VersionStore(checkpoint_every=1, directory=str(tmp_path))
+
+        store.reset(0, doc)
+        started.wait(1)
+        held = [part for part in store.pending[0].parts if isinstance(part, list)]
+        assert sum(map(len, held)) < len(lines) // 10 # only the pages that were in memory anyway
+        for v in range(1, 5):
+            for i in range(0, 20000, 499):
+                doc[i] = f"version {v}\n"
+            store.commit(v, doc)
+            assert doc.resident_bytes <= 20000
+        release.set()
+        store.flush()
+
+        assert doc.resident_bytes <= 20000
+        assert store.doc_at(0) == lines
+        assert store.doc_at(4) == list(doc) and doc[499] == "version 4\n"
+
+    def test_failed_checkpoint_is_dropped(self, tmp_path, monkeypatch):
+        """Test that a checkpoint that couldn't be written isn't kept in memory instead"""
+        def failing_write(path, lines):
+            raise OSError("disk full")
+        monkeypatch.setattr(versions, "write_atomic", failing_write)
+        store = VersionStore(checkpoint_every=100, directory=str(tmp_path))
+
+        store.reset(0, ["a\n", "b"])
+        store.flush()
+
+        assert not store.pending
+        assert store.doc_at(0) is None
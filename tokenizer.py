@@ -0,0 +1,111 @@
+import keyword
+import re
+from history import INSERT, DELETE, SPLIT, JOIN
+
+# a Python-flavoured lexer that works one line at a time. The only state carried from one line
+# to the next is an open triple-quoted string, so a line can be re-lexed from the state the line
+# above it ended in
+TOKEN_RE = re.compile(r"""
+    (?P<comment>\#.*)
+  | (?P<triple>[rRbBuUfF]{0,2}(?:'''|\"\"\"))
+  | (?P<string>[rRbBuUfF]{0,2}(?:'(?:\\.|[^'\\])*'?|"(?:\\.|[^"\\])*"?))
+  | (?P<number>\b\d[\d_]*(?:\.\d*)?(?:[eE][+-]?\d+)?[jJ]?)
+  | (?P<name>[A-Za-z_]\w*)
+""", re.VERBOSE)
+
+
+def lex_line(text, state=None):
+    # returns ([[start, end, kind], ...], end state); state is the open triple quote or None
+    spans = []
+    pos = 0
+    if state is not None:
+        close = text.find(state)
+        if close < 0:
+            return ([[0, len(text), "string"]] if text else []), state
+        spans.append([0, close + 3, "string"])
+        pos = close + 3
+    while True:
+        m = TOKEN_RE.search(text, pos)
+        if m is None:
+            return spans, None
+        kind = m.lastgroup
+        start, end = m.span()
+        if kind == "triple":
+            quote = m.group()[-3:]
+            close = text.find(quote, end)
+            if close < 0:
+                spans.append([start, len(text), "string"])
+                return spans, quote
+            kind, end = "string", close + 3
+        elif kind == "name":
+            if not keyword.iskeyword(m.group()):
+                pos = end
+                continue
+            kind = "keyword"
+        spans.append([start, end, kind])
+        pos = end
+
+
+class SyntaxIndex(object):
+    # token spans of every line plus the lexer state each line ends in. Edits only mark lines
+    # dirty; refresh() re-lexes those and carries on downwards only while a line's end state
+    # changed (a triple quote was opened or closed), so the work follows the edit, not the doc.
+    # Nothing is built until somebody asks for tokens.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.spans = []
+        self.states = []
+        self.dirty = set()     # 0-based lines to re-lex
+        self.changed = set()   # 1-based lines re-lexed since take_changes()
+        self.structure = []    # [SPLIT|JOIN, line] since take_changes(), in order
+
+    def on_edit(self, kind, line, idx, n):
+        if not self.spans:
+            return
+        if kind in (INSERT, DELETE):
+            self.dirty.add(line - 1)
+            return
+        if kind == SPLIT:
+            # the new line ends where the old one did
+            self.spans.insert(line, None)
+            self.states.insert(line, self.states[line - 1])
+            self.dirty = {i + 1 if i >= line else i for i in self.dirty} | {line - 1, line}
+            self.changed = {l + 1 if l > line else l for l in self.changed}
+        elif kind == JOIN:
+            self.spans.pop(line - 1)
+            self.states[line - 2] = self.states.pop(line - 1)
+            self.dirty = {i - 1 if i >= line - 1 else i for i in self.dirty} | {line - 2}
+            self.changed = {l - 1 if l >= line else l for l in self.changed}
+        self.structure.append([kind, line])
+
+    def refresh(self, doc):
+        # re-lex what the edits touched; returns True if the whole doc had to be lexed
+        if len(self.spans) != len(doc):
+            # first use, or the doc was replaced without going through the edit listeners
+            self.reset()
+            self.spans = [None] * len(doc)
+            self.states = [None] * len(doc)
+            state = None
+            for i, text in enumerate(doc):
+                self.spans[i], state = lex_line(text.rstrip("\n"), state)
+                self.states[i] = state
+            return True
+        for i in sorted(self.dirty):
+            while i < len(doc):
+                old = self.states[i]
+                self.spans[i], self.states[i] = lex_line(doc[i].rstrip("\n"), self.states[i - 1] if i > 0 else None)
+                self.changed.add(i + 1)
+                if self.states[i] == old:
+                    break
+                i += 1
+        self.dirty.clear()
+        return False
+
+    def take_changes(self):
+        # what changed since the last call: line splits/joins in order, then the re-lexed lines
+        changes = {"structure": self.structure, "lines": [[line, self.spans[line - 1]] for line in sorted(self.changed)]}
+        self.structure = []
+        self.changed = set()
+        return changes
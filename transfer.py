@@ -0,0 +1,107 @@
+import argparse
+import json
+import socket
+import sys
+from autosave import write_atomic
+from protocol import read_greeting
+
+DELIMITER = "\u001D"
+FRAME_END = "\u001E"
+CHUNK_CHARS = 64 * 1024 # characters of the file per IMPORT op
+WINDOW = 4              # chunks sent ahead of the server's acks
+
+# streams a file into a running server, or the server's doc out to a file or stdout, holding
+# no more than a few chunks in memory either way:
+#   python transfer.py import HOST PORT FILE
+#   python transfer.py export HOST PORT [FILE]
+
+
+class Transfer(object):
+    def __init__(self, host, port, key=None):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.id, self.buffer = read_greeting(self.sock)
+        if key is not None:
+            self.send({"opcode": "AUTH", "key": key})
+
+    def send(self, op):
+        op["id"] = self.id
+        self.sock.sendall((json.dumps(op) + DELIMITER).encode())
+
+    def results(self, kind):
+        # payloads of the KIND frames the server sends, skipping doc frames and anything else
+        while True:
+            *frames, self.buffer = self.buffer.split(FRAME_END.encode())
+            for frame in frames:
+                name, _, payload = frame.decode("utf-8").partition(": ")
+                if name == "AUTH":
+                    raise PermissionError(json.loads(payload)["error"])
+                if name == kind:
+                    yield json.loads(payload)
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.buffer += data
+
+    def upload(self, f, chunk_chars=CHUNK_CHARS, window=WINDOW):
+        # at most `window` chunks are unacknowledged, so a busy server slows us down instead
+        # of piling our chunks up in its queue. Returns the doc version once the last one landed
+        # a one line viewport keeps the doc frames the server sends us tiny
+        self.send({"opcode": "VIEWPORT", "first": 1, "count": 1})
+        acks = self.results("IMPORT")
+        seq, in_flight, ver = 0, 0, None
+        chunk = f.read(chunk_chars)
+        while True:
+            following = f.read(chunk_chars) if chunk else ""
+            done = not following
+            self.send({"opcode": "IMPORT", "seq": seq, "text": chunk, "start": seq == 0, "done": done})
+            seq += 1
+            in_flight += 1
+            while in_flight >= window or (done and in_flight):
+                ver = next(acks)["ver"]
+                in_flight -= 1
+            if done:
+                return ver
+            chunk = following
+
+    def download(self):
+        # yields the doc's lines a frame at a time
+        self.send({"opcode": "EXPORT"})
+        for payload in self.results("EXPORT"):
+            yield from payload["lines"]
+            if payload["done"]:
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("direction", choices=["import", "export"], help="Send a file to the server, or save the server's doc")
+    parser.add_argument("host", help="Server's IP address")
+    parser.add_argument("port", help="Server's port number")
+    parser.add_argument("file", nargs="?", default="-", help="File to read or write, - for stdin/stdout")
+    parser.add_argument("--key", help="Key to authenticate with, for servers started with --auth")
+    parser.add_argument("--chunk", type=int, default=CHUNK_CHARS, help="Characters per chunk sent to the server")
+    args = parser.parse_args()
+
+    transfer = Transfer(args.host, int(args.port), args.key)
+    try:
+        if args.direction == "import":
+            if args.file == "-":
+                ver = transfer.upload(sys.stdin, args.chunk)
+            else:
+                with open(args.file, encoding="utf-8") as f:
+                    ver = transfer.upload(f, args.chunk)
+            print(f"Imported {args.file} as version {ver}", file=sys.stderr)
+        elif args.file == "-":
+            sys.stdout.writelines(transfer.download())
+        else:
+            # written next to the target and renamed over it once complete
+            write_atomic(args.file, transfer.download())
+    finally:
+        transfer.close()
+
+if __name__ == "__main__":
+    main()
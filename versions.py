@@ -0,0 +1,151 @@
+import bisect
+import difflib
+import json
+import os
+import queue
+import threading
+from collections import deque
+from history import replay_edit, apply_to_lines
+from autosave import write_atomic
+from paging import snapshot
+
+DEFAULT_CHECKPOINT_EVERY = 1000 # versions between full copies of the doc
+DEFAULT_MAX_CHECKPOINTS = 20    # older checkpoints are dropped along with the edits after them
+
+
+def json_array(lines):
+    # a JSON list of the lines written out one at a time, so a paged doc is never copied whole
+    yield "["
+    for i, line in enumerate(lines):
+        yield ("," if i else "") + json.dumps(line)
+    yield "]"
+
+
+class VersionStore(object):
+    # past versions of the doc: a checkpoint every few versions plus the edits in between, so
+    # "the doc at version V" starts from the nearest checkpoint at or before V and replays at
+    # most checkpoint_every versions of edits. Only max_checkpoints are kept, which bounds
+    # memory (and disk, with a directory the checkpoints are written there instead of kept).
+    # Checkpoints are taken on the updater thread as a snapshot, which for a paged doc shares
+    # its pages rather than copying them; a writer thread streams them to disk, in order with
+    # the deletes of dropped ones
+    def __init__(self, checkpoint_every=DEFAULT_CHECKPOINT_EVERY, max_checkpoints=DEFAULT_MAX_CHECKPOINTS, directory=None):
+        self.checkpoint_every = checkpoint_every
+        self.max_checkpoints = max_checkpoints
+        self.directory = directory
+        self.vers = []                # checkpoint versions, oldest first
+        self.checkpoints = deque()    # their lines, or None when they live in directory
+        self.edits = {}               # ver -> replayable edits that made that version
+        self.newest = None            # the last version we know the edits for
+        self.pending = {}             # ver -> lines of a checkpoint not on disk yet
+        self.lock = threading.Lock()  # guards pending between the updater and the writer
+        self.jobs = queue.Queue()
+        self.writer = None
+
+    def reset(self, ver, doc):
+        # the doc was replaced wholesale, history starts over from it
+        for old in self.vers:
+            self.remove_file(old)
+        self.vers = []
+        self.checkpoints.clear()
+        self.edits.clear()
+        self.checkpoint(ver, doc)
+
+    def record(self, ver, inverse):
+        self.extend(ver, [replay_edit(inverse)])
+
+    def extend(self, ver, edits):
+        if self.vers:
+            self.edits.setdefault(ver, []).extend(edits)
+
+    def commit(self, ver, doc):
+        # called once a version is complete; takes a checkpoint when one is due
+        if not self.vers or ver - self.vers[-1] >= self.checkpoint_every:
+            self.checkpoint(ver, doc)
+        self.newest = ver
+
+    def checkpoint(self, ver, doc):
+        lines = snapshot(doc)
+        if self.directory is not None:
+            with self.lock:
+                self.pending[ver] = lines
+            self.submit(("write", ver, lines))
+            self.checkpoints.append(None)
+        else:
+            self.checkpoints.append(lines)
+        self.vers.append(ver)
+        self.newest = ver
+        while len(self.vers) > self.max_checkpoints:
+            old = self.vers.pop(0)
+            self.checkpoints.popleft()
+            self.remove_file(old)
+            for v in range(old + 1, self.vers[0] + 1):
+                self.edits.pop(v, None)
+
+    def path(self, ver):
+        return os.path.join(self.directory, f"checkpoint-{ver}.json")
+
+    def remove_file(self, ver):
+        if self.directory is not None:
+            self.submit(("remove", ver, None))
+
+    def submit(self, job):
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.run, daemon=True, name="checkpoint_thread")
+            self.writer.start()
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            action, ver, lines = self.jobs.get()
+            try:
+                if action == "write":
+                    write_atomic(self.path(ver), json_array(lines))
+                else:
+                    os.unlink(self.path(ver))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # a checkpoint that didn't make it to disk is lost, versions from it read as not kept
+                print(f"Couldn't {action} checkpoint {ver}: {e}")
+            finally:
+                with self.lock:
+                    self.pending.pop(ver, None)
+                self.jobs.task_done()
+
+    def flush(self):
+        # wait for the writer to catch up
+        self.jobs.join()
+
+    def oldest(self):
+        return self.vers[0] if self.vers else None
+
+    def doc_at(self, ver):
+        # the lines of version ver, or None if it's older than what is kept or not reached yet
+        if not self.vers or ver < self.vers[0] or ver > self.newest:
+            return None
+        i = bisect.bisect_right(self.vers, ver) - 1
+        base = self.vers[i]
+        doc = self.checkpoints[i]
+        if doc is None:
+            with self.lock:
+                doc = self.pending.get(base)
+        if doc is None:
+            try:
+                with open(self.path(base)) as f:
+                    doc = json.load(f)
+            except FileNotFoundError:
+                return None
+        else:
+            doc = list(doc)
+        for v in range(base + 1, ver + 1):
+            for edit in self.edits.get(v, ()):
+                apply_to_lines(doc, edit)
+        return doc
+
+    def diff(self, old, new):
+        # unified diff lines from version old to version new, None if either one isn't kept
+        before, after = self.doc_at(old), self.doc_at(new)
+        if before is None or after is None:
+            return None
+        return list(difflib.unified_diff(before, after, f"version {old}", f"version {new}"))
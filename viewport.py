@@ -0,0 +1,38 @@
+from history import SPLIT, JOIN
+
+
+class ChangeTracker(object):
+    # remembers which lines the edits since the last broadcast touched, so clients
+    # watching a viewport elsewhere in the doc only need the new line count
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.first = None
+        self.last = None
+        self.structural = False  # a line was added or removed, shifting everything below
+
+    def on_edit(self, kind, line, idx, n):
+        if kind == JOIN:
+            line -= 1
+        if kind in (SPLIT, JOIN):
+            self.structural = True
+        self.first = line if self.first is None else min(self.first, line)
+        self.last = line if self.last is None else max(self.last, line)
+
+    def touches(self, viewport):
+        if self.first is None:
+            return False
+        first, count = viewport
+        last = first + count - 1
+        if self.structural:
+            # lines from the first change down have moved, which includes anything after it
+            return self.first <= last
+        return self.first <= last and self.last >= first
+
+
+def clamp_viewport(first, count, total):
+    # keep a requested range inside the document, never asking for less than one line
+    count = max(1, count)
+    first = max(1, min(first, total - count + 1))
+    return first, count